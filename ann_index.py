@@ -0,0 +1,221 @@
+import argparse
+import hashlib
+import os
+import time
+import numpy as np
+
+# Inverted lists probed per query unless the index was saved with its own
+# count; more probes = better recall, slower search
+N_PROBE = 8
+KMEANS_ITERATIONS = 15
+# Rows scored against the centroids per step while training, bounds memory
+ASSIGN_BATCH = 8192
+
+
+def index_path(gallery_file):
+    """The index lives next to the gallery: train.gal -> train.ivf.npz."""
+    return os.path.splitext(gallery_file)[0] + ".ivf.npz"
+
+
+def fingerprint(encodings):
+    """SHA-1 of the gallery matrix, so a stale index is never used."""
+    return hashlib.sha1(np.ascontiguousarray(encodings, dtype="<f4").tobytes()).hexdigest()
+
+
+def _sq_distances(a, b, b_sq_norms):
+    sq = np.einsum("ij,ij->i", a, a)[:, None] + b_sq_norms[None, :] - 2.0 * (a @ b.T)
+    np.maximum(sq, 0.0, out=sq)
+    return sq
+
+
+def _assign(encodings, centroids):
+    """Index of the nearest centroid for every row, computed in batches."""
+    c_sq = np.einsum("ij,ij->i", centroids, centroids)
+    assignment = np.empty(len(encodings), dtype=np.int64)
+    for start in range(0, len(encodings), ASSIGN_BATCH):
+        batch = encodings[start:start + ASSIGN_BATCH]
+        assignment[start:start + len(batch)] = _sq_distances(batch, centroids, c_sq).argmin(axis=1)
+    return assignment
+
+
+# --------------------------------
+# IVF Index
+# --------------------------------
+class IVFIndex:
+    """
+    Coarse k-means partitions with inverted lists over the gallery rows.
+    A query is compared with every centroid, then only with the rows of
+    its n_probe nearest partitions, instead of with the whole gallery.
+
+    Rows are stored grouped by partition: `order[offsets[i]:offsets[i + 1]]`
+    are the gallery rows of partition i. The probe count is saved with the
+    index, so each deployment tunes it once (`ann_index.py tune`).
+    """
+
+    def __init__(self, centroids, order, offsets, gallery_fingerprint, n_probe=N_PROBE):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.c_sq_norms = np.einsum("ij,ij->i", self.centroids, self.centroids)
+        self.order = np.asarray(order, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.gallery_fingerprint = gallery_fingerprint
+        self.n_probe = int(n_probe)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, encodings, n_lists=None, n_probe=N_PROBE, iterations=KMEANS_ITERATIONS, seed=0):
+        """Train k-means on the gallery rows and bucket every row into a list."""
+        encodings = np.asarray(encodings, dtype=np.float32)
+        n = len(encodings)
+        if n == 0:
+            raise ValueError("Cannot build an index for an empty gallery")
+        n_lists = min(n_lists or max(1, int(4 * np.sqrt(n))), n)
+        rng = np.random.default_rng(seed)
+        centroids = encodings[rng.choice(n, n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignment = _assign(encodings, centroids)
+            counts = np.bincount(assignment, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, encodings)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+            # Re-seed empty partitions with random rows so no list stays unused
+            empty = np.flatnonzero(~filled)
+            if len(empty):
+                centroids[empty] = encodings[rng.choice(n, len(empty), replace=False)]
+
+        assignment = _assign(encodings, centroids)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        return cls(centroids, order, offsets, fingerprint(encodings), n_probe)
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                 fingerprint=np.array(self.gallery_fingerprint), n_probe=np.array(self.n_probe))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            # Indexes saved before the probe count was stored use the default
+            n_probe = int(data["n_probe"]) if "n_probe" in data.files else N_PROBE
+            return cls(data["centroids"], data["order"], data["offsets"], str(data["fingerprint"]), n_probe)
+
+    def search(self, encodings, sq_norms, queries, k, n_probe=None):
+        """
+        Approximate top-k search. Returns (rows, distances) per query, nearest
+        first; fewer than k are returned if the probed lists hold fewer rows.
+        n_probe defaults to the index's own.
+        """
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        coarse = _sq_distances(queries, self.centroids, self.c_sq_norms)
+        probes = np.argpartition(coarse, n_probe - 1, axis=1)[:, :n_probe]
+
+        results = []
+        for query, lists in zip(queries, probes):
+            rows = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+            sq = _sq_distances(query[None, :], encodings[rows], sq_norms[rows])[0]
+            kk = min(k, len(rows))
+            if kk == 0:
+                results.append((rows, sq))
+                continue
+            best = np.argpartition(sq, kk - 1)[:kk]
+            best = best[np.argsort(sq[best])]
+            results.append((rows[best], np.sqrt(sq[best])))
+        return results
+
+
+def build_index(gallery_file, n_lists=None, n_probe=None, encodings=None):
+    """
+    Build the IVF index for a .gal file (or the given rows of it) and save
+    it next to it. Without n_probe, a rebuild keeps the old index's count.
+    """
+    path = index_path(gallery_file)
+    if n_probe is None:
+        n_probe = IVFIndex.load(path).n_probe if os.path.exists(path) else N_PROBE
+    if encodings is None:
+        from gallery import open_gallery
+        encodings = open_gallery(gallery_file).encodings
+    index = IVFIndex.build(encodings, n_lists=n_lists, n_probe=n_probe)
+    index.save(path)
+    return index
+
+
+def tune_index(gallery_file, n_probe):
+    """Change the probe count saved with a .gal file's index; running servers pick it up on reload."""
+    if n_probe < 1:
+        raise ValueError(f"n_probe must be at least 1, got {n_probe}")
+    path = index_path(gallery_file)
+    index = IVFIndex.load(path)
+    index.n_probe = n_probe
+    index.save(path)
+    return index
+
+
+# --------------------------------
+# Recall Report
+# --------------------------------
+def recall_report(gallery, probes=(1, 2, 4, 8, 16, 32), k=10, n_queries=500, noise=0.02, seed=0):
+    """
+    Compare the index with exact search. Queries are gallery rows with a
+    little noise added, standing in for new photos of enrolled people.
+    Returns one dict per probe count with recall@1, recall@k and latency.
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(gallery), min(n_queries, len(gallery)), replace=False)
+    queries = gallery.encodings[picks] + rng.normal(scale=noise, size=(len(picks), gallery.dim)).astype(np.float32)
+
+    start = time.perf_counter()
+    exact = gallery._nearest(queries, k, use_index=False)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = []
+    for n_probe in probes:
+        start = time.perf_counter()
+        approx = gallery.index.search(gallery.encodings, gallery.sq_norms, queries, k, n_probe)
+        approx_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits_1 = sum(len(a[0]) and a[0][0] == e[0][0] for a, e in zip(approx, exact))
+        hits_k = sum(len(np.intersect1d(a[0], e[0])) for a, e in zip(approx, exact))
+        report.append({
+            "n_probe": n_probe,
+            "recall_at_1": round(float(hits_1) / len(queries), 4),
+            f"recall_at_{k}": round(float(hits_k) / (len(queries) * k), 4),
+            "ms_per_query": round(approx_ms, 4),
+            "exact_ms_per_query": round(exact_ms, 4),
+        })
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or evaluate the ANN index of a face gallery.")
+    parser.add_argument("command", choices=["build", "recall", "tune"])
+    parser.add_argument("gallery", help="path to train.gal")
+    parser.add_argument("--lists", type=int, default=None, help="number of k-means partitions (default 4*sqrt(rows))")
+    parser.add_argument("--probes", default="1,2,4,8,16,32", help="comma-separated probe counts to evaluate")
+    parser.add_argument("--n-probe", type=int, default=None,
+                        help=f"probe count to save with the index (build: default kept, or {N_PROBE}; tune: required)")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = build_index(args.gallery, n_lists=args.lists, n_probe=args.n_probe)
+        print(f"Built {index.n_lists} lists over {len(index.order)} rows, probing {index.n_probe}: "
+              f"{index_path(args.gallery)}")
+    elif args.command == "tune":
+        if args.n_probe is None:
+            parser.error("tune needs --n-probe")
+        index = tune_index(args.gallery, args.n_probe)
+        print(f"{index_path(args.gallery)} now probes {index.n_probe} of {index.n_lists} lists")
+    else:
+        from gallery import open_gallery
+        gallery = open_gallery(args.gallery)
+        if gallery.index is None:
+            print(f"Building a temporary index ({index_path(args.gallery)} not found)")
+            gallery.index = IVFIndex.build(gallery.encodings, n_lists=args.lists)
+        probes = [int(p) for p in args.probes.split(",")]
+        for row in recall_report(gallery, probes=probes, k=args.k):
+            print(row)
@@ -0,0 +1,261 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from streaming import MJPEG_CLIENTS, ClientPacer, mjpeg_part
+
+# ASGI serving mode. Each app's asgi.py serves its long-lived endpoints
+# (SSE enrollment, MJPEG streams) as coroutines on one event loop and hands
+# everything else to the Flask app, so a waiting client costs a coroutine
+# instead of a server thread. Run from the app folder with:
+#     uvicorn asgi:app --host 0.0.0.0 --port 5000
+# (requires uvicorn, plus asgiref for the Flask fallback routes)
+
+# Threads for blocking work: camera grabs, file writes, JPEG encoding, recognition
+EXECUTOR_WORKERS = 8
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="async-serving")
+
+
+async def run_blocking(fn, *args):
+    """Run a blocking call on the shared executor without holding up the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def sse(message):
+    """One server-sent event carrying `message` as its data."""
+    return f"data: {message}\n\n"
+
+
+# --------------------------------
+# Requests and Responses
+# --------------------------------
+class Request:
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+
+
+class JSONResponse:
+    def __init__(self, data, status=200):
+        self.body = json.dumps(data).encode()
+        self.status = status
+
+    async def __call__(self, send, receive):
+        await send({"type": "http.response.start", "status": self.status,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class StreamingResponse:
+    """
+    Sends each chunk an async generator yields (str or bytes) as soon as it
+    is ready. The generator is cancelled as soon as the client disconnects,
+    even while it is waiting, so an abandoned stream never runs to the end.
+    """
+
+    def __init__(self, chunks, media_type):
+        self.chunks = chunks
+        self.media_type = media_type
+
+    async def __call__(self, send, receive):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", self.media_type.encode()), (b"cache-control", b"no-cache")]})
+        streaming = asyncio.ensure_future(self._stream(send))
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            await asyncio.wait({streaming, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnected.cancel()
+            streaming.cancel()
+            try:
+                await streaming
+            except asyncio.CancelledError:
+                pass
+            await self.chunks.aclose()
+
+    async def _stream(self, send):
+        async for chunk in self.chunks:
+            await send({"type": "http.response.body", "more_body": True,
+                        "body": chunk.encode() if isinstance(chunk, str) else chunk})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def event_stream(chunks):
+    return StreamingResponse(chunks, "text/event-stream")
+
+
+def mjpeg_response(chunks):
+    return StreamingResponse(chunks, "multipart/x-mixed-replace; boundary=frame")
+
+
+async def single_event(message):
+    yield sse(message)
+
+
+async def _wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+# --------------------------------
+# Application
+# --------------------------------
+class AsyncApp:
+    """
+    Minimal ASGI application: async handlers registered with route() take a
+    Request and return a response; any other request goes to `fallback`,
+    a WSGI (Flask) app run in a thread by asgiref.
+    """
+
+    def __init__(self, fallback=None):
+        self.routes = {}
+        self.fallback = None
+        if fallback is not None:
+            from asgiref.wsgi import WsgiToAsgi
+            self.fallback = WsgiToAsgi(fallback)
+
+    def route(self, path, methods=("GET",)):
+        def register(handler):
+            for method in methods:
+                self.routes[(method, path)] = handler
+            return handler
+        return register
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        handler = self.routes.get((scope.get("method"), scope.get("path")))
+        if handler is not None:
+            response = await handler(Request(scope, receive))
+            await response(send, receive)
+        elif self.fallback is not None:
+            await self.fallback(scope, receive, send)
+        else:
+            await JSONResponse({"message": "Not found"}, 404)(send, receive)
+
+
+# --------------------------------
+# Frames for Coroutines
+# --------------------------------
+class AsyncFrameFeed:
+    """
+    Bridges a capture thread's frames to any number of asyncio clients.
+
+    One pump thread per feed reads the source; each new frame replaces the
+    single shared `frame` and wakes every waiting client, so memory stays
+    at one frame per feed however many clients there are. A client that is
+    still sending simply picks up the newest frame afterwards.
+
+    `open_frames()` is called when the first client arrives and must return
+    (frame iterator, close callable); close is called after the last client
+    leaves and must make the iterator end.
+    """
+
+    def __init__(self, open_frames):
+        self.open_frames = open_frames
+        self.frame = None
+        self._clients = 0
+        self._close = None
+        self._ended = False
+        self._loop = None
+        self._changed = None
+        self._pumping = None
+
+    @classmethod
+    def for_camera(cls, camera):
+        """Feed from a CameraBroadcaster (or LiveCamera) subscription."""
+        def open_frames():
+            subscription = camera.subscribe()
+            return iter(subscription), lambda: camera.unsubscribe(subscription)
+        return cls(open_frames)
+
+    @classmethod
+    def for_slot(cls, slot):
+        """Feed from a FrameSlot that some other thread keeps publishing to."""
+        def open_frames():
+            running = threading.Event()
+            running.set()
+            return slot.frames(running.is_set), running.clear
+        return cls(open_frames)
+
+    def _publish(self, frame, pumping):
+        if pumping is not self._pumping:
+            return  # from a pump that has since been stopped
+        self.frame = frame
+        if frame is None:
+            self._ended = True
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _pump(self, frames, pumping):
+        try:
+            for frame in frames:
+                self._loop.call_soon_threadsafe(self._publish, frame, pumping)
+        finally:
+            self._loop.call_soon_threadsafe(self._publish, None, pumping)
+
+    def _start(self):
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self._ended = False
+        self._pumping = object()
+        frames, self._close = self.open_frames()
+        threading.Thread(target=self._pump, args=(frames, self._pumping), daemon=True).start()
+
+    def _stop(self):
+        self._pumping = None
+        self.frame = None
+        self._close()
+
+    async def frames(self):
+        """Async generator of the newest frames for one client, skipping any it was too slow for."""
+        self._clients += 1
+        if self._clients == 1:
+            self._start()
+        try:
+            seq = 0
+            while not self._ended:
+                changed = self._changed
+                frame = self.frame
+                if frame is not None and frame.seq > seq:
+                    seq = frame.seq
+                    yield frame
+                    continue
+                await changed.wait()
+        finally:
+            self._clients -= 1
+            if self._clients == 0:
+                self._stop()
+
+
+async def adaptive_mjpeg_async(feed, variants, caps=None):
+    """
+    The asyncio counterpart of streaming.adaptive_mjpeg: one client's MJPEG
+    parts at the tier its ClientPacer settles on. Encodings another client
+    already made are taken from the cache; new ones are made on the executor.
+    """
+    pacer = ClientPacer(caps)
+    MJPEG_CLIENTS.inc()
+    try:
+        async for frame in feed.frames():
+            if not pacer.want(frame):
+                continue
+            jpeg = variants.cached(frame, pacer.current)
+            if jpeg is None:
+                jpeg = await run_blocking(variants.jpeg, frame, pacer.current)
+            start = time.perf_counter()
+            yield mjpeg_part(jpeg)
+            pacer.sent(time.perf_counter() - start)
+    finally:
+        MJPEG_CLIENTS.dec()
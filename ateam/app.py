@@ -1,11 +1,22 @@
 from flask import Flask, render_template, Response, request, jsonify, send_from_directory
 import os
-import subprocess
-import threading
 import time
-import pickle
+import sys
+import cv2
 import face_recognition
 
+# Shared modules (gallery.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera import LiveCamera
+from recording import ContinuousRecorder
+from sources import camera_source
+from metrics import CONTENT_TYPE, render_metrics
+from detection import DetectionPipeline
+from gallery import UNKNOWN, LiveGallery
+from recognition import best_name, recognize_images
+from events import EVENTS_DB, EventStore, parse_limit, parse_time
+from enrollment import GalleryPublisher, enroll, name_error
+
 
 app = Flask(__name__)
 
@@ -16,8 +27,11 @@ app = Flask(__name__)
 PHOTO_FOLDER = "./photos"
 VIDEO_FOLDER = "./videos"
 ACTIVE_PERSON_FOLDER = "./active_person"
-RECOGNITION_LOG = "./recognized_name.txt"
 PKL_FILE = "train.pkl"
+GALLERY_FILE = "train.gal"
+DETECTION_CONFIG = "detection.json"
+RECORD_ON_RECOGNITION = 0  # Seconds to record when a known person is recognized (0 = off)
+RECORD_PREROLL = 0  # Seconds kept in memory and prepended to each recording (0 = off; JPEG-encodes every frame)
 
 
 os.makedirs(PHOTO_FOLDER, exist_ok=True)
@@ -35,95 +49,90 @@ DIRECTIONS = [
     "Slightly Up",
     "Slightly Down"
 ]
-recording = False
-record_process = None
-Encodings = []
-Names = []
 
 
 # --------------------------------
-# Load Known Encodings and Names
+# Load Known Encodings and Names (memory-mapped train.gal)
+# Reloaded automatically whenever training rewrites the files
+# --------------------------------
+live_gallery = LiveGallery(GALLERY_FILE, PKL_FILE).watch()
+
+# Finished enrollments are added to train.gal in the background and go live at once
+publisher = GalleryPublisher(PHOTO_FOLDER, GALLERY_FILE, live_gallery)
+
+# Detection scale/model/upsample/ROI/min face size for this deployment
+detector = DetectionPipeline.from_config(DETECTION_CONFIG)
+
+# Recognition history (timestamp, camera, identity, distance, box, frame), written in the background.
+# Only the newest event frames (MAX_FRAMES in events.py) are kept in ACTIVE_PERSON_FOLDER.
+events = EventStore(EVENTS_DB, frame_dir=ACTIVE_PERSON_FOLDER).start()
+
+
+# --------------------------------
+# Camera (one long-lived GStreamer pipeline owned by the server)
 # --------------------------------
-if os.path.exists(PKL_FILE):
-    with open(PKL_FILE, "rb") as f:
-        Names = pickle.load(f)
-        Encodings = pickle.load(f)
-else:
-    print("Warning: train.pkl not found. Facial recognition will not work.")
+# (set CAMERA_SOURCE, e.g. "file:videos", to replay recordings instead)
+CAMERA_SOURCE = (
+    "gst:nvarguscamerasrc ! "
+    "video/x-raw(memory:NVMM),width=1280,height=720,framerate=60/1 ! "
+    "nvvidconv ! video/x-raw,format=BGRx ! "
+    "videoconvert ! video/x-raw,format=BGR"
+)
+camera = LiveCamera(camera_source(CAMERA_SOURCE), name="ateam").start()
+
+# Recording branch: once triggered, writes fixed-length segments + index.m3u8,
+# starting with the last RECORD_PREROLL seconds if that is set
+recorder = ContinuousRecorder(camera, VIDEO_FOLDER, fps=60, frame_size=(1280, 720),
+                              preroll_seconds=RECORD_PREROLL).start()
 
 
 # --------------------------------
 # Helper Functions
 # --------------------------------
-def capture_photo(photo_path):
-    """Capture a single photo using GStreamer."""
-    gst_command = (
-        f"gst-launch-1.0 nvarguscamerasrc num-buffers=1 ! "
-        f"'video/x-raw(memory:NVMM),width=1280,height=720,framerate=60/1' ! "
-        f"nvvidconv ! videoconvert ! jpegenc ! filesink location={photo_path}"
-    )
-    process = subprocess.run(gst_command, shell=True, stderr=subprocess.PIPE)
-    if process.returncode != 0:
-        print(f"Error capturing photo: {process.stderr.decode()}")
-        return False
-    return True
-
-
-def record_video(duration):
-    """Record video using GStreamer and save it to a file."""
-    global record_process
-    timestamp = time.strftime("%Y%m%d-%H%M%S")
-    video_path = os.path.join(VIDEO_FOLDER, f"video_{timestamp}.mp4")
-
-
-    gst_command = [
-        "gst-launch-1.0",
-        "nvarguscamerasrc",
-        f"num-buffers={duration * 60}",
-        "!",
-        "'video/x-raw(memory:NVMM),width=1280,height=720,framerate=60/1'",
-        "!",
-        "nvvidconv",
-        "!",
-        "videoconvert",
-        "!",
-        "x264enc",
-        "tune=zerolatency",
-        "bitrate=500",
-        "speed-preset=ultrafast",
-        "!",
-        "mp4mux",
-        "!",
-        f"filesink location={video_path}"
-    ]
+def capture_frame():
+    """Take the next frame (BGR) from the live pipeline, or None if the camera is unavailable."""
+    frame = camera.grab()
+    if frame is None:
+        print("Error capturing photo: no frame from the camera")
+        return None
+    return frame.image
 
 
-    try:
-        record_process = subprocess.Popen(" ".join(gst_command), shell=True)
-        record_process.wait(timeout=duration)
-    except subprocess.TimeoutExpired:
-        record_process.terminate()
-    finally:
-        record_process = None
+def recognize_face(image):
+    """Recognize the people in the given BGR frame. Returns the best name and every face found."""
+    # One snapshot for the whole call, even if a reload swaps in a new one meanwhile
+    gallery = live_gallery.get()
+    if not len(gallery):
+        return "Unknown (no training data available)", []
+
+
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    timings = {}
+    faces = recognize_images([image], gallery, tolerance=0.6, pipeline=detector, timings=timings)[0]
+    print("Recognition timings (ms): " + ", ".join(f"{k}={v:.1f}" for k, v in timings.items()))
 
 
-def recognize_face(photo_path):
-    """Recognize the person in the given photo."""
-    if not Encodings or not Names:
-        return "Unknown (no training data available)"
+    # Every face is scored against the whole gallery at once; closest match wins
+    return best_name(faces), faces
 
 
-    image = face_recognition.load_image_file(photo_path)
-    face_positions = face_recognition.face_locations(image)
-    all_encodings = face_recognition.face_encodings(image, face_positions)
+def identify_active_person(image):
+    """Recognize the person in a frame, keep the frame and record the result. Returns the name."""
+    recognized_name, faces = recognize_face(image)
+    # Keep the frame for reference, one file per capture so every event can point at its frame;
+    # a capture without faces has no events, so nothing to keep
+    timestamp = time.time()
+    frame_path = None
+    if faces:
+        frame_path = os.path.join(ACTIVE_PERSON_FOLDER, f"active_{int(timestamp * 1000)}.jpg")
+        cv2.imwrite(frame_path, image)
+    if RECORD_ON_RECOGNITION and not recognized_name.startswith(UNKNOWN):
+        recorder.trigger(f"recognized {recognized_name}", RECORD_ON_RECOGNITION)
 
 
-    for face_encoding in all_encodings:
-        matches = face_recognition.compare_faces(Encodings, face_encoding, tolerance=0.6)
-        if True in matches:
-            first_match_index = matches.index(True)
-            return Names[first_match_index]
-    return "Unknown"
+    # One event per face found, queued for the background writer
+    events.record_faces(camera.name, faces, frame_path, timestamp)
+    return recognized_name
 
 
 # --------------------------------
@@ -137,28 +146,19 @@ def index():
 
 @app.route("/take-photos-stream", methods=["GET"])
 def take_photos_stream():
-    """Capture 5 photos and send instructions via SSE."""
+    """
+    Capture 5 photos and send instructions via SSE. Each photo is taken as
+    soon as a live frame passes the quality and pose checks for its prompt.
+    """
     name = request.args.get("name", "").strip()
-    if not name:
-        return Response("data: Error: Name is required!\n\n", mimetype="text/event-stream")
+    error = name_error(name)
+    if error:
+        return Response(f"data: Error: {error}\n\n", mimetype="text/event-stream")
 
 
     def generate_photos():
-        for i, direction in enumerate(DIRECTIONS):
-            yield f"data: Please face {direction}\n\n"
-            time.sleep(2)
-
-
-            # Capture photo
-            photo_path = os.path.join(PHOTO_FOLDER, f"{name}_{i + 1}.jpg")
-            if capture_photo(photo_path):
-                yield f"data: Captured photo {i + 1} ({direction})\n\n"
-            else:
-                yield f"data: Failed to capture photo {i + 1}\n\n"
-            time.sleep(1)
-
-
-        yield "data: Photo capture complete!\n\n"
+        for message in enroll(capture_frame, PHOTO_FOLDER, name, DIRECTIONS, publisher=publisher):
+            yield f"data: {message}\n\n"
 
 
     return Response(generate_photos(), mimetype="text/event-stream")
@@ -166,65 +166,126 @@ def take_photos_stream():
 
 @app.route("/capture-active-person", methods=["POST"])
 def capture_active_person():
-    """Capture a photo, recognize the person, and log the result."""
-    global recording, record_process
-    if recording or record_process:
-        return jsonify({"message": "Cannot capture photo while recording is in progress!"}), 400
-
-
-    # Delay to ensure the camera resource is free
-    time.sleep(7)
-
-
-    photo_path = os.path.join(ACTIVE_PERSON_FOLDER, "active.jpg")
-    if not capture_photo(photo_path):
+    """Capture a photo, recognize the person, and log the result (works while recording too)."""
+    # The frame comes straight from the live pipeline, no camera restart needed
+    image = capture_frame()
+    if image is None:
         return jsonify({"message": "Failed to capture active person photo!"}), 500
 
 
-    # Recognize the person in the photo
-    recognized_name = recognize_face(photo_path)
+    recognized_name = identify_active_person(image)
+    return jsonify({"message": f"Photo captured and recognized as: {recognized_name}"})
 
 
-    # Write the recognized name to the log file
-    with open(RECOGNITION_LOG, "w") as log_file:
-        log_file.write(f"Recognized Name: {recognized_name}\n")
-        log_file.write(f"Timestamp: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+@app.route("/recognize", methods=["POST"])
+def recognize():
+    """
+    Recognize every face in one or more uploaded images (any multipart file field).
+    Returns boxes, best identity, distance and runner-up for each face.
+    """
+    uploads = [upload for key in request.files for upload in request.files.getlist(key)]
+    if not uploads:
+        return jsonify({"message": "No images uploaded!"}), 400
+
+    gallery = live_gallery.get()
+    images = []
+    results = []
+    for upload in uploads:
+        result = {"filename": upload.filename, "faces": []}
+        try:
+            images.append((result, face_recognition.load_image_file(upload)))
+        except Exception as e:
+            result["error"] = f"Could not read image: {e}"
+        results.append(result)
+
+    # Detection and matching run over the whole request at once
+    timings = {}
+    faces = recognize_images([image for _, image in images], gallery, tolerance=0.6,
+                             pipeline=detector, timings=timings)
+    for (result, _), image_faces in zip(images, faces):
+        result["faces"] = image_faces
+
+    return jsonify({
+        "gallery_version": live_gallery.version,
+        "images": results,
+        "timings_ms": {stage: round(ms, 2) for stage, ms in timings.items()},
+    })
+
+
+@app.route("/recognitions")
+def recognitions():
+    """
+    Recognition events, newest first. Optional filters: start, end (epoch
+    seconds or ISO time), identity, camera and limit (default 1000, at most 10000).
+    """
+    try:
+        start, end = parse_time(request.args.get("start")), parse_time(request.args.get("end"))
+    except ValueError as e:
+        return jsonify({"message": f"Invalid time: {e}"}), 400
+    try:
+        limit = parse_limit(request.args.get("limit"))
+    except ValueError as e:
+        return jsonify({"message": f"Invalid limit: {e}"}), 400
+    return jsonify(events.query(start, end, request.args.get("identity"), request.args.get("camera"), limit))
 
 
-    return jsonify({"message": f"Photo captured and recognized as: {recognized_name}"})
+@app.route("/recognitions/seen")
+def recognitions_seen():
+    """Who was seen between start and end: sightings, first/last time and best distance per identity."""
+    try:
+        start, end = parse_time(request.args.get("start")), parse_time(request.args.get("end"))
+    except ValueError as e:
+        return jsonify({"message": f"Invalid time: {e}"}), 400
+    return jsonify(events.seen(start, end, request.args.get("camera")))
 
 
 @app.route("/start-record", methods=["POST"])
 def start_record():
-    """Start video recording."""
-    global recording
-    if recording:
+    """Start a recording session (with the last RECORD_PREROLL seconds before the request, if set)."""
+    if recorder.recording:
         return jsonify({"message": "Already recording!"})
-    recording = True
     duration = int(request.form.get("duration", 5))  # Default to 5 seconds
-    threading.Thread(target=record_video, args=(duration,)).start()
-    return jsonify({"message": f"Recording started for {duration} seconds!"})
+    session = recorder.trigger("api", duration)
+    return jsonify({"message": f"Recording started for {duration} seconds!", "session": session})
 
 
 @app.route("/stop-record", methods=["POST"])
 def stop_record():
     """Stop video recording."""
-    global recording, record_process
-    if not recording:
+    if not recorder.recording:
         return jsonify({"message": "No recording in progress!"})
-    if record_process:
-        record_process.terminate()
-        record_process = None
-    recording = False
+    recorder.stop()
     return jsonify({"message": "Recording stopped!"})
 
 
+@app.route("/record-status")
+def record_status():
+    """Pre-roll buffered, current session folder and segments written so far."""
+    return jsonify(recorder.status())
+
+
+@app.route("/admin/reload-gallery", methods=["POST"])
+def reload_gallery():
+    """Force a gallery reload and report its version and size."""
+    if not live_gallery.reload():
+        status = live_gallery.status()
+        return jsonify({"message": f"Gallery reload failed: {live_gallery.error}. "
+                                   f"Still serving version {status['version']}.", **status}), 500
+    return jsonify(live_gallery.status())
+
+
 @app.route("/photos/<filename>")
 def serve_photo(filename):
     """Serve a photo from the photos directory."""
     return send_from_directory(PHOTO_FOLDER, filename)
 
 
+@app.route("/metrics")
+def metrics():
+    """Runtime metrics (stage latencies, frames, clients, recognitions, gallery) for Prometheus."""
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
 
@@ -0,0 +1,265 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import cv2
+import numpy as np
+from detection import DETECTION_CONFIG, DetectionPipeline
+from gallery import PROTOTYPE_MARGIN, TOLERANCE, Gallery, load_gallery
+
+# Headless recognition benchmark: replays recorded videos through
+# decode -> detect -> encode -> match and writes machine-readable results.
+# Usage: python bench.py --videos "ateam/videos/*.mp4" --gallery ateam/train.gal --out bench.json
+
+DEFAULT_VIDEOS = ["ateam/videos/*.mp4", "zddotvid/videos/*.mp4"]
+DEFAULT_INFLATE = [1000, 10000, 50000]
+PERCENTILES = (50, 95, 99)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (ru_maxrss is in KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    if not samples:
+        return None
+    values = np.asarray(samples)
+    summary = {f"p{p}": round(float(np.percentile(values, p)), 3) for p in PERCENTILES}
+    summary["mean"] = round(float(values.mean()), 3)
+    summary["count"] = len(samples)
+    return summary
+
+
+def replay_frames(video_files, max_frames, stride):
+    """Yield (video, RGB frame, decode ms) from each video, one frame at a time."""
+    for video_file in video_files:
+        cap = cv2.VideoCapture(video_file)
+        if not cap.isOpened():
+            print(f"Warning: could not open {video_file}. Skipping.", file=sys.stderr)
+            continue
+        index = 0
+        emitted = 0
+        try:
+            while max_frames is None or emitted < max_frames:
+                start = time.perf_counter()
+                if not cap.grab():
+                    break
+                if index % stride:
+                    index += 1
+                    continue
+                ok, frame = cap.retrieve()
+                if not ok:
+                    break
+                rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                yield video_file, rgb, (time.perf_counter() - start) * 1000
+                index += 1
+                emitted += 1
+        finally:
+            cap.release()
+
+
+# --------------------------------
+# Pipeline Replay
+# --------------------------------
+def bench_pipeline(video_files, gallery, pipeline, max_frames, stride):
+    """
+    Run every replayed frame through the full pipeline and collect per-stage
+    latencies. Returns the report and the face encodings seen, which the
+    gallery scaling run reuses as realistic queries.
+    """
+    stages = {"decode": [], "resize": [], "detect": [], "encode": [], "match": [], "total": []}
+    encodings_seen = []
+    frames = faces = 0
+    started = time.perf_counter()
+
+    for _, frame, decode_ms in replay_frames(video_files, max_frames, stride):
+        timings = {}
+        locations = pipeline.detect([frame], timings)
+        encodings = pipeline.encode([frame], locations, timings)[0]
+        start = time.perf_counter()
+        gallery.match(encodings)
+        timings["match"] = (time.perf_counter() - start) * 1000
+        timings["decode"] = decode_ms
+
+        for stage, ms in timings.items():
+            stages[stage].append(ms)
+        stages["total"].append(sum(timings.values()))
+        encodings_seen.extend(encodings)
+        frames += 1
+        faces += len(encodings)
+
+    elapsed = time.perf_counter() - started
+    report = {
+        "frames": frames,
+        "faces": faces,
+        "seconds": round(elapsed, 3),
+        "fps": round(frames / elapsed, 2) if elapsed > 0 else None,
+        "stages_ms": {stage: summarize(samples) for stage, samples in stages.items()},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    return report, encodings_seen
+
+
+# --------------------------------
+# Gallery Scaling
+# --------------------------------
+def inflate_gallery(gallery, size, seed=0):
+    """
+    A gallery of `size` rows: the real rows plus synthetic ones, made by
+    perturbing real rows (or random vectors of similar norm when the real
+    gallery is empty) so distances stay in a realistic range.
+    """
+    rng = np.random.default_rng(seed)
+    extra = max(0, size - len(gallery))
+    if len(gallery):
+        base = gallery.encodings[rng.integers(0, len(gallery), extra)]
+        synthetic = base + rng.normal(scale=0.08, size=base.shape).astype(np.float32)
+    else:
+        synthetic = rng.normal(scale=0.09, size=(extra, gallery.dim)).astype(np.float32)
+    encodings = np.vstack([gallery.encodings, synthetic]) if len(gallery) else synthetic
+    names = gallery.names + [f"synthetic_{i // 5}" for i in range(extra)]
+    return Gallery(names, encodings)
+
+
+def bench_gallery_scaling(gallery, queries, sizes, repeats=200, seed=0):
+    """Match latency per face as the gallery grows."""
+    rng = np.random.default_rng(seed)
+    if not len(queries):
+        queries = rng.normal(scale=0.09, size=(16, gallery.dim)).astype(np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+
+    results = []
+    for size in sizes:
+        inflated = inflate_gallery(gallery, size, seed)
+        samples = []
+        for _ in range(repeats):
+            query = queries[rng.integers(0, len(queries))]
+            start = time.perf_counter()
+            inflated.match([query])
+            samples.append((time.perf_counter() - start) * 1000)
+        results.append({"gallery_size": len(inflated), "match_ms": summarize(samples),
+                        "peak_rss_mb": round(peak_rss_mb(), 1)})
+    return results
+
+
+def enrolled_gallery(gallery, identities, photos=5, seed=0):
+    """
+    A synthetic gallery of `identities` people with `photos` rows each,
+    spread around the person the way one enrollment session's photos are
+    (about 0.13 apart from their centroid), so prototypes have something to
+    collapse. Returns the gallery and each person's centre.
+    """
+    rng = np.random.default_rng(seed)
+    if len(gallery):
+        base = gallery.encodings[rng.integers(0, len(gallery), identities)]
+        centres = base + rng.normal(scale=0.08, size=base.shape).astype(np.float32)
+    else:
+        centres = rng.normal(scale=0.09, size=(identities, gallery.dim)).astype(np.float32)
+    rows = np.repeat(centres, photos, axis=0) + rng.normal(scale=0.012, size=(identities * photos, gallery.dim))
+    names = [f"person_{i // photos}" for i in range(identities * photos)]
+    return Gallery(names, rows.astype(np.float32)), centres
+
+
+def bench_prototypes(gallery, sizes, repeats=200, seed=0):
+    """
+    Match latency per face with and without prototypes on enrolled-looking
+    galleries, with the share of faces re-checked on every row and how often
+    the answer agrees with the exact scan. Half the queries are enrolled
+    people, half strangers.
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for size in sizes:
+        enrolled, centres = enrolled_gallery(gallery, max(1, size // 5), seed=seed)
+        known = centres[rng.integers(0, len(centres), repeats // 2)]
+        known = known + rng.normal(scale=0.03, size=known.shape)
+        # Strangers about 0.9 from the nearest enrolled person, like an unenrolled visitor
+        strangers = centres[rng.integers(0, len(centres), repeats - len(known))]
+        strangers = strangers + rng.normal(scale=0.08, size=strangers.shape)
+        queries = np.vstack([known, strangers]).astype(np.float32)
+
+        def run():
+            samples, names = [], []
+            for query in queries:
+                start = time.perf_counter()
+                names.append(enrolled.match([query], top_k=1)[0]["name"])
+                samples.append((time.perf_counter() - start) * 1000)
+            return samples, names
+
+        exact_ms, exact_names = run()
+        enrolled.build_prototypes()
+        prototype_ms, prototype_names = run()
+        nearest = enrolled.prototypes._match_rows(queries, TOLERANCE, 1)
+        rechecked = sum(abs(r["distance"] - TOLERANCE) <= PROTOTYPE_MARGIN for r in nearest)
+        results.append({
+            "gallery_size": len(enrolled),
+            "prototypes": len(enrolled.prototypes),
+            "exact_match_ms": summarize(exact_ms),
+            "prototype_match_ms": summarize(prototype_ms),
+            "rechecked_pct": round(rechecked / len(queries) * 100, 1),
+            "agreement_pct": round(sum(a == b for a, b in zip(exact_names, prototype_names)) / len(queries) * 100, 1),
+        })
+    return results
+
+
+def compare(baseline, current):
+    """p95 stage latencies of the current run against a saved baseline run."""
+    rows = []
+    for stage, summary in current["pipeline"]["stages_ms"].items():
+        before = (baseline["pipeline"]["stages_ms"].get(stage) or {}).get("p95")
+        if summary is None or not before:
+            continue
+        rows.append({"stage": stage, "baseline_p95": before, "p95": summary["p95"],
+                     "change_pct": round((summary["p95"] - before) / before * 100, 1)})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the recognition pipeline on recorded videos.")
+    parser.add_argument("--videos", nargs="+", default=DEFAULT_VIDEOS, help="video files or glob patterns")
+    parser.add_argument("--gallery", default="ateam/train.gal", help="train.gal (or legacy train.pkl)")
+    parser.add_argument("--config", default=DETECTION_CONFIG, help="detection settings JSON")
+    parser.add_argument("--frames", type=int, default=100, help="frames per video (default 100)")
+    parser.add_argument("--stride", type=int, default=1, help="use every Nth frame")
+    parser.add_argument("--inflate", default=",".join(map(str, DEFAULT_INFLATE)),
+                        help="comma-separated synthetic gallery sizes; empty to skip")
+    parser.add_argument("--out", default=None, help="write the JSON results here as well as stdout")
+    parser.add_argument("--baseline", default=None, help="earlier results JSON to compare p95 latencies against")
+    args = parser.parse_args()
+
+    video_files = sorted({path for pattern in args.videos for path in glob.glob(pattern)})
+    gallery_file = args.gallery
+    if gallery_file.endswith(".pkl"):
+        gallery = Gallery.from_pickle(gallery_file)
+    else:
+        gallery = load_gallery(gallery_file, os.path.splitext(gallery_file)[0] + ".pkl")
+    pipeline = DetectionPipeline.from_config(args.config)
+
+    pipeline_report, encodings_seen = bench_pipeline(video_files, gallery, pipeline, args.frames, args.stride)
+    sizes = [int(size) for size in args.inflate.split(",") if size]
+    results = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": {"machine": platform.machine(), "python": platform.python_version(),
+                 "opencv": cv2.__version__, "cpus": os.cpu_count()},
+        "videos": video_files,
+        "gallery": {"file": gallery_file, "size": len(gallery)},
+        "detection": pipeline.settings(),
+        "pipeline": pipeline_report,
+        "gallery_scaling": bench_gallery_scaling(gallery, encodings_seen, sizes),
+        "prototypes": bench_prototypes(gallery, sizes),
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["comparison"] = compare(json.load(f), results)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
@@ -0,0 +1,320 @@
+import collections
+import threading
+import time
+import cv2
+from metrics import FRAMES_DROPPED
+from streaming import JPEG_SECONDS, VariantCache, adaptive_mjpeg
+
+# Frames each viewer may fall behind before its oldest frame is dropped
+SUBSCRIBER_QUEUE = 2
+# Consecutive failed reads before the device is considered gone
+MAX_READ_FAILURES = 30
+# Raw frames the recording branch may buffer before it starts dropping (~44 MB at 720p)
+RECORD_QUEUE = 16
+
+# One captured frame as handed to every subscriber. `seq` goes up by one
+# per frame this camera delivers (also across reopens) and `timestamp` is
+# the source's capture time. `image` is the BGR frame, a read-only view of
+# the source's buffer shared by every subscriber (copy it to draw on it),
+# and `jpeg` its encoding, done once in the capture thread no matter how
+# many viewers there are.
+Frame = collections.namedtuple("Frame", ["seq", "timestamp", "image", "jpeg"])
+
+
+# --------------------------------
+# Subscriber Queue
+# --------------------------------
+class Subscription:
+    """
+    Bounded frame queue for one consumer. When the consumer falls behind,
+    the oldest frame is dropped so the capture thread never blocks.
+    """
+
+    def __init__(self, max_queue=SUBSCRIBER_QUEUE):
+        self.frames = collections.deque(maxlen=max_queue)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, frame):
+        with self.cond:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+                FRAMES_DROPPED.inc()
+            self.frames.append(frame)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Next frame, or None once the camera has closed (or on timeout)."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames or self.closed, timeout)
+            if self.frames:
+                return self.frames.popleft()
+            return None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __iter__(self):
+        """Iterate over the frames until the subscription is closed."""
+        while True:
+            frame = self.get()
+            if frame is None:
+                return
+            yield frame
+
+
+# --------------------------------
+# Shared Camera
+# --------------------------------
+class CameraBroadcaster:
+    """
+    A single capture thread per camera that reads each frame once and
+    hands it to any number of subscribers.
+
+    The device is opened when the first subscriber arrives and released
+    as soon as the last one leaves, so an idle server does not hold the
+    camera. `open_source` is called each time to open the device and
+    must return a FrameSource (see sources.camera_source).
+    """
+
+    def __init__(self, open_source, name="camera", jpeg_quality=None):
+        self.open_source = open_source
+        self.name = name
+        self.jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if jpeg_quality else []
+        self.frames_captured = 0
+        self.variants = VariantCache()
+        # Kept across reopens so a restarted capture never reuses the sequence
+        # numbers the variant cache (and slow clients) still hold
+        self._seq = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, max_queue=SUBSCRIBER_QUEUE):
+        subscription = Subscription(max_queue)
+        with self._lock:
+            self._subscribers.add(subscription)
+            if self._thread is None:
+                self._start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+        subscription.close()
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    def _start(self):
+        # Called with self._lock held
+        self._thread = threading.Thread(target=self._run, name=f"{self.name}-capture", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        source = self.open_source()
+        opened = source.open()
+        if not opened:
+            print(f"Error: Could not open video device for {self.name}.")
+        failures = 0
+        try:
+            while opened:
+                with self._lock:
+                    subscribers = list(self._subscribers)
+                if not subscribers:
+                    break
+                captured = source.read()
+                if captured is None:
+                    failures += 1
+                    if failures >= MAX_READ_FAILURES:
+                        print(f"Error: {self.name} stopped delivering frames.")
+                        opened = False
+                    time.sleep(0.01)
+                    continue
+                failures = 0
+                start = time.perf_counter()
+                ok, buffer = cv2.imencode('.jpg', captured.image, self.jpeg_params)
+                JPEG_SECONDS.observe_since(start)
+                if not ok:
+                    continue
+                self._seq += 1
+                self.frames_captured += 1
+                frame = Frame(self._seq, captured.timestamp, captured.image, buffer.tobytes())
+                for subscription in subscribers:
+                    subscription.put(frame)
+        finally:
+            source.close()
+            with self._lock:
+                self._thread = None
+                if not opened:
+                    # The device is gone: end every stream instead of hanging it
+                    for subscription in self._subscribers:
+                        subscription.close()
+                    self._subscribers.clear()
+                elif self._subscribers:
+                    # Someone subscribed while we were shutting down
+                    self._start()
+
+    def mjpeg_stream(self, max_queue=SUBSCRIBER_QUEUE, caps=None):
+        """
+        Generator for a multipart MJPEG response; unsubscribes when the client leaves.
+        Quality, size and frame rate adapt to the client within `caps` (a StreamCaps).
+        """
+        subscription = self.subscribe(max_queue)
+        try:
+            yield from adaptive_mjpeg(subscription, self.variants, caps, lambda: subscription.dropped)
+        finally:
+            self.unsubscribe(subscription)
+
+
+# --------------------------------
+# Latest-Frame Slot
+# --------------------------------
+class FrameSlot:
+    """
+    Holds only the newest frame from a capture thread, already JPEG-encoded,
+    with a sequence number that increases by one per frame.
+
+    The capture thread publishes each frame exactly once; readers block on
+    the condition until a frame newer than the one they last saw exists,
+    so no reader ever encodes or copies on its own or spins while idle.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.frame = None
+        self._seq = 0
+
+    def publish(self, image, jpeg, timestamp=None):
+        with self.cond:
+            self._seq += 1
+            self.frame = Frame(self._seq, timestamp or time.time(), image, jpeg)
+            self.cond.notify_all()
+        return self.frame
+
+    def latest(self):
+        """The newest frame, or None before the first one arrives."""
+        return self.frame
+
+    def wait_newer(self, seq, timeout=None):
+        """Block until a frame with a sequence number above `seq` exists; None on timeout."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.frame is not None and self.frame.seq > seq, timeout):
+                return None
+            return self.frame
+
+    def frames(self, alive=None):
+        """
+        Iterate over new frames as they are published, skipping any that were
+        replaced before the reader got to them. Stops once `alive()` is false.
+        """
+        latest = self.frame
+        seq = latest.seq if latest else 0
+        while True:
+            frame = self.wait_newer(seq, timeout=1.0)
+            if frame is None:
+                if alive is not None and not alive():
+                    return
+                continue
+            seq = frame.seq
+            yield frame
+
+
+# --------------------------------
+# Long-Lived Capture
+# --------------------------------
+class LiveCamera:
+    """
+    A capture pipeline owned by the server for its whole lifetime.
+
+    A background thread keeps reading frames into a FrameSlot, so stills,
+    enrollment photos and recognition all take frames from memory without
+    bringing the camera up and down. If the device stops delivering frames
+    the pipeline is reopened.
+
+    Every frame is also teed to subscribers such as a ContinuousRecorder
+    (recording.py), each with its own bounded, leaky queue, so recording,
+    preview and recognition all run off one sensor read.
+    """
+
+    def __init__(self, open_source, name="camera", reopen_delay=2.0):
+        self.open_source = open_source
+        self.name = name
+        self.reopen_delay = reopen_delay
+        self.slot = FrameSlot()
+        self._running = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self, max_queue=SUBSCRIBER_QUEUE):
+        subscription = Subscription(max_queue)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+        subscription.close()
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return self
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-capture", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop capturing and release the device (waits for the capture thread)."""
+        with self._lock:
+            self._running = False
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    @property
+    def running(self):
+        return self._running
+
+    def _run(self):
+        while self._running:
+            source = self.open_source()
+            if not source.open():
+                print(f"Error: Could not open capture pipeline for {self.name}. Retrying.")
+                time.sleep(self.reopen_delay)
+                continue
+            failures = 0
+            try:
+                while self._running and failures < MAX_READ_FAILURES:
+                    captured = source.read()
+                    if captured is None:
+                        failures += 1
+                        time.sleep(0.01)
+                        continue
+                    failures = 0
+                    frame = self.slot.publish(captured.image, None, captured.timestamp)
+                    with self._lock:
+                        subscribers = list(self._subscribers)
+                    for subscription in subscribers:
+                        subscription.put(frame)
+            finally:
+                source.close()
+            if self._running:
+                print(f"Warning: {self.name} stopped delivering frames. Reopening.")
+                time.sleep(self.reopen_delay)
+
+    def grab(self, timeout=2.0):
+        """
+        The first frame captured after this call (never an older buffered one),
+        or None if the camera delivers nothing within `timeout` seconds.
+        """
+        current = self.slot.latest()
+        return self.slot.wait_newer(current.seq if current else 0, timeout)
@@ -0,0 +1,24 @@
+import os
+import sys
+from gallery import Gallery, save_gallery, open_gallery
+
+# One-shot migration: train.pkl (two pickles: names, encodings) -> train.gal
+# Usage: python convert_pkl.py path/to/train.pkl [path/to/train.gal]
+if len(sys.argv) not in (2, 3):
+    print("Usage: python convert_pkl.py <train.pkl> [<train.gal>]")
+    sys.exit(1)
+
+pkl_file = sys.argv[1]
+gallery_file = sys.argv[2] if len(sys.argv) == 3 else os.path.splitext(pkl_file)[0] + ".gal"
+
+gallery = Gallery.from_pickle(pkl_file)
+save_gallery(gallery, gallery_file)
+
+# Read the new file back and make sure nothing was lost on the way
+converted = open_gallery(gallery_file)
+if converted.names != gallery.names or not (converted.encodings == gallery.encodings).all():
+    print(f"Error: {gallery_file} does not match {pkl_file}")
+    sys.exit(1)
+
+print(f"Converted {len(gallery)} encodings ({len(gallery.identities)} people) "
+      f"from {pkl_file} to {gallery_file}")
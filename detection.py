@@ -0,0 +1,137 @@
+import json
+import os
+import time
+import cv2
+import numpy as np
+import face_recognition
+from metrics import STAGE_SECONDS
+
+# Per-deployment settings live in this file next to the app (same folder as train.gal)
+DETECTION_CONFIG = "detection.json"
+
+DEFAULTS = {
+    # Detection runs on a copy scaled by this factor; boxes are mapped back
+    # to full resolution for encoding. 0.5 turns a 1280x720 frame into 640x360:
+    # much faster, but small and distant faces are missed.
+    "scale": 1.0,
+    # "hog" (CPU) or "cnn" (much slower without a GPU, better recall)
+    "model": "hog",
+    # How many times dlib upsamples the (scaled) image to find small faces
+    "upsample": 1,
+    # Only look inside this [x, y, width, height] region of the frame, or null
+    "roi": None,
+    # Drop faces narrower than this many full-resolution pixels
+    "min_face": 0,
+}
+
+DETECT_SECONDS = STAGE_SECONDS.labels("detect")
+ENCODE_SECONDS = STAGE_SECONDS.labels("encode")
+
+
+def _ms_since(start):
+    return (time.perf_counter() - start) * 1000
+
+
+# --------------------------------
+# Detection Pipeline
+# --------------------------------
+class DetectionPipeline:
+    """
+    Face detection stage: crop to the region of interest, downscale,
+    detect, map the boxes back to full resolution and drop faces that are
+    too small. Encoding always uses the full-resolution image.
+
+    Every call records how long each stage took, in milliseconds, into
+    the `timings` dict passed in, so settings can be tuned per machine;
+    detection and encoding are also observed in the /metrics histograms.
+    """
+
+    def __init__(self, scale=DEFAULTS["scale"], model=DEFAULTS["model"], upsample=DEFAULTS["upsample"],
+                 roi=DEFAULTS["roi"], min_face=DEFAULTS["min_face"]):
+        if model not in ("hog", "cnn"):
+            raise ValueError(f"Unknown face detection model: {model}")
+        if not 0 < scale <= 1:
+            raise ValueError(f"Detection scale must be in (0, 1], got {scale}")
+        if roi and (len(roi) != 4 or roi[0] < 0 or roi[1] < 0 or roi[2] <= 0 or roi[3] <= 0):
+            raise ValueError(f"Detection roi must be [x, y, width, height] with x, y >= 0 and a positive size, "
+                             f"got {roi}")
+        self.scale = scale
+        self.model = model
+        self.upsample = upsample
+        self.roi = tuple(roi) if roi else None
+        self.min_face = min_face
+
+    @classmethod
+    def from_config(cls, config_file=DETECTION_CONFIG):
+        """Build the pipeline from a JSON config file; missing keys use DEFAULTS."""
+        settings = dict(DEFAULTS)
+        if os.path.exists(config_file):
+            with open(config_file) as f:
+                settings.update(json.load(f))
+        return cls(**settings)
+
+    def settings(self):
+        return {"scale": self.scale, "model": self.model, "upsample": self.upsample,
+                "roi": list(self.roi) if self.roi else None, "min_face": self.min_face}
+
+    def _prepare(self, image):
+        """
+        Crop to the ROI and downscale. Returns the image to detect on (None if
+        the ROI lies outside this frame) and the ROI offset.
+        """
+        x, y = 0, 0
+        if self.roi:
+            x, y, w, h = (int(v) for v in self.roi)
+            image = image[y:y + h, x:x + w]
+            if not image.size:
+                return None, (x, y)
+        if self.scale != 1:
+            image = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        # dlib wants a contiguous buffer; an unscaled ROI crop is only a view
+        return np.ascontiguousarray(image), (x, y)
+
+    def _to_full_resolution(self, boxes, offset, shape):
+        """Map (top, right, bottom, left) boxes from the detection image back to the frame."""
+        x, y = offset
+        height, width = shape[:2]
+        mapped = []
+        for top, right, bottom, left in boxes:
+            top = max(0, int(round(top / self.scale)) + y)
+            right = min(width, int(round(right / self.scale)) + x)
+            bottom = min(height, int(round(bottom / self.scale)) + y)
+            left = max(0, int(round(left / self.scale)) + x)
+            if right - left >= self.min_face:
+                mapped.append((top, right, bottom, left))
+        return mapped
+
+    def detect(self, images, timings=None):
+        """Face boxes, in full-resolution (top, right, bottom, left) form, for each RGB image."""
+        timings = timings if timings is not None else {}
+
+        start = time.perf_counter()
+        prepared = [self._prepare(image) for image in images]
+        timings["resize"] = timings.get("resize", 0.0) + _ms_since(start)
+
+        start = time.perf_counter()
+        small = [image for image, _ in prepared]
+        if self.model == "cnn" and len(small) > 1 and all(image is not None for image in small) \
+                and len({image.shape for image in small}) == 1:
+            # The CNN detector can push same-sized images through dlib in one batch
+            locations = face_recognition.batch_face_locations(small, number_of_times_to_upsample=self.upsample)
+        else:
+            locations = [face_recognition.face_locations(image, self.upsample, self.model) if image is not None
+                         else [] for image in small]
+        timings["detect"] = timings.get("detect", 0.0) + _ms_since(start)
+        DETECT_SECONDS.observe_since(start)
+
+        return [self._to_full_resolution(boxes, offset, image.shape)
+                for boxes, (_, offset), image in zip(locations, prepared, images)]
+
+    def encode(self, images, locations, timings=None):
+        """128-d encodings for the given boxes, computed on the full-resolution images."""
+        timings = timings if timings is not None else {}
+        start = time.perf_counter()
+        encodings = [face_recognition.face_encodings(image, boxes) for image, boxes in zip(images, locations)]
+        timings["encode"] = timings.get("encode", 0.0) + _ms_since(start)
+        ENCODE_SECONDS.observe_since(start)
+        return encodings
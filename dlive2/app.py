@@ -1,41 +1,52 @@
-from flask import Flask, Response, render_template
-import cv2
+from flask import Flask, Response, render_template, request
+import os
+import sys
+
+# Shared modules (camera.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera import CameraBroadcaster
+from detection import DetectionPipeline
+from gallery import LiveGallery
+from overlay import RecognitionOverlay
+from sources import camera_source
+from metrics import CONTENT_TYPE, render_metrics
+from streaming import stream_caps
 
 app = Flask(__name__)
 
-def generate_frames():
-    """Generate frames from GStreamer pipeline."""
-    # Define the GStreamer pipeline
-    gst_pipeline = (
-        "nvarguscamerasrc ! "
-        "video/x-raw(memory:NVMM),width=1280,height=720,framerate=60/1 ! "
-        "nvvidconv ! video/x-raw,format=(string)BGRx ! "
-        "videoconvert ! video/x-raw,format=(string)BGR ! appsink"
-    )
-
-    # Open the camera feed
-    cap = cv2.VideoCapture(gst_pipeline, cv2.CAP_GSTREAMER)
-    if not cap.isOpened():
-        raise RuntimeError("Error: Unable to access the camera with GStreamer pipeline.")
-
-    # Read frames in a loop
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        # Encode the frame as JPEG
-        _, buffer = cv2.imencode('.jpg', frame)
-        frame = buffer.tobytes()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-
-    cap.release()
+# Define the GStreamer pipeline (an appsink is added by the source;
+# set CAMERA_SOURCE to replay recordings instead)
+CAMERA_SOURCE = (
+    "gst:nvarguscamerasrc ! "
+    "video/x-raw(memory:NVMM),width=1280,height=720,framerate=60/1 ! "
+    "nvvidconv ! video/x-raw,format=(string)BGRx ! "
+    "videoconvert ! video/x-raw,format=(string)BGR"
+)
+
+# One GStreamer capture shared by every viewer; opened for the first viewer
+# and released when the last one disconnects
+camera = CameraBroadcaster(camera_source(CAMERA_SOURCE), name="dlive2")
+
+# Known faces (train.gal in this folder, reloaded after retraining) and the
+# annotated stream built on the shared capture
+live_gallery = LiveGallery("train.gal", "train.pkl").watch()
+recognized = RecognitionOverlay(camera, live_gallery, DetectionPipeline.from_config("detection.json"))
+
+
+def generate_frames(caps=None):
+    """Generate frames from the shared GStreamer capture, adapted to the client's link."""
+    return camera.mjpeg_stream(caps=caps)
 
 @app.route('/video-feed')
 def video_feed():
-    """Video streaming route."""
-    return Response(generate_frames(),
+    """Video streaming route (optional ?width=&fps=&quality= caps)."""
+    return Response(generate_frames(stream_caps(request.args)),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/recognized_feed')
+def recognized_feed():
+    """Video stream with recognized faces boxed and named."""
+    return Response(recognized.mjpeg_stream(stream_caps(request.args)),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/')
@@ -43,6 +54,11 @@ def index():
     """Render the main webpage."""
     return render_template('index.html')
 
+@app.route('/metrics')
+def metrics():
+    """Runtime metrics (stage latencies, frames, clients, recognitions, gallery) for Prometheus."""
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
 
@@ -0,0 +1,26 @@
+import os
+import sys
+
+# Shared modules (async_serving.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as server
+from async_serving import AsyncApp, AsyncFrameFeed, adaptive_mjpeg_async, mjpeg_response
+from streaming import stream_caps
+
+# ASGI serving mode: uvicorn asgi:app --host 0.0.0.0 --port 5000
+# Each stream is a coroutine fed from one pump thread per source, so a
+# viewer costs no server thread; other routes are served by the Flask app.
+app = AsyncApp(fallback=server.app)
+camera_feed = AsyncFrameFeed.for_camera(server.camera)
+recognized_feed = AsyncFrameFeed(server.recognized.open)
+
+
+@app.route("/video-feed")
+async def video_feed(request):
+    return mjpeg_response(adaptive_mjpeg_async(camera_feed, server.camera.variants, stream_caps(request.args)))
+
+
+@app.route("/recognized_feed")
+async def recognized_feed_route(request):
+    return mjpeg_response(adaptive_mjpeg_async(recognized_feed, server.recognized.variants,
+                                               stream_caps(request.args)))
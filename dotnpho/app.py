@@ -3,6 +3,15 @@ from flask import Flask, render_template, Response, request, jsonify, send_from_
 import threading
 import time
 import os
+import sys
+
+# Shared modules (camera.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera import FrameSlot
+from streaming import JPEG_SECONDS, VariantCache, adaptive_mjpeg, stream_caps
+from enrollment import GalleryPublisher, enroll, name_error
+from sources import camera_source
+from metrics import CONTENT_TYPE, render_metrics
 
 app = Flask(__name__)
 
@@ -10,6 +19,11 @@ app = Flask(__name__)
 PHOTO_FOLDER = './photos'
 os.makedirs(PHOTO_FOLDER, exist_ok=True)
 
+# Finished enrollments are added to train.gal in the background; servers
+# that watch it (LiveGallery) pick each one up on their next poll
+GALLERY_FILE = 'train.gal'
+publisher = GalleryPublisher(PHOTO_FOLDER, GALLERY_FILE)
+
 # Directions for the user to face
 DIRECTIONS = [
     "Center",
@@ -20,34 +34,48 @@ DIRECTIONS = [
 ]
 
 # Global variables for shared camera access
-cap = None           # The VideoCapture instance
-outputFrame = None   # The latest frame read from the camera
-lock = threading.Lock()
+open_source = camera_source("v4l2:2")  # /dev/video2 (adjust if necessary), or $CAMERA_SOURCE
+source = None        # The open FrameSource
+frame_slot = FrameSlot()  # The latest frame read from the camera, JPEG-encoded once, with a sequence number
+variants = VariantCache()  # Smaller/lower-quality encodings of it, shared by clients on the same tier
 bg_thread_started = False
 
 def init_camera():
     """Lazily initialize the camera if it hasn't been opened yet."""
-    global cap
-    if cap is None:
-        # Try using device index 1 (adjust if necessary)
-        cap = cv2.VideoCapture(2)
-        if not cap.isOpened():
+    global source
+    if source is None:
+        source = open_source()
+        if not source.open():
+            source = None
             print("Error: Could not open video device. Try a different index or close other apps using the camera.")
             return False
     return True
 
 def update_frame():
-    """Background thread that continuously captures frames from the camera."""
-    global outputFrame, cap
+    """
+    Background thread that continuously captures frames from the camera.
+    Each frame is JPEG-encoded here, once, and published for every client.
+    """
     if not init_camera():
         return
     while True:
-        ret, frame = cap.read()
+        # source.read() blocks until the camera delivers the next frame
+        frame = source.read()
+        if frame is None:
+            time.sleep(0.01)
+            continue
+        start = time.perf_counter()
+        ret, buffer = cv2.imencode('.jpg', frame.image)
+        JPEG_SECONDS.observe_since(start)
         if not ret:
             continue
-        with lock:
-            outputFrame = frame.copy()
-        time.sleep(0.03)  # Aim for roughly 30 fps
+        frame_slot.publish(frame.image, buffer.tobytes(), frame.timestamp)
+
+def capture_frame(timeout=2.0):
+    """The next frame (BGR) the background thread publishes, or None if none arrives in time."""
+    current = frame_slot.latest()
+    frame = frame_slot.wait_newer(current.seq if current else 0, timeout)
+    return frame.image if frame is not None else None
 
 def start_background_thread():
     """Start the background thread once if not already started."""
@@ -61,58 +89,43 @@ def index():
     """Serve the main HTML page."""
     return render_template('index.html')
 
-def gen_frames():
-    """Generator that yields the live feed frames as JPEG-encoded data."""
+def gen_frames(caps=None):
+    """
+    Generator that yields the live feed frames as JPEG-encoded data.
+    Sleeps until the capture thread publishes a frame newer than the last one sent;
+    size, quality and frame rate adapt to how fast the client keeps up.
+    """
     if not init_camera():
         yield b""
         return
     start_background_thread()
-    while True:
-        with lock:
-            if outputFrame is None:
-                continue
-            ret, buffer = cv2.imencode('.jpg', outputFrame)
-            if not ret:
-                continue
-            frame = buffer.tobytes()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+    yield from adaptive_mjpeg(frame_slot.frames(), variants, caps)
 
 @app.route('/video_feed')
 def video_feed():
-    """Return the live feed stream."""
+    """Return the live feed stream (optional ?width=&fps=&quality= caps)."""
     start_background_thread()
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(gen_frames(stream_caps(request.args)), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/take-photos-stream', methods=['GET'])
 def take_photos_stream():
     """
-    SSE endpoint that instructs the user to face various directions,
-    waits a few seconds for each, then captures a photo from the shared frame.
-    Photos are saved as <name>_1.jpg, <name>_2.jpg, etc.
+    SSE endpoint that instructs the user to face various directions and
+    captures each photo as soon as a shared frame passes the quality and
+    pose checks for it. Photos are saved as <name>_1.jpg, <name>_2.jpg, etc.
     """
     name = request.args.get('name', 'photo').strip()
-    if not name:
-        return Response("data: Error: Name is required!\n\n", mimetype="text/event-stream")
+    error = name_error(name)
+    if error:
+        return Response(f"data: Error: {error}\n\n", mimetype="text/event-stream")
     
     if not init_camera():
         return Response("data: Error: Could not open camera\n\n", mimetype="text/event-stream")
     start_background_thread()
     
     def generate():
-        for i, direction in enumerate(DIRECTIONS):
-            yield f"data: Please face {direction}\n\n"
-            time.sleep(2)  # Allow time for the user to adjust
-            photo_filename = f"{name}_{i+1}.jpg"
-            filepath = os.path.join(PHOTO_FOLDER, photo_filename)
-            with lock:
-                if outputFrame is None:
-                    yield f"data: Failed to capture photo {i+1} (no frame available)\n\n"
-                    continue
-                cv2.imwrite(filepath, outputFrame)
-            yield f"data: Captured photo {i+1} ({direction}) as {photo_filename}\n\n"
-            time.sleep(1)  # Short pause before next instruction
-        yield "data: Photo capture complete!\n\n"
+        for message in enroll(capture_frame, PHOTO_FOLDER, name, DIRECTIONS, publisher=publisher):
+            yield f"data: {message}\n\n"
     
     return Response(generate(), mimetype="text/event-stream")
 
@@ -121,6 +134,11 @@ def serve_photo(filename):
     """Serve a photo from the photos folder."""
     return send_from_directory(PHOTO_FOLDER, filename)
 
+@app.route('/metrics')
+def metrics():
+    """Runtime metrics (stage latencies, frames, clients, recognitions, gallery) for Prometheus."""
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
 
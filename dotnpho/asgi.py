@@ -0,0 +1,46 @@
+import os
+import sys
+
+# Shared modules (async_serving.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as server
+from async_serving import (AsyncApp, AsyncFrameFeed, JSONResponse, adaptive_mjpeg_async, event_stream,
+                           mjpeg_response, run_blocking, single_event, sse)
+from enrollment import enroll_async, name_error
+from streaming import stream_caps
+
+# ASGI serving mode: uvicorn asgi:app --host 0.0.0.0 --port 5000
+# The live feed and enrollment run as coroutines; other routes are served by the Flask app.
+app = AsyncApp(fallback=server.app)
+feed = AsyncFrameFeed.for_slot(server.frame_slot)
+
+
+@app.route("/video_feed")
+async def video_feed(request):
+    """Return the live feed stream (optional ?width=&fps=&quality= caps)."""
+    if not await run_blocking(server.init_camera):
+        return JSONResponse({"message": "Could not open camera"}, 503)
+    server.start_background_thread()
+    return mjpeg_response(adaptive_mjpeg_async(feed, server.variants, stream_caps(request.args)))
+
+
+@app.route("/take-photos-stream")
+async def take_photos_stream(request):
+    """
+    SSE endpoint that instructs the user to face various directions and
+    captures each photo once a shared frame passes the quality and pose checks.
+    """
+    name = request.args.get('name', 'photo').strip()
+    error = name_error(name)
+    if error:
+        return event_stream(single_event(f"Error: {error}"))
+    if not await run_blocking(server.init_camera):
+        return event_stream(single_event("Error: Could not open camera"))
+    server.start_background_thread()
+
+    async def generate():
+        async for message in enroll_async(server.capture_frame, server.PHOTO_FOLDER, name, server.DIRECTIONS,
+                                          publisher=server.publisher):
+            yield sse(message)
+
+    return event_stream(generate())
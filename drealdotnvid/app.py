@@ -1,8 +1,14 @@
 from flask import Flask, render_template, Response, request, jsonify, send_from_directory
 import os
-import subprocess
-import threading
-import time
+import sys
+
+# Shared modules (camera.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera import LiveCamera
+from recording import ContinuousRecorder
+from sources import camera_source
+from metrics import CONTENT_TYPE, render_metrics
+from enrollment import GalleryPublisher, enroll, name_error
 
 app = Flask(__name__)
 
@@ -11,9 +17,15 @@ app = Flask(__name__)
 # --------------------------------
 PHOTO_FOLDER = "./photos"
 VIDEO_FOLDER = "./videos"
+RECORD_PREROLL = 0  # Seconds kept in memory and prepended to each recording (0 = off; JPEG-encodes every frame)
 os.makedirs(PHOTO_FOLDER, exist_ok=True)
 os.makedirs(VIDEO_FOLDER, exist_ok=True)
 
+# Finished enrollments are added to train.gal in the background; servers
+# that watch it (LiveGallery) pick each one up on their next poll
+GALLERY_FILE = "train.gal"
+publisher = GalleryPublisher(PHOTO_FOLDER, GALLERY_FILE)
+
 DIRECTIONS = [
     "Center",
     "Slightly Left",
@@ -22,48 +34,47 @@ DIRECTIONS = [
     "Slightly Down"
 ]
 
-recording = False
-record_process = None
+# One long-lived GStreamer pipeline owned by the server
+# (set CAMERA_SOURCE, e.g. "file:videos", to replay recordings instead)
+CAMERA_SOURCE = (
+    "gst:nvarguscamerasrc ! "
+    "video/x-raw(memory:NVMM),width=1280,height=720,framerate=60/1 ! "
+    "nvvidconv ! video/x-raw,format=BGRx ! "
+    "videoconvert ! video/x-raw,format=BGR"
+)
+camera = LiveCamera(camera_source(CAMERA_SOURCE), name="drealdotnvid").start()
+
+# Recording branch: once triggered, writes fixed-length segments + index.m3u8,
+# starting with the last RECORD_PREROLL seconds if that is set
+recorder = ContinuousRecorder(camera, VIDEO_FOLDER, fps=60, frame_size=(1280, 720),
+                              preroll_seconds=RECORD_PREROLL).start()
 
 
 # --------------------------------
 # Photo Capture Functionality
 # --------------------------------
-def capture_photo(photo_path):
-    """Capture a single photo using GStreamer."""
-    gst_command = (
-        f"gst-launch-1.0 nvarguscamerasrc num-buffers=1 ! "
-        f"'video/x-raw(memory:NVMM),width=1280,height=720,framerate=60/1' ! "
-        f"nvvidconv ! videoconvert ! jpegenc ! filesink location={photo_path}"
-    )
-    process = subprocess.run(gst_command, shell=True, stderr=subprocess.PIPE)
-    if process.returncode != 0:
-        print(f"Error capturing photo: {process.stderr.decode()}")
-        return False
-    return True
+def capture_frame():
+    """Take the next frame (BGR) from the live pipeline, or None if the camera is unavailable."""
+    frame = camera.grab()
+    if frame is None:
+        print("Error capturing photo: no frame from the camera")
+        return None
+    return frame.image
 
 @app.route("/take-photos-stream", methods=["GET"])
 def take_photos_stream():
-    """Capture 5 photos and send instructions via SSE."""
+    """
+    Capture 5 photos and send instructions via SSE. Each photo is taken as
+    soon as a live frame passes the quality and pose checks for its prompt.
+    """
     name = request.args.get("name", "").strip()
-    if not name:
-        return Response("data: Error: Name is required!\n\n", mimetype="text/event-stream")
+    error = name_error(name)
+    if error:
+        return Response(f"data: Error: {error}\n\n", mimetype="text/event-stream")
 
     def generate_photos():
-        for i, direction in enumerate(DIRECTIONS):
-            yield f"data: Please face {direction}\n\n"
-            time.sleep(2)
-
-            # Capture photo
-            photo_path = os.path.join(PHOTO_FOLDER, f"{name}_{i + 1}.jpg")
-            if capture_photo(photo_path):
-                yield f"data: Captured photo {i + 1} ({direction})\n\n"
-            else:
-                yield f"data: Failed to capture photo {i + 1}\n\n"
-
-            time.sleep(1)
-
-        yield "data: Photo capture complete!\n\n"
+        for message in enroll(capture_frame, PHOTO_FOLDER, name, DIRECTIONS, publisher=publisher):
+            yield f"data: {message}\n\n"
 
     return Response(generate_photos(), mimetype="text/event-stream")
 
@@ -76,65 +87,31 @@ def serve_photo(filename):
 # --------------------------------
 # Video Recording Functionality
 # --------------------------------
-def record_video(duration):
-    """Record video using GStreamer and save it to a file."""
-    global record_process
-    timestamp = time.strftime("%Y%m%d-%H%M%S")
-    video_path = os.path.join(VIDEO_FOLDER, f"video_{timestamp}.mp4")
-
-    gst_command = [
-        "gst-launch-1.0",
-        "nvarguscamerasrc",
-        f"num-buffers={duration * 60}",
-        "!",
-        "'video/x-raw(memory:NVMM),width=1280,height=720,framerate=60/1'",
-        "!",
-        "nvvidconv",
-        "!",
-        "videoconvert",
-        "!",
-        "x264enc",
-        "tune=zerolatency",
-        "bitrate=500",
-        "speed-preset=ultrafast",
-        "!",
-        "mp4mux",
-        "!",
-        f"filesink location={video_path}"
-    ]
-
-    try:
-        record_process = subprocess.Popen(" ".join(gst_command), shell=True)
-        record_process.wait(timeout=duration)
-    except subprocess.TimeoutExpired:
-        record_process.terminate()
-    finally:
-        record_process = None
-
 @app.route("/start-record", methods=["POST"])
 def start_record():
-    """Start video recording."""
-    global recording
-    if recording:
+    """Start a recording session (with the last RECORD_PREROLL seconds before the request, if set)."""
+    if recorder.recording:
         return jsonify({"message": "Already recording!"})
-    recording = True
     duration = int(request.form.get("duration", 5))  # Default to 5 seconds
-    threading.Thread(target=record_video, args=(duration,)).start()
-    return jsonify({"message": f"Recording started for {duration} seconds!"})
+    session = recorder.trigger("api", duration)
+    return jsonify({"message": f"Recording started for {duration} seconds!", "session": session})
+
 
 @app.route("/stop-record", methods=["POST"])
 def stop_record():
     """Stop video recording."""
-    global recording, record_process
-    if not recording:
+    if not recorder.recording:
         return jsonify({"message": "No recording in progress!"})
-    if record_process:
-        record_process.terminate()
-        record_process = None
-    recording = False
+    recorder.stop()
     return jsonify({"message": "Recording stopped!"})
 
 
+@app.route("/record-status")
+def record_status():
+    """Pre-roll buffered, current session folder and segments written so far."""
+    return jsonify(recorder.status())
+
+
 # --------------------------------
 # Main Interface
 # --------------------------------
@@ -144,6 +121,12 @@ def index():
     return render_template("index.html")
 
 
+@app.route("/metrics")
+def metrics():
+    """Runtime metrics (stage latencies, frames, clients, recognitions, gallery) for Prometheus."""
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
 
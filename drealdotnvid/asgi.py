@@ -0,0 +1,28 @@
+import os
+import sys
+
+# Shared modules (async_serving.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as server
+from async_serving import AsyncApp, event_stream, single_event, sse
+from enrollment import enroll_async, name_error
+
+# ASGI serving mode: uvicorn asgi:app --host 0.0.0.0 --port 5000
+# Enrollment runs as a coroutine; every other route is served by the Flask app in app.py.
+app = AsyncApp(fallback=server.app)
+
+
+@app.route("/take-photos-stream")
+async def take_photos_stream(request):
+    """Capture 5 photos as they pass the quality checks, sending instructions via SSE without holding a thread."""
+    name = request.args.get("name", "").strip()
+    error = name_error(name)
+    if error:
+        return event_stream(single_event(f"Error: {error}"))
+
+    async def generate_photos():
+        async for message in enroll_async(server.capture_frame, server.PHOTO_FOLDER, name, server.DIRECTIONS,
+                                          publisher=server.publisher):
+            yield sse(message)
+
+    return event_stream(generate_photos())
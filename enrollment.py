@@ -0,0 +1,324 @@
+import asyncio
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import face_recognition
+from async_serving import run_blocking
+from detection import DetectionPipeline
+from metrics import STAGE_SECONDS, STREAM_CLIENTS
+from training import encode_image, name_error, replace_identity
+
+# Seconds the person gets to match one prompt before it is skipped
+PROMPT_TIMEOUT = 10.0
+# Minimum seconds between two feedback messages, so the status does not flicker
+FEEDBACK_INTERVAL = 0.5
+# Narrowest face accepted, in full-resolution pixels
+MIN_FACE_WIDTH = 100
+# Variance of the Laplacian over the face, scaled to SHARPNESS_WIDTH pixels wide;
+# motion blur and out-of-focus frames score well below this
+MIN_SHARPNESS = 60.0
+SHARPNESS_WIDTH = 160
+
+# Head pose from landmarks: turn is how far the nose sits from the middle of
+# the eyes, in eye distances (positive = the person's left); tilt is how far
+# it moved up from the Center photo, as a fraction of the eye-to-mouth height
+MIN_TURN = 0.12
+MAX_TURN = 0.5
+MIN_TILT = 0.06
+MAX_TILT = 0.25
+# Nose height between eyes and mouth for a level head, used until the Center photo sets it
+LEVEL_PITCH = 0.55
+
+# (turn, tilt) asked for by each prompt; any other prompt only gets the quality checks
+POSES = {
+    "Center": (0, 0),
+    "Slightly Left": (1, 0),
+    "Slightly Right": (-1, 0),
+    "Slightly Up": (0, 1),
+    "Slightly Down": (0, -1),
+}
+MOVES = {
+    "left": "Turn a little to your left",
+    "right": "Turn a little to your right",
+    "up": "Tilt your head up a little",
+    "down": "Tilt your head down a little",
+}
+TOO_FAR = "Not so far, come back a little toward the camera"
+
+STEP_SECONDS = STAGE_SECONDS.labels("enroll_step")
+ENROLL_CLIENTS = STREAM_CLIENTS.labels("enroll")
+
+
+def sharpness(image):
+    """Variance of the Laplacian of a BGR crop, at a fixed width so faces of any size compare."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = cv2.resize(gray, (SHARPNESS_WIDTH, max(1, gray.shape[0] * SHARPNESS_WIDTH // gray.shape[1])))
+    return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+
+def head_pose(landmarks, mirrored=False):
+    """Approximate (yaw, pitch) from face_recognition landmarks; see MIN_TURN for the units."""
+    left_eye = np.mean(landmarks["left_eye"], axis=0)
+    right_eye = np.mean(landmarks["right_eye"], axis=0)
+    eyes = (left_eye + right_eye) / 2
+    nose = np.mean(landmarks["nose_tip"], axis=0)
+    mouth = np.mean(landmarks["top_lip"] + landmarks["bottom_lip"], axis=0)
+    # Unmirrored, the person's left is on the right of the picture
+    yaw = (nose[0] - eyes[0]) / max(np.linalg.norm(right_eye - left_eye), 1.0)
+    pitch = (nose[1] - eyes[1]) / max(mouth[1] - eyes[1], 1.0)
+    return (-yaw if mirrored else yaw), pitch
+
+
+def _axis_feedback(value, want, limit, low, high, positive, negative):
+    """
+    What to change along one axis. `want` 0 means stay within `limit` of
+    level; 1 or -1 means move between `low` and `high` that way.
+    """
+    if want == 0:
+        if value > limit:
+            return MOVES[negative]
+        if value < -limit:
+            return MOVES[positive]
+        return None
+    if value * want < low:
+        return MOVES[positive if want > 0 else negative]
+    if value * want > high:
+        return TOO_FAR
+    return None
+
+
+def pose_feedback(direction, turn, tilt):
+    """What the person should change to match the prompt, or None when the pose fits."""
+    if direction not in POSES:
+        return None
+    want_turn, want_tilt = POSES[direction]
+    # Center has to face the camera; the other prompts only must not turn too far off their axis
+    turn_limit = MIN_TURN if direction == "Center" else MAX_TURN
+    return (_axis_feedback(turn, want_turn, turn_limit, MIN_TURN, MAX_TURN, "left", "right")
+            or _axis_feedback(tilt, want_tilt, MAX_TILT, MIN_TILT, MAX_TILT, "up", "down"))
+
+
+# --------------------------------
+# Auto-Capture
+# --------------------------------
+class AutoCapture:
+    """
+    Quality-gated capture for one enrollment.
+
+    For each prompt, live frames are checked until one shows exactly one
+    face, large enough, sharp, not cut off by the edge of the picture and
+    in the pose the prompt asks for. That frame is JPEG-encoded and run
+    through the same encode_image() training uses; only if it yields an
+    encoding is it saved, so every photo written can be trained on. A
+    prompt nobody matches within `timeout` seconds is skipped.
+
+    step() does the blocking work for one frame and returns a feedback
+    message (or None); enroll() and enroll_async() drive it.
+    """
+
+    def __init__(self, timeout=PROMPT_TIMEOUT, min_face=MIN_FACE_WIDTH, min_sharpness=MIN_SHARPNESS,
+                 mirrored=False, pipeline=None):
+        self.timeout = timeout
+        self.min_face = min_face
+        self.min_sharpness = min_sharpness
+        self.mirrored = mirrored
+        self.pipeline = pipeline or DetectionPipeline()
+        # Path of every photo saved so far -> its encoding, handed on to the gallery
+        self.photos = {}
+        # Nose height of the accepted Center photo, the reference for Up/Down
+        self.level_pitch = LEVEL_PITCH
+        self.direction = None
+        self.done = False
+        self.captured = False
+        self._deadline = 0.0
+        self._reason = None
+        self._message = None
+        self._message_at = 0.0
+
+    def begin(self, direction):
+        """Start matching frames against a new prompt."""
+        self.direction = direction
+        self.done = False
+        self.captured = False
+        self._deadline = time.monotonic() + self.timeout
+        self._reason = "No frame from the camera"
+        self._message = None
+
+    def check(self, image):
+        """None if the BGR frame passes every gate for the current prompt, else what to fix."""
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        boxes = self.pipeline.detect([rgb])[0]
+        if not boxes:
+            return "No face found, look at the camera"
+        if len(boxes) > 1:
+            return "More than one face in view"
+        top, right, bottom, left = boxes[0]
+        if right - left < self.min_face:
+            return "Move closer to the camera"
+        height, width = image.shape[:2]
+        if top <= 0 or left <= 0 or bottom >= height or right >= width:
+            return "Move to the middle of the picture"
+        if sharpness(image[top:bottom, left:right]) < self.min_sharpness:
+            return "Hold still, the picture is blurred"
+
+        landmarks = face_recognition.face_landmarks(rgb, [boxes[0]])[0]
+        yaw, pitch = head_pose(landmarks, self.mirrored)
+        # Looking up brings the nose closer to the eyes
+        message = pose_feedback(self.direction, yaw, self.level_pitch - pitch)
+        if message is None and self.direction == "Center":
+            self.level_pitch = pitch
+        return message
+
+    def step(self, image, photo_path):
+        """
+        Check one frame (None if the camera gave none) and save it to
+        `photo_path` if it passes. Returns feedback to show, or None.
+        """
+        start = time.perf_counter()
+        try:
+            return self._step(image, photo_path)
+        finally:
+            STEP_SECONDS.observe_since(start)
+
+    def _step(self, image, photo_path):
+        if image is not None:
+            self._reason = self.check(image)
+            if self._reason is None:
+                ok, buffer = cv2.imencode('.jpg', image)
+                # Exactly the bytes that will be saved go through the training encoder
+                encoding = encode_image(io.BytesIO(buffer.tobytes())) if ok else None
+                if encoding is not None:
+                    with open(photo_path, "wb") as f:
+                        f.write(buffer.tobytes())
+                    self.photos[photo_path] = encoding
+                    self.done = self.captured = True
+                    return None
+                self._reason = "Hold still, the face could not be encoded"
+        if time.monotonic() >= self._deadline:
+            self.done = True
+            return None
+        # Only report a change, and not more often than FEEDBACK_INTERVAL
+        now = time.monotonic()
+        if self._reason != self._message and now - self._message_at >= FEEDBACK_INTERVAL:
+            self._message, self._message_at = self._reason, now
+            return self._reason
+        return None
+
+    def result(self, number, photo_path):
+        """The message for the prompt that just finished."""
+        if self.captured:
+            return f"Captured photo {number} ({self.direction}) as {os.path.basename(photo_path)}"
+        return f"Failed to capture photo {number} ({self.direction}): timed out ({self._reason})"
+
+
+# --------------------------------
+# Gallery Publishing
+# --------------------------------
+class GalleryPublisher:
+    """
+    Background worker that adds finished enrollments to the gallery.
+
+    Enrollments are published one at a time on a single thread, each with
+    replace_identity(): a complete enrollment replaces the person's old
+    photos and rows, a partial one is added alongside them, and train.gal
+    is rewritten atomically, without a full retrain.
+    The encodings AutoCapture already computed are reused. A LiveGallery,
+    if given, is reloaded straight away; other servers watching the file
+    pick it up on their next poll. Until train.gal exists, the legacy
+    `pkl_file` (by default the LiveGallery's) is what enrollments add to.
+    """
+
+    def __init__(self, image_dir, gallery_file, live_gallery=None, pkl_file=None):
+        self.image_dir = image_dir
+        self.gallery_file = gallery_file
+        self.live_gallery = live_gallery
+        self.pkl_file = pkl_file or (live_gallery.pkl_file if live_gallery is not None else None)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gallery-publisher")
+
+    def submit(self, name, photos, complete=True):
+        """
+        Queue `photos` (saved path -> encoding, or None to encode) for `name`;
+        only a `complete` enrollment replaces the earlier photos. Returns a
+        Future of the message to show when done.
+        """
+        return self._executor.submit(self._publish, name, photos, complete)
+
+    def _publish(self, name, photos, complete):
+        photos = {os.path.relpath(path, self.image_dir): encoding for path, encoding in photos.items()}
+        try:
+            gallery, report = replace_identity(self.image_dir, self.gallery_file, name, photos, replace=complete,
+                                               pkl_file=self.pkl_file)
+        except Exception as e:
+            print(f"Error adding {name} to {self.gallery_file}: {e}")
+            return f"{name} could not be added to the gallery: {e}"
+        if self.live_gallery is not None:
+            self.live_gallery.reload()
+        print(f"Enrolled {name} in {self.gallery_file}: {report}")
+        return (f"{name} can now be recognized ({len(photos) - report['failed']} photos, "
+                f"{len(gallery.identities)} people in the gallery)")
+
+
+def photo_path(folder, name, number):
+    """Enrollment photos are saved as <name>_<number>.jpg, the form training reads names from."""
+    return os.path.join(folder, f"{name}_{number}.jpg")
+
+
+def enroll(next_frame, folder, name, directions, capture=None, publisher=None):
+    """
+    Messages for one enrollment, prompt by prompt. `next_frame()` returns
+    the next BGR frame (None if there is none). With a publisher, the
+    photos are then added to the gallery before the final message,
+    "Photo capture complete! ...", which says whether that worked.
+    """
+    capture = capture or AutoCapture()
+    saved = 0
+    ENROLL_CLIENTS.inc()
+    try:
+        for i, direction in enumerate(directions):
+            path = photo_path(folder, name, i + 1)
+            yield f"Please face {direction}"
+            capture.begin(direction)
+            while not capture.done:
+                message = capture.step(next_frame(), path)
+                if message:
+                    yield message
+            saved += capture.captured
+            yield capture.result(i + 1, path)
+        summary = f"{saved} of {len(directions)} photos saved"
+        if publisher is not None and capture.photos:
+            yield f"Adding {name} to the gallery..."
+            complete = saved == len(directions)
+            summary += ", " + publisher.submit(name, capture.photos, complete).result()
+        yield f"Photo capture complete! {summary}."
+    finally:
+        ENROLL_CLIENTS.dec()
+
+
+async def enroll_async(next_frame, folder, name, directions, capture=None, publisher=None):
+    """enroll() for ASGI mode: frames and checks run on the shared executor."""
+    capture = capture or AutoCapture()
+    saved = 0
+    ENROLL_CLIENTS.inc()
+    try:
+        for i, direction in enumerate(directions):
+            path = photo_path(folder, name, i + 1)
+            yield f"Please face {direction}"
+            capture.begin(direction)
+            while not capture.done:
+                image = await run_blocking(next_frame)
+                message = await run_blocking(capture.step, image, path)
+                if message:
+                    yield message
+            saved += capture.captured
+            yield capture.result(i + 1, path)
+        summary = f"{saved} of {len(directions)} photos saved"
+        if publisher is not None and capture.photos:
+            yield f"Adding {name} to the gallery..."
+            complete = saved == len(directions)
+            summary += ", " + await asyncio.wrap_future(publisher.submit(name, capture.photos, complete))
+        yield f"Photo capture complete! {summary}."
+    finally:
+        ENROLL_CLIENTS.dec()
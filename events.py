@@ -0,0 +1,234 @@
+import atexit
+import datetime
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# Recognition history: one row per recognized face, appended by a background
+# writer and indexed by time and identity. Lives next to the app (same folder as train.gal).
+EVENTS_DB = "recognitions.db"
+# Events a burst may queue before new ones are dropped rather than block recognition
+MAX_QUEUE = 10000
+# Largest number of events committed in one transaction
+BATCH_SIZE = 500
+# Events a query returns by default, and at most
+QUERY_LIMIT = 1000
+MAX_QUERY_LIMIT = 10000
+# Event frames kept in the frame folder; older ones are deleted and their
+# events' frame reference cleared
+MAX_FRAMES = 2000
+# Seconds between clean-ups of the frame folder
+PRUNE_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    camera TEXT NOT NULL,
+    identity TEXT NOT NULL,
+    distance REAL,
+    box_top INTEGER,
+    box_right INTEGER,
+    box_bottom INTEGER,
+    box_left INTEGER,
+    frame TEXT
+);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+CREATE INDEX IF NOT EXISTS events_identity_ts ON events (identity, ts);
+CREATE INDEX IF NOT EXISTS events_frame ON events (frame);
+"""
+COLUMNS = ["ts", "camera", "identity", "distance", "box_top", "box_right", "box_bottom", "box_left", "frame"]
+
+
+def parse_time(value):
+    """Epoch seconds or an ISO date/time ("2025-05-14 13:48:01") as epoch seconds; None stays None."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def parse_limit(value):
+    """A query limit from a request argument: QUERY_LIMIT if missing, at most MAX_QUERY_LIMIT."""
+    if value is None or value == "":
+        return QUERY_LIMIT
+    limit = int(value)
+    if limit < 1:
+        raise ValueError(f"limit must be positive, got {limit}")
+    return min(limit, MAX_QUERY_LIMIT)
+
+
+def _connect(path):
+    db = sqlite3.connect(path)
+    # WAL lets queries read while the writer appends
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+def _to_dict(row):
+    event = dict(zip(COLUMNS, row))
+    box = {side: event.pop(f"box_{side}") for side in ("top", "right", "bottom", "left")}
+    event["box"] = box if box["top"] is not None else None
+    event["time"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(event["ts"]))
+    return event
+
+
+# --------------------------------
+# Event Store
+# --------------------------------
+class EventStore:
+    """
+    Append-only store of recognition events in SQLite.
+
+    record() only queues the event. A writer thread takes everything that
+    queued up while its previous commit was running and writes it in one
+    transaction (group commit), so a burst of recognitions costs a few
+    commits rather than one file open/write per face. Queries use their own
+    connection and see everything committed so far.
+
+    With a `frame_dir`, the writer also keeps the frames events point at to
+    the newest `max_frames` .jpg files there.
+    """
+
+    def __init__(self, path=EVENTS_DB, max_queue=MAX_QUEUE, batch_size=BATCH_SIZE, frame_dir=None,
+                 max_frames=MAX_FRAMES):
+        self.path = path
+        self.batch_size = batch_size
+        self.frame_dir = frame_dir
+        self.max_frames = max_frames
+        self.written = 0
+        self.dropped = 0
+        self.commits = 0
+        self.frames_pruned = 0
+        self._pruned_at = 0.0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        db = _connect(path)
+        db.executescript(SCHEMA)
+        db.close()
+
+    def start(self):
+        """Start the writer thread. Returns self."""
+        self._thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+        self._thread.start()
+        # Write out whatever is still queued when the server exits
+        atexit.register(self.close)
+        return self
+
+    def record(self, camera, identity, distance=None, box=None, frame=None, timestamp=None):
+        """Queue one event. `box` is a {top, right, bottom, left} dict, `frame` a reference to the source frame."""
+        box = box or {}
+        row = (timestamp or time.time(), camera, identity, distance,
+               box.get("top"), box.get("right"), box.get("bottom"), box.get("left"), frame)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def record_faces(self, camera, faces, frame=None, timestamp=None):
+        """Queue an event for every face returned by recognize_images."""
+        timestamp = timestamp or time.time()
+        for face in faces:
+            self.record(camera, face["name"], face["distance"], face["box"], frame, timestamp)
+
+    def _run(self):
+        db = _connect(self.path)
+        insert = f"INSERT INTO events ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+        stopping = False
+        while not stopping:
+            # Block for one event, then take whatever else is already queued
+            rows = []
+            row = self._queue.get()
+            while True:
+                if row is None:
+                    stopping = True
+                    break
+                rows.append(row)
+                if len(rows) >= self.batch_size:
+                    break
+                try:
+                    row = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if rows:
+                with db:
+                    db.executemany(insert, rows)
+                self.written += len(rows)
+                self.commits += 1
+                if self.frame_dir and time.monotonic() - self._pruned_at >= PRUNE_INTERVAL:
+                    self._prune_frames(db)
+            for _ in range(len(rows) + stopping):
+                self._queue.task_done()
+        db.close()
+
+    def _prune_frames(self, db):
+        """Delete all but the newest max_frames frames and clear the events that pointed at them."""
+        self._pruned_at = time.monotonic()
+        try:
+            frames = [entry for entry in os.scandir(self.frame_dir)
+                      if entry.name.endswith(".jpg") and entry.is_file()]
+        except OSError as e:
+            print(f"Error listing {self.frame_dir}: {e}")
+            return
+        if len(frames) <= self.max_frames:
+            return
+        frames.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        # Events store the path the app wrote, which is the folder joined with the file name
+        paths = [os.path.join(self.frame_dir, entry.name) for entry in frames[:len(frames) - self.max_frames]]
+        with db:
+            db.executemany("UPDATE events SET frame = NULL WHERE frame = ?", [(path,) for path in paths])
+        for path in paths:
+            try:
+                os.remove(path)
+                self.frames_pruned += 1
+            except OSError:
+                pass
+
+    def flush(self):
+        """Block until every event queued so far is committed."""
+        self._queue.join()
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    # -- queries --
+
+    def query(self, start=None, end=None, identity=None, camera=None, limit=QUERY_LIMIT):
+        """Events between `start` and `end` (epoch seconds, either may be None), newest first."""
+        where, params = self._where(start, end, identity, camera)
+        db = _connect(self.path)
+        try:
+            rows = db.execute(f"SELECT {', '.join(COLUMNS)} FROM events {where} ORDER BY ts DESC LIMIT ?",
+                              params + [limit]).fetchall()
+        finally:
+            db.close()
+        return [_to_dict(row) for row in rows]
+
+    def seen(self, start=None, end=None, camera=None):
+        """Who was seen between `start` and `end`: per identity, sightings, first/last time and best distance."""
+        where, params = self._where(start, end, None, camera)
+        db = _connect(self.path)
+        try:
+            rows = db.execute("SELECT identity, COUNT(*), MIN(ts), MAX(ts), MIN(distance) FROM events "
+                              f"{where} GROUP BY identity ORDER BY MIN(ts)", params).fetchall()
+        finally:
+            db.close()
+        return [{"identity": identity, "sightings": count, "first_seen": first, "last_seen": last,
+                 "best_distance": best} for identity, count, first, last, best in rows]
+
+    @staticmethod
+    def _where(start, end, identity, camera):
+        clauses, params = [], []
+        for clause, value in (("ts >= ?", start), ("ts <= ?", end), ("identity = ?", identity),
+                              ("camera = ?", camera)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
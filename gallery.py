@@ -0,0 +1,451 @@
+import os
+import pickle
+import struct
+import sys
+import threading
+import time
+import numpy as np
+from metrics import GALLERY_ENCODINGS, GALLERY_IDENTITIES, GALLERY_VERSION
+
+# Same cut-off face_recognition.compare_faces uses by default
+TOLERANCE = 0.6
+UNKNOWN = "Unknown"
+
+# Enrollment photos further than this from their identity's centroid are
+# kept as extra prototypes (e.g. a strongly turned head). Every row is then
+# within OUTLIER_DISTANCE of a prototype of its identity, which bounds the
+# error of trusting a prototype match. Smaller is closer to the exact scan
+# but keeps more photos as prototypes, so matching saves less.
+OUTLIER_DISTANCE = 0.15
+# Prototype matches within this much of the tolerance are re-checked on
+# every row. Outside that band the answer is one the rows agree with: a face
+# further than tolerance + margin from every prototype has no row within
+# the tolerance, and one within tolerance - margin of a prototype has a
+# row of that identity within it.
+PROTOTYPE_MARGIN = OUTLIER_DISTANCE
+
+# Galleries smaller than this always use the exact scan, even with an index
+ANN_MIN_ROWS = 20000
+
+# dlib model behind face_recognition.face_encodings
+MODEL_NAME = "dlib_face_recognition_resnet_model_v1"
+ENCODING_DIM = 128
+
+
+# --------------------------------
+# Gallery Matcher
+# --------------------------------
+class Gallery:
+    """
+    Enrolled face encodings kept in one contiguous float matrix.
+    Every query face is scored against every enrolled row in a single
+    vectorized distance computation, and the closest row wins.
+
+    Names are stored once per identity; each row only carries the index
+    of its identity in `labels`.
+
+    A gallery can also carry `prototypes`: a few vectors per identity (the
+    centroid of its enrollment photos plus outlier poses). Matching then
+    scans the prototypes and only falls back to the per-photo rows when a
+    result lands near the tolerance.
+
+    Large galleries can use an approximate (IVF) index saved next to the
+    .gal file; it is only loaded on the first search that needs it.
+    """
+
+    def __init__(self, names, encodings, model=MODEL_NAME):
+        identities = {}
+        labels = [identities.setdefault(name, len(identities)) for name in names]
+        self._setup(list(identities), np.asarray(labels, dtype=np.uint32), encodings, model)
+
+    def _setup(self, identities, labels, encodings, model):
+        self.identities = identities
+        self.labels = labels
+        self.model = model
+        self.prototypes = None
+        self.index_file = None
+        self.n_probe = None
+        self._index = None
+        if len(encodings):
+            # No copy when the rows are already float32, e.g. a memory-mapped file
+            matrix = np.asarray(encodings, dtype=np.float32)
+        else:
+            matrix = np.empty((0, ENCODING_DIM), dtype=np.float32)
+        self.encodings = np.ascontiguousarray(matrix)
+        if len(self.labels) != len(self.encodings):
+            raise ValueError("Gallery names and encodings have different lengths")
+        # Squared norms of the enrolled rows, reused by every query
+        self.sq_norms = np.einsum("ij,ij->i", self.encodings, self.encodings)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def dim(self):
+        return self.encodings.shape[1]
+
+    @property
+    def names(self):
+        """Per-row names, in the same order as the encoding rows."""
+        return [self.identities[label] for label in self.labels]
+
+    def name_of(self, row):
+        return self.identities[self.labels[row]]
+
+    @property
+    def index(self):
+        """The ANN index, loaded from index_file on first use; None if unusable."""
+        if self._index is None and self.index_file and os.path.exists(self.index_file):
+            from ann_index import IVFIndex, fingerprint
+            index = IVFIndex.load(self.index_file)
+            if index.gallery_fingerprint == fingerprint(self.encodings):
+                self._index = index
+            else:
+                print(f"Warning: {self.index_file} is stale. Using exact search.", file=sys.stderr)
+            self.index_file = None
+        return self._index
+
+    @index.setter
+    def index(self, index):
+        self._index = index
+
+    @classmethod
+    def from_arrays(cls, identities, labels, encodings, model=MODEL_NAME):
+        """Build a gallery from an identity table and per-row identity indices."""
+        gallery = cls.__new__(cls)
+        gallery._setup(list(identities), np.asarray(labels, dtype=np.uint32), encodings, model)
+        return gallery
+
+    @classmethod
+    def from_pickle(cls, pkl_file):
+        """Load a train.pkl written as two pickles: names, then encodings."""
+        with open(pkl_file, "rb") as f:
+            names = pickle.load(f)
+            encodings = pickle.load(f)
+        return cls(names, encodings)
+
+    def distances(self, face_encodings):
+        """Return an (n_faces, n_enrolled) matrix of euclidean distances."""
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, self.dim)
+        q_norms = np.einsum("ij,ij->i", queries, queries)
+        sq = q_norms[:, None] + self.sq_norms[None, :] - 2.0 * (queries @ self.encodings.T)
+        np.maximum(sq, 0.0, out=sq)
+        return np.sqrt(sq)
+
+    def build_prototypes(self, outlier_distance=OUTLIER_DISTANCE):
+        """
+        Collapse each identity into its centroid plus any photo further than
+        outlier_distance from it. The per-photo rows are kept for auditing
+        and as the fallback for borderline matches. An identity whose photos
+        are all outliers keeps just the photos; its centroid would stand for
+        none of them.
+        """
+        labels = []
+        prototypes = []
+        order = np.argsort(self.labels, kind="stable")
+        ids, starts = np.unique(self.labels[order], return_index=True)
+        for label, rows in zip(ids, np.split(order, starts[1:])):
+            encodings = self.encodings[rows]
+            centroid = encodings.mean(axis=0)
+            outlying = np.linalg.norm(encodings - centroid, axis=1) > outlier_distance
+            if not outlying.all():
+                prototypes.append(centroid)
+                labels.append(label)
+            prototypes.extend(encodings[outlying])
+            labels.extend([label] * int(outlying.sum()))
+        self.prototypes = Gallery.from_arrays(self.identities, labels, prototypes, self.model)
+        return self.prototypes
+
+    def match(self, face_encodings, tolerance=TOLERANCE, top_k=3, margin=PROTOTYPE_MARGIN):
+        """
+        Match a batch of face encodings against the whole gallery.
+        Returns one dict per face with the best name, its distance and
+        the top-k closest (name, distance) candidates. With prototypes, only
+        faces whose prototype distance is within `margin` of the tolerance
+        are re-checked on every row.
+        """
+        if len(face_encodings) == 0:
+            return []
+        if not len(self):
+            return [{"name": UNKNOWN, "distance": None, "candidates": []} for _ in face_encodings]
+
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, self.dim)
+        if self.prototypes is None or not len(self.prototypes):
+            return self._match_rows(queries, tolerance, top_k)
+
+        results = self.prototypes._match_rows(queries, tolerance, top_k)
+        unsure = [i for i, r in enumerate(results)
+                  if r["distance"] is None or abs(r["distance"] - tolerance) <= margin]
+        if unsure:
+            for i, result in zip(unsure, self._match_rows(queries[unsure], tolerance, top_k)):
+                results[i] = result
+        return results
+
+    def _nearest(self, queries, k, use_index=True):
+        """
+        Top-k rows per query as (rows, distances), nearest first. Uses the
+        ANN index for large galleries, otherwise scans every row.
+        """
+        if use_index and len(self) >= ANN_MIN_ROWS and self.index is not None:
+            # n_probe overrides the count saved with the index, e.g. while measuring recall
+            return self.index.search(self.encodings, self.sq_norms, queries, k, self.n_probe)
+
+        dist = self.distances(queries)
+        k = min(k, dist.shape[1])
+        # argpartition keeps this O(n) per face; only the k winners get sorted
+        nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        rows = np.arange(dist.shape[0])[:, None]
+        order = np.argsort(dist[rows, nearest], axis=1)
+        nearest = nearest[rows, order]
+        return [(row, dist[i, row]) for i, row in enumerate(nearest)]
+
+    def _match_rows(self, queries, tolerance, top_k):
+        """Top-k search over the rows of this gallery."""
+        results = []
+        for rows, dist in self._nearest(queries, top_k):
+            if not len(rows):
+                results.append({"name": UNKNOWN, "distance": None, "candidates": []})
+                continue
+            candidates = [(self.name_of(j), float(d)) for j, d in zip(rows, dist)]
+            best_name, best_distance = candidates[0]
+            results.append({
+                "name": best_name if best_distance <= tolerance else UNKNOWN,
+                "distance": best_distance,
+                "candidates": candidates,
+            })
+        return results
+
+    def best_match(self, face_encodings, tolerance=TOLERANCE):
+        """Return the closest recognized name over all given faces, or Unknown."""
+        known = [m for m in self.match(face_encodings, tolerance, top_k=1) if m["name"] != UNKNOWN]
+        if not known:
+            return UNKNOWN
+        return min(known, key=lambda m: m["distance"])["name"]
+
+
+# --------------------------------
+# Binary Gallery File (.gal)
+# --------------------------------
+# Layout, all little-endian:
+#   header        HEADER struct (+ PROTO_HEADER from version 2), padded to 128 bytes
+#   labels        uint32[count], identity index of each row
+#   matrix        float32[count, dim], starts on a 64-byte boundary
+#   proto labels  uint32[proto_count], version 2 only
+#   proto matrix  float32[proto_count, dim], version 2 only, 64-byte aligned
+#   names         identity names, UTF-8, NUL separated
+# The matrices are memory-mapped on load, so every server process shares
+# the same page-cache copy instead of unpickling its own.
+MAGIC = b"HGNGAL"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<6sHIII64sQQQ")
+PROTO_HEADER = struct.Struct("<IQQ")
+HEADER_SIZE = 128
+ALIGN = 64
+
+
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def save_gallery(gallery, gallery_file):
+    """Write the gallery to a .gal file, replacing any old file atomically."""
+    count, dim = len(gallery), gallery.dim
+    prototypes = gallery.prototypes
+    proto_count = len(prototypes) if prototypes is not None else 0
+    labels_offset = HEADER_SIZE
+    matrix_offset = _align(labels_offset + 4 * count)
+    proto_labels_offset = matrix_offset + 4 * count * dim
+    proto_matrix_offset = _align(proto_labels_offset + 4 * proto_count)
+    names_offset = proto_matrix_offset + 4 * proto_count * dim
+    names_blob = b"\0".join(name.encode("utf-8") for name in gallery.identities)
+
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, dim, count, len(gallery.identities),
+        gallery.model.encode("ascii")[:64], labels_offset, matrix_offset, names_offset,
+    ) + PROTO_HEADER.pack(proto_count, proto_labels_offset, proto_matrix_offset)
+    tmp_file = f"{gallery_file}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(header.ljust(HEADER_SIZE, b"\0"))
+        f.write(gallery.labels.astype("<u4").tobytes())
+        f.write(b"\0" * (matrix_offset - f.tell()))
+        f.write(gallery.encodings.astype("<f4").tobytes())
+        if proto_count:
+            f.write(prototypes.labels.astype("<u4").tobytes())
+            f.write(b"\0" * (proto_matrix_offset - f.tell()))
+            f.write(prototypes.encodings.astype("<f4").tobytes())
+        f.write(names_blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, gallery_file)
+
+
+def read_header(gallery_file):
+    """Return the header fields of a .gal file as a dict."""
+    with open(gallery_file, "rb") as f:
+        raw = f.read(HEADER_SIZE)
+    if len(raw) < HEADER.size:
+        raise ValueError(f"{gallery_file} is too short to be a gallery file")
+    (magic, version, dim, count, n_identities, model,
+     labels_offset, matrix_offset, names_offset) = HEADER.unpack_from(raw)
+    if magic != MAGIC:
+        raise ValueError(f"{gallery_file} is not a gallery file")
+    if version not in (1, 2):
+        raise ValueError(f"{gallery_file} has unsupported gallery format version {version}")
+    proto_count = proto_labels_offset = proto_matrix_offset = 0
+    if version >= 2:
+        proto_count, proto_labels_offset, proto_matrix_offset = PROTO_HEADER.unpack_from(raw, HEADER.size)
+    return {
+        "version": version,
+        "dim": dim,
+        "count": count,
+        "identities": n_identities,
+        "model": model.rstrip(b"\0").decode("ascii"),
+        "labels_offset": labels_offset,
+        "matrix_offset": matrix_offset,
+        "names_offset": names_offset,
+        "proto_count": proto_count,
+        "proto_labels_offset": proto_labels_offset,
+        "proto_matrix_offset": proto_matrix_offset,
+    }
+
+
+def _map_rows(gallery_file, count, dim, labels_offset, matrix_offset):
+    if not count:
+        return np.empty(0, dtype=np.uint32), np.empty((0, dim), dtype=np.float32)
+    labels = np.memmap(gallery_file, dtype="<u4", mode="r", offset=labels_offset, shape=(count,))
+    encodings = np.memmap(gallery_file, dtype="<f4", mode="r", offset=matrix_offset, shape=(count, dim))
+    return labels, encodings
+
+
+def open_gallery(gallery_file):
+    """Memory-map a .gal file; only the small name table is read into memory."""
+    header = read_header(gallery_file)
+    dim = header["dim"]
+    labels, encodings = _map_rows(gallery_file, header["count"], dim,
+                                  header["labels_offset"], header["matrix_offset"])
+    with open(gallery_file, "rb") as f:
+        f.seek(header["names_offset"])
+        names_blob = f.read()
+    identities = names_blob.decode("utf-8").split("\0") if header["identities"] else []
+    if len(identities) != header["identities"]:
+        raise ValueError(f"{gallery_file} has a corrupt name table")
+    gallery = Gallery.from_arrays(identities, labels, encodings, model=header["model"])
+    index_file = os.path.splitext(gallery_file)[0] + ".ivf.npz"
+    if os.path.exists(index_file):
+        gallery.index_file = index_file
+    if header["proto_count"]:
+        proto_labels, proto_encodings = _map_rows(gallery_file, header["proto_count"], dim,
+                                                  header["proto_labels_offset"], header["proto_matrix_offset"])
+        gallery.prototypes = Gallery.from_arrays(identities, proto_labels, proto_encodings, model=header["model"])
+    return gallery
+
+
+def load_gallery(gallery_file, pkl_file=None):
+    """
+    Load the gallery, preferring the binary .gal file and falling back to a
+    legacy train.pkl. Returns an empty gallery if neither exists.
+    """
+    if os.path.exists(gallery_file):
+        return open_gallery(gallery_file)
+    if pkl_file and os.path.exists(pkl_file):
+        print(f"Warning: {gallery_file} not found, loading legacy {pkl_file}. "
+              f"Run convert_pkl.py to migrate.", file=sys.stderr)
+        return Gallery.from_pickle(pkl_file)
+    print(f"Warning: {gallery_file} not found. Facial recognition will not work.", file=sys.stderr)
+    return Gallery([], [])
+
+
+# --------------------------------
+# Hot Reload
+# --------------------------------
+class LiveGallery:
+    """
+    The gallery a running server matches against, swapped in place when the
+    files on disk change.
+
+    Each load builds a complete new Gallery on the side and then replaces
+    the `current` reference in one assignment, so a recognition that has
+    already picked up a snapshot keeps using it undisturbed and no reader
+    ever sees a half-loaded gallery. Old snapshots stay valid because a
+    retrain replaces train.gal atomically instead of rewriting it.
+    """
+
+    def __init__(self, gallery_file, pkl_file=None, poll_interval=2.0):
+        self.gallery_file = gallery_file
+        self.pkl_file = pkl_file
+        self.poll_interval = poll_interval
+        self.version = 0
+        self.loaded_at = None
+        # Why the last reload failed, or None if it succeeded
+        self.error = None
+        self._signature = None
+        self._lock = threading.Lock()
+        self.current = Gallery([], [])
+        self.reload()
+        # Read at scrape time, so reloads cost nothing extra
+        GALLERY_VERSION.labels(gallery_file).set_function(lambda: self.version)
+        GALLERY_ENCODINGS.labels(gallery_file).set_function(lambda: len(self.current))
+        GALLERY_IDENTITIES.labels(gallery_file).set_function(lambda: len(self.current.identities))
+
+    def get(self):
+        """Return the current snapshot; hold on to it for a whole recognition."""
+        return self.current
+
+    def _file_signature(self):
+        """Identity of the files on disk; any change means a retrain happened."""
+        signature = []
+        for path in (self.gallery_file, self.pkl_file, os.path.splitext(self.gallery_file)[0] + ".ivf.npz"):
+            try:
+                st = os.stat(path) if path else None
+            except OSError:
+                st = None
+            signature.append((st.st_ino, st.st_size, st.st_mtime_ns) if st else None)
+        return tuple(signature)
+
+    def reload(self, force=True):
+        """
+        Load the gallery files into a new snapshot and publish it. Without
+        force, nothing happens unless the files changed. Returns True if a
+        new snapshot was published; a file that fails to load leaves the
+        previous snapshot in place and its reason in `error`.
+        """
+        with self._lock:
+            signature = self._file_signature()
+            if not force and signature == self._signature:
+                return False
+            try:
+                gallery = load_gallery(self.gallery_file, self.pkl_file)
+            except (OSError, ValueError, pickle.UnpicklingError) as e:
+                print(f"Error reloading {self.gallery_file}: {e}. Keeping gallery version {self.version}.",
+                      file=sys.stderr)
+                self.error = str(e)
+                return False
+            self.error = None
+            self._signature = signature
+            self.version += 1
+            self.loaded_at = time.time()
+            self.current = gallery
+            return True
+
+    def watch(self):
+        """Start a daemon thread that reloads the gallery whenever its files change."""
+        def poll():
+            while True:
+                time.sleep(self.poll_interval)
+                if self.reload(force=False):
+                    print(f"Reloaded {self.gallery_file}: version {self.version}, {len(self.current)} encodings")
+        threading.Thread(target=poll, daemon=True).start()
+        return self
+
+    def status(self):
+        gallery = self.current
+        return {
+            "version": self.version,
+            "encodings": len(gallery),
+            "identities": len(gallery.identities),
+            "prototypes": len(gallery.prototypes) if gallery.prototypes is not None else 0,
+            "loaded_at": (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.loaded_at))
+                          if self.loaded_at is not None else None),
+            "file": self.gallery_file,
+            "error": self.error,
+        }
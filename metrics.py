@@ -0,0 +1,229 @@
+import bisect
+import threading
+import time
+
+# Runtime metrics for every server, served at /metrics in the Prometheus
+# text format (https://prometheus.io/docs/instrumenting/exposition_formats/).
+# The metrics themselves are defined at the bottom of this module; the
+# modules that do the work import the ones they update.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds, in seconds, of the latency histogram buckets: from a camera
+# read or a JPEG encode (a few ms) up to a CNN detection pass (seconds)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_families = []
+_families_lock = threading.Lock()
+
+
+# --------------------------------
+# Per-Thread Storage
+# --------------------------------
+class _Sharded:
+    """
+    Base for metrics kept as one slot (a short list of numbers) per thread
+    that updates them.
+
+    A thread only ever writes its own slot, so updates take no lock and
+    none are lost; scrapes add the slots up. Slots of threads that have
+    finished (the Flask dev server uses a thread per request) are folded
+    into `_retired` at the next scrape so they do not pile up.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._retired = [0] * size
+        self._local = threading.local()
+        self._live = []
+        self._lock = threading.Lock()
+
+    def _new_slot(self):
+        # First update from this thread; the lock is only taken here and on scrapes
+        slot = self._local.slot = [0] * self._size
+        with self._lock:
+            self._live.append((threading.current_thread(), slot))
+        return slot
+
+    def _totals(self):
+        with self._lock:
+            live = []
+            for thread, slot in self._live:
+                if thread.is_alive():
+                    live.append((thread, slot))
+                else:
+                    self._retired = [a + b for a, b in zip(self._retired, slot)]
+            self._live = live
+            totals = list(self._retired)
+            for _, slot in live:
+                totals = [a + b for a, b in zip(totals, slot)]
+        return totals
+
+
+# --------------------------------
+# Metric Types
+# --------------------------------
+class Counter(_Sharded):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        try:
+            self._local.slot[0] += amount
+        except AttributeError:
+            self._new_slot()[0] += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self._totals()[0])]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, or, after set_function(), whatever that function returns at scrape time."""
+
+    def __init__(self):
+        super().__init__()
+        self._function = None
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self, name, labels):
+        if self._function is not None:
+            return [(name, labels, self._function())]
+        return super().samples(name, labels)
+
+
+class Histogram(_Sharded):
+    """
+    Counts of observations per fixed bucket, plus their sum. An observation
+    costs a bisect and two additions in the calling thread's slot.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One count per bucket, one for +Inf, then the sum
+        super().__init__(len(self.buckets) + 2)
+
+    def observe(self, value):
+        try:
+            slot = self._local.slot
+        except AttributeError:
+            slot = self._new_slot()
+        slot[bisect.bisect_left(self.buckets, value)] += 1
+        slot[-1] += value
+
+    def observe_since(self, start):
+        """Observe the seconds since `start`, a time.perf_counter() reading."""
+        self.observe(time.perf_counter() - start)
+
+    def samples(self, name, labels):
+        totals = self._totals()
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), totals):
+            cumulative += count
+            samples.append((name + "_bucket", labels + (("le", _format_value(bound)),), cumulative))
+        samples.append((name + "_sum", labels, totals[-1]))
+        samples.append((name + "_count", labels, cumulative))
+        return samples
+
+
+# --------------------------------
+# Registry
+# --------------------------------
+class Family:
+    """
+    A named metric and its children, one per combination of label values.
+    Look children up once with labels() and keep them, so the hot path
+    does not repeat the lookup. A family without label names is its own
+    only child and is updated directly (FRAMES_CAPTURED.inc()).
+    """
+
+    def __init__(self, kind, name, help, labelnames=(), make=None):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._make = make
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            child = self.labels()
+            for method in ("inc", "dec", "observe", "observe_since", "set_function"):
+                if hasattr(child, method):
+                    setattr(self, method, getattr(child, method))
+        with _families_lock:
+            _families.append(self)
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._make())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            for name, labels, value in child.samples(self.name, tuple(zip(self.labelnames, values))):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+def counter(name, help, labelnames=()):
+    return Family("counter", name, help, labelnames, Counter)
+
+
+def gauge(name, help, labelnames=()):
+    return Family("gauge", name, help, labelnames, Gauge)
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return Family("histogram", name, help, labelnames, lambda: Histogram(buckets))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render_metrics():
+    """Every metric in the Prometheus text format, the body of a /metrics response."""
+    with _families_lock:
+        families = list(_families)
+    lines = []
+    for family in families:
+        lines.extend(family.render())
+    return "\n".join(lines) + "\n"
+
+
+# --------------------------------
+# Metrics
+# --------------------------------
+STAGE_SECONDS = histogram(
+    "facerec_stage_duration_seconds",
+    "Time spent in each pipeline stage: capture (one source read), jpeg_encode, detect, "
+    "encode and match (per call), enroll_step (one enrollment frame check).",
+    ["stage"])
+FRAMES_CAPTURED = counter("facerec_frames_captured_total", "Frames read from the camera source.")
+FRAME_READ_FAILURES = counter("facerec_frame_read_failures_total", "Camera source reads that returned no frame.")
+FRAMES_DROPPED = counter("facerec_frames_dropped_total",
+                         "Frames dropped because a consumer (viewer, recorder, recognizer) fell behind.")
+STREAM_CLIENTS = gauge("facerec_stream_clients", "Clients currently connected to a stream.", ["stream"])
+RECOGNITIONS = counter("facerec_recognitions_total", "Faces matched against the gallery, by outcome.", ["outcome"])
+GALLERY_ENCODINGS = gauge("facerec_gallery_encodings", "Encodings in the loaded gallery.", ["file"])
+GALLERY_IDENTITIES = gauge("facerec_gallery_identities", "People in the loaded gallery.", ["file"])
+GALLERY_VERSION = gauge("facerec_gallery_version", "Times the gallery has been (re)loaded.", ["file"])
@@ -0,0 +1,139 @@
+import threading
+import time
+import cv2
+from camera import FrameSlot
+from gallery import TOLERANCE, UNKNOWN
+from streaming import JPEG_SECONDS, VariantCache, adaptive_mjpeg
+from tracking import FaceTracker
+
+# Boxes older than this many seconds are no longer drawn (recognition has stalled)
+ANNOTATION_TTL = 1.0
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def draw_faces(image, faces):
+    """Draw a box and name for every face, in place (same look as picrec.py)."""
+    for face in faces:
+        box = face["box"]
+        name = face["name"] if face["name"] != UNKNOWN else "Unknown Person"
+        cv2.rectangle(image, (box["left"], box["top"]), (box["right"], box["bottom"]), (0, 0, 255), 2)
+        cv2.putText(image, name, (box["left"], box["top"] - 6), FONT, .75, (0, 255, 255), 2)
+    return image
+
+
+# --------------------------------
+# Recognized Feed
+# --------------------------------
+class RecognitionOverlay:
+    """
+    An annotated copy of a CameraBroadcaster's stream, with recognized names
+    drawn on every frame.
+
+    Two threads share the camera with the raw feed:
+    - the recognition worker subscribes with a one-frame queue, so it always
+      picks up the newest frame and stale ones are dropped while it is busy.
+      Faces are followed with a FaceTracker, so steady faces are not re-encoded.
+    - the render thread takes every frame at camera rate, draws the latest
+      annotations on it and JPEG-encodes it once for all viewers.
+    So the output keeps the camera frame rate while recognition runs as
+    fast as the CPU allows, typically a few times per second.
+
+    Both threads only run while someone is watching /recognized_feed.
+    """
+
+    def __init__(self, camera, live_gallery, pipeline=None, tolerance=TOLERANCE, jpeg_quality=None):
+        self.camera = camera
+        self.live_gallery = live_gallery
+        self.pipeline = pipeline
+        self.tolerance = tolerance
+        self.jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if jpeg_quality else []
+        self.slot = FrameSlot()
+        self.variants = VariantCache()
+        self.recognitions = 0
+        self._annotations = (0.0, [])
+        self._clients = 0
+        self._lock = threading.Lock()
+        self._subscriptions = None
+        self._render_thread = None
+
+    def _start(self):
+        # Called with self._lock held; a fresh tracker per session so no identity outlives it
+        render = self.camera.subscribe()
+        worker = self.camera.subscribe(max_queue=1)
+        self._subscriptions = (render, worker)
+        tracker = FaceTracker(self.pipeline)
+        threading.Thread(target=self._recognize, args=(worker, tracker),
+                         name=f"{self.camera.name}-recognize", daemon=True).start()
+        self._render_thread = threading.Thread(target=self._render, args=(render,),
+                                               name=f"{self.camera.name}-overlay", daemon=True)
+        self._render_thread.start()
+
+    def _stop(self):
+        # Called with self._lock held
+        for subscription in self._subscriptions:
+            self.camera.unsubscribe(subscription)
+        self._subscriptions = None
+        self._annotations = (0.0, [])
+
+    def _recognize(self, subscription, tracker):
+        while True:
+            frame = subscription.get()
+            if frame is None:
+                break
+            image = cv2.cvtColor(frame.image, cv2.COLOR_BGR2RGB)
+            faces = tracker.update(image, self.live_gallery.get(), self.tolerance)
+            self._annotations = (frame.timestamp, faces)
+            self.recognitions += 1
+
+    def _render(self, subscription):
+        while True:
+            frame = subscription.get()
+            if frame is None:
+                break
+            annotated_at, faces = self._annotations
+            if faces and frame.timestamp - annotated_at <= ANNOTATION_TTL:
+                image = draw_faces(frame.image.copy(), faces)
+                start = time.perf_counter()
+                ok, buffer = cv2.imencode('.jpg', image, self.jpeg_params)
+                JPEG_SECONDS.observe_since(start)
+                if not ok:
+                    continue
+                jpeg = buffer.tobytes()
+            else:
+                # Nothing to draw: reuse the camera's own encoding
+                image, jpeg = frame.image, frame.jpeg
+            self.slot.publish(image, jpeg)
+
+    def open(self):
+        """
+        Join the viewers, starting recognition for the first one. Returns the
+        annotated frames (ending if the camera goes away) and a callable to
+        leave again; the threads stop when the last viewer has left.
+        """
+        with self._lock:
+            self._clients += 1
+            if self._clients == 1:
+                self._start()
+            render_thread = self._render_thread
+        viewing = threading.Event()
+        viewing.set()
+
+        def close():
+            if not viewing.is_set():
+                return
+            viewing.clear()
+            with self._lock:
+                self._clients -= 1
+                if self._clients == 0 and self._subscriptions:
+                    self._stop()
+
+        frames = self.slot.frames(lambda: viewing.is_set() and render_thread.is_alive())
+        return frames, close
+
+    def mjpeg_stream(self, caps=None):
+        """Generator for a multipart MJPEG response of the annotated frames, adapted to the client."""
+        frames, close = self.open()
+        try:
+            yield from adaptive_mjpeg(frames, self.variants, caps)
+        finally:
+            close()
@@ -1,15 +1,13 @@
 import face_recognition
 import cv2
 import os
-import pickle
+from detection import DetectionPipeline
+from gallery import load_gallery
+from recognition import recognize_images
 print(cv2.__version__)
 
-Encodings = []
-Names = [] 
-
-with open('train.pkl', 'rb') as f:
-    Names = pickle.load(f)
-    Encodings = pickle.load(f)
+gallery = load_gallery('train.gal', 'train.pkl')
+detector = DetectionPipeline.from_config('detection.json')
 
 font = cv2.FONT_HERSHEY_SIMPLEX
 image_dir = r'C:\Users\dodds\OneDrive\Documents\HGNspring2024\demoImages-master\unknown'
@@ -20,16 +18,16 @@ for root, dirs, files in os.walk(image_dir):
         print(file)
         testImagePath = os.path.join(root, file)
         testImage = face_recognition.load_image_file(testImagePath)
-        facePositions = face_recognition.face_locations(testImage)
-        allEncodings = face_recognition.face_encodings(testImage, facePositions)
+        timings = {}
+        faces = recognize_images([testImage], gallery, pipeline=detector, timings=timings)[0]
+        print(timings)
         testImage = cv2.cvtColor(testImage, cv2.COLOR_RGB2BGR)
 
-        for (top, right, bottom, left), face_encoding in zip(facePositions, allEncodings):
+        for face in faces:
+            top, right, bottom, left = (face['box'][k] for k in ('top', 'right', 'bottom', 'left'))
             name = 'Unknown Person'
-            matches = face_recognition.compare_faces(Encodings, face_encoding)
-            if True in matches:
-                first_match_index = matches.index(True)
-                name = Names[first_match_index]
+            if face['name'] != 'Unknown':
+                name = face['name']
             cv2.rectangle(testImage, (left,top), (right,bottom), (0,0,255), 2)
             cv2.putText(testImage, name, (left, top-6), font, .75, (0,255,255), 2)
         cv2.imshow('Picture', testImage)
@@ -0,0 +1,71 @@
+import time
+from detection import DetectionPipeline
+from gallery import TOLERANCE, UNKNOWN
+from metrics import RECOGNITIONS, STAGE_SECONDS
+
+# Enough rows to find a second identity when each person has five photos enrolled
+MATCH_TOP_K = 11
+
+MATCH_SECONDS = STAGE_SECONDS.labels("match")
+KNOWN_FACES = RECOGNITIONS.labels("known")
+UNKNOWN_FACES = RECOGNITIONS.labels("unknown")
+
+
+def runner_up(match):
+    """The closest candidate belonging to a different identity than the best one."""
+    if not match["candidates"]:
+        return None
+    best_name = match["candidates"][0][0]
+    for name, distance in match["candidates"][1:]:
+        if name != best_name:
+            return {"name": name, "distance": distance}
+    return None
+
+
+def face_result(box, match):
+    """The per-face dict returned to callers: box, best name, its distance and the runner-up."""
+    (UNKNOWN_FACES if match["name"] == UNKNOWN else KNOWN_FACES).inc()
+    top, right, bottom, left = box
+    return {
+        "box": {"top": top, "right": right, "bottom": bottom, "left": left},
+        "name": match["name"],
+        "distance": match["distance"],
+        "runner_up": runner_up(match),
+    }
+
+
+def recognize_images(images, gallery, tolerance=TOLERANCE, pipeline=None, timings=None):
+    """
+    Detect and recognize every face in a batch of RGB images.
+
+    All faces found across the batch are matched against the gallery in
+    one vectorized call. Returns one list per image with a dict per face:
+    box, best name, its distance and the runner-up identity. Stage
+    durations in milliseconds are added to `timings` if one is given.
+    """
+    pipeline = pipeline or DetectionPipeline()
+    timings = timings if timings is not None else {}
+    locations = pipeline.detect(images, timings)
+    encodings = pipeline.encode(images, locations, timings)
+
+    start = time.perf_counter()
+    matches = iter(gallery.match([e for image_encodings in encodings for e in image_encodings],
+                                 tolerance, top_k=MATCH_TOP_K))
+    timings["match"] = timings.get("match", 0.0) + (time.perf_counter() - start) * 1000
+    MATCH_SECONDS.observe_since(start)
+
+    results = []
+    for boxes in locations:
+        faces = []
+        for box in boxes:
+            faces.append(face_result(box, next(matches)))
+        results.append(faces)
+    return results
+
+
+def best_name(faces):
+    """The recognized name of the closest face, or Unknown."""
+    known = [face for face in faces if face["name"] != UNKNOWN]
+    if not known:
+        return UNKNOWN
+    return min(known, key=lambda face: face["distance"])["name"]
@@ -0,0 +1,290 @@
+import collections
+import math
+import os
+import threading
+import time
+import cv2
+import numpy as np
+from camera import RECORD_QUEUE
+from metrics import FRAMES_DROPPED
+
+# Seconds of video kept in memory before a trigger. Off by default: keeping a
+# pre-roll JPEG-encodes every frame the camera delivers, even while idle
+PREROLL_SECONDS = 0
+# Length of each segment file
+SEGMENT_SECONDS = 10
+# Quality of the in-memory pre-roll frames (the camera's own JPEG is used when it has one)
+PREROLL_QUALITY = 80
+# A longer stall is not filled with copies of the last frame; the video just continues
+MAX_GAP_SECONDS = 1.0
+INDEX_FILE = "index.m3u8"
+
+
+def gst_segment_pipeline(segment_path, fps, bitrate=500):
+    """
+    GStreamer encoder for one segment. MPEG-TS can be read while it is still
+    being written, unlike mp4, whose index is only written when it is closed.
+    """
+    return (
+        "appsrc ! videoconvert ! "
+        f"x264enc tune=zerolatency bitrate={bitrate} speed-preset=ultrafast key-int-max={int(fps)} ! "
+        f"mpegtsmux ! filesink location={segment_path}"
+    )
+
+
+# --------------------------------
+# Continuous Recording
+# --------------------------------
+class ContinuousRecorder:
+    """
+    Segmented recording branch of a LiveCamera.
+
+    A trigger (the API or a recognition event) starts a session in its own
+    folder, cut into `segment_seconds` MPEG-TS files. The session's
+    index.m3u8 lists every finished segment, so both the segments and the
+    index can be read (or played as an HLS event playlist) while the
+    session is still going.
+
+    One thread takes frames from the camera and hands them to a writer
+    thread, which does the encoding. With `preroll_seconds`, the last
+    seconds before a trigger are kept in memory as JPEG frames and the
+    writer starts with them; frames arriving while it works through that
+    backlog are JPEG-encoded onto it too rather than dropped. Once it has
+    caught up, live frames go through a leaky queue of `max_queue` frames.
+
+    Segments run at the nominal `fps`, paced by the frames' capture
+    timestamps: a frame is repeated or skipped as needed, so playback time
+    and the index durations match real time however fast the camera runs.
+    """
+
+    def __init__(self, camera, folder, fps, frame_size, preroll_seconds=PREROLL_SECONDS,
+                 segment_seconds=SEGMENT_SECONDS, max_queue=RECORD_QUEUE):
+        self.camera = camera
+        self.folder = folder
+        self.fps = fps
+        self.frame_size = frame_size
+        self.preroll_seconds = preroll_seconds
+        self.segment_seconds = segment_seconds
+        self.max_queue = max_queue
+        # Room for the pre-roll plus as long again of frames that arrive while it is written
+        self.max_backlog = max(max_queue, int(2 * fps * preroll_seconds))
+        self.session = None
+        self.sessions = 0
+        self.segments = 0
+        self.preroll_buffered = 0.0
+        self.frames_dropped = 0
+        self._preroll = collections.deque()
+        self._stop_at = None
+        self._reason = None
+        self._lock = threading.Lock()
+        # (session key, timestamp, image, jpeg) waiting for the writer; one of image/jpeg is None.
+        # The key is (session number, folder): two sessions may start in the same second
+        self._pending = collections.deque()
+        self._pending_cond = threading.Condition()
+        self._closed = False
+        self._writing = None
+        self._finished = None
+        self._writer = None
+        self._segment_start = None
+        self._segment_clock = None
+        self._segment_frames = 0
+        self._subscription = None
+        self._threads = []
+
+    def start(self):
+        """Start the capture and writer threads. Returns self."""
+        self._subscription = self.camera.subscribe(self.max_queue)
+        self._threads = [
+            threading.Thread(target=self._run, name=f"{self.camera.name}-preroll", daemon=True),
+            threading.Thread(target=self._write_pending, name=f"{self.camera.name}-segments", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def close(self):
+        """Finish any session and stop buffering."""
+        self.camera.unsubscribe(self._subscription)
+        for thread in self._threads:
+            thread.join()
+
+    @property
+    def recording(self):
+        return self.session is not None
+
+    @property
+    def dropped(self):
+        return (self._subscription.dropped if self._subscription else 0) + self.frames_dropped
+
+    def trigger(self, reason, duration=None):
+        """
+        Start a session (or extend the current one) so that it runs for at
+        least `duration` more seconds, or until stop() when duration is None.
+        Returns the session folder.
+        """
+        with self._lock:
+            stop_at = time.time() + duration if duration is not None else None
+            if self.session is None:
+                self.sessions += 1
+                session = os.path.join(self.folder, f"session_{time.strftime('%Y%m%d-%H%M%S')}")
+                # A second session in the same second gets its own folder
+                self.session = session if not os.path.exists(session) else f"{session}_{self.sessions}"
+                self._reason = reason
+                self._stop_at = stop_at
+            elif self._stop_at is not None:
+                self._stop_at = None if stop_at is None else max(self._stop_at, stop_at)
+            return self.session
+
+    def stop(self):
+        """End the current session after the frame being written (no-op when idle)."""
+        with self._lock:
+            if self.session is not None:
+                self._stop_at = 0
+
+    def status(self):
+        return {"recording": self.recording, "session": self.session, "segments": self.segments,
+                "preroll_seconds": round(self.preroll_buffered, 1), "backlog": len(self._pending),
+                "dropped": self.dropped}
+
+    # -- capture thread --
+
+    def _run(self):
+        try:
+            for frame in self._subscription:
+                with self._lock:
+                    session = (self.sessions, self.session) if self.session is not None else None
+                if session is None:
+                    self._buffer(frame)
+                else:
+                    self._hand_off(session, frame)
+        finally:
+            with self._pending_cond:
+                self._closed = True
+                self._pending_cond.notify()
+
+    def _jpeg(self, frame):
+        if frame.jpeg is not None:
+            return frame.jpeg
+        ok, buffer = cv2.imencode('.jpg', frame.image, [cv2.IMWRITE_JPEG_QUALITY, PREROLL_QUALITY])
+        return buffer.tobytes() if ok else None
+
+    def _buffer(self, frame):
+        if not self.preroll_seconds:
+            return
+        jpeg = self._jpeg(frame)
+        if jpeg is None:
+            return
+        self._preroll.append((frame.timestamp, jpeg))
+        while self._preroll[0][0] < frame.timestamp - self.preroll_seconds:
+            self._preroll.popleft()
+        self.preroll_buffered = frame.timestamp - self._preroll[0][0]
+
+    def _hand_off(self, session, frame):
+        with self._pending_cond:
+            if self._preroll:
+                # First frame of the session: the pre-roll goes ahead of it
+                self._pending.extend((session, timestamp, None, jpeg) for timestamp, jpeg in self._preroll)
+                self._preroll = collections.deque()
+                self.preroll_buffered = 0.0
+            backlog = self._pending and self._pending[-1][3] is not None
+        if backlog:
+            # The writer is still on the pre-roll; keep the frame in the same compact form
+            jpeg = self._jpeg(frame)
+            if jpeg is None:
+                return
+            item, limit = (session, frame.timestamp, None, jpeg), self.max_backlog
+        else:
+            item, limit = (session, frame.timestamp, frame.image, None), self.max_queue
+        with self._pending_cond:
+            if len(self._pending) >= limit:
+                self._pending.popleft()
+                self.frames_dropped += 1
+                FRAMES_DROPPED.inc()
+            self._pending.append(item)
+            self._pending_cond.notify()
+
+    # -- writer thread --
+
+    def _write_pending(self):
+        try:
+            while True:
+                with self._pending_cond:
+                    self._pending_cond.wait_for(lambda: self._pending or self._closed)
+                    if not self._pending:
+                        return
+                    session, timestamp, image, jpeg = self._pending.popleft()
+                if session == self._finished:
+                    continue  # queued just before its session ended
+                if session != self._writing:
+                    self._begin(session)
+                if image is None:
+                    image = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+                self._write(timestamp, image)
+                with self._lock:
+                    stop_at = self._stop_at
+                if stop_at is not None and timestamp >= stop_at:
+                    self._end()
+        finally:
+            if self._writing is not None:
+                self._end()
+
+    def _begin(self, session):
+        self._writing = session
+        folder = session[1]
+        os.makedirs(folder, exist_ok=True)
+        self.segments = 0
+        with self._lock:
+            reason = self._reason
+        with open(os.path.join(folder, INDEX_FILE), "w") as index:
+            index.write("#EXTM3U\n#EXT-X-VERSION:3\n")
+            index.write(f"#EXT-X-TARGETDURATION:{math.ceil(self.segment_seconds)}\n")
+            index.write("#EXT-X-MEDIA-SEQUENCE:0\n#EXT-X-PLAYLIST-TYPE:EVENT\n")
+            index.write(f"# trigger: {reason}\n")
+        print(f"Recording {folder} ({reason}), {len(self._pending)} frames queued")
+
+    def _write(self, timestamp, image):
+        if self._writer is not None and timestamp - self._segment_clock >= self.segment_seconds:
+            self._close_segment()
+        if self._writer is None:
+            self._open_segment(timestamp)
+        # Frames due by now at the nominal rate: a late frame is repeated to fill in, an early one skipped
+        due = round((timestamp - self._segment_clock) * self.fps) + 1
+        if due - self._segment_frames > self.fps * MAX_GAP_SECONDS:
+            # A stall: carry on right after the last frame instead of showing a still for its length
+            self._segment_clock += (due - self._segment_frames - 1) / self.fps
+            due = self._segment_frames + 1
+        while self._segment_frames < due:
+            self._writer.write(image)
+            self._segment_frames += 1
+
+    def _open_segment(self, timestamp):
+        path = os.path.join(self._writing[1], f"segment_{self.segments:05d}.ts")
+        self._writer = cv2.VideoWriter(gst_segment_pipeline(path, self.fps), cv2.CAP_GSTREAMER, 0,
+                                       self.fps, self.frame_size, True)
+        if not self._writer.isOpened():
+            print(f"Error: Could not open recording pipeline for {path}.")
+        self._segment_start = timestamp
+        self._segment_clock = timestamp
+        self._segment_frames = 0
+
+    def _close_segment(self):
+        # Releasing the writer sends EOS; only then is the segment added to the index
+        self._writer.release()
+        self._writer = None
+        name = f"segment_{self.segments:05d}.ts"
+        started = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self._segment_start))
+        with open(os.path.join(self._writing[1], INDEX_FILE), "a") as index:
+            index.write(f"#EXT-X-PROGRAM-DATE-TIME:{started}{time.strftime('%z')}\n")
+            index.write(f"#EXTINF:{self._segment_frames / self.fps:.3f},\n{name}\n")
+        self.segments += 1
+
+    def _end(self):
+        if self._writer is not None:
+            self._close_segment()
+        with open(os.path.join(self._writing[1], INDEX_FILE), "a") as index:
+            index.write("#EXT-X-ENDLIST\n")
+        print(f"Recording {self._writing[1]} finished: {self.segments} segments")
+        self._finished, self._writing = self._writing, None
+        with self._lock:
+            self.session = None
+            self._stop_at = None
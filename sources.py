@@ -0,0 +1,306 @@
+import collections
+import os
+import sys
+import time
+from urllib.parse import parse_qsl
+import cv2
+import numpy as np
+from metrics import FRAME_READ_FAILURES, FRAMES_CAPTURED, STAGE_SECONDS
+
+# Camera sources: where a CameraBroadcaster or LiveCamera gets its frames.
+# Apps name their camera with a spec string:
+#     v4l2:/dev/video1?width=1280&height=720&fps=30&fourcc=MJPG   (or v4l2:1)
+#     gst:nvarguscamerasrc ! ... ! video/x-raw,format=BGR
+#     file:../ateam/videos?loop=1&fps=30&width=1280&height=720
+# and setting CAMERA_SOURCE overrides it, so any server can be load-tested
+# or benchmarked from recorded video on a machine with no camera:
+#     CAMERA_SOURCE="file:../ateam/videos" python app.py
+SOURCE_ENV = "CAMERA_SOURCE"
+
+# Frame buffers a source allocates up front, and the most it will grow to
+# while consumers still hold on to older frames
+POOL_BUFFERS = 8
+MAX_POOL_BUFFERS = 64
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov", ".ts")
+
+CAPTURE_SECONDS = STAGE_SECONDS.labels("capture")
+
+# One frame from a source. `seq` counts frames read since the source was
+# opened, from 1; `timestamp` is the wall-clock time it was captured (for
+# replay, when it was due). `image` is a read-only view of a pooled buffer:
+# keep it as long as needed, but copy it before drawing on it.
+SourceFrame = collections.namedtuple("SourceFrame", ["seq", "timestamp", "image"])
+
+
+def gst_appsink_pipeline(source):
+    """
+    Finish a GStreamer source description with an appsink OpenCV can read from.
+    drop/max-buffers keep only the newest buffer so reads are never stale.
+    """
+    return f"{source} ! appsink drop=true max-buffers=1 sync=false"
+
+
+# --------------------------------
+# Frame Buffer Pool
+# --------------------------------
+class FramePool:
+    """
+    Reusable frame buffers, so a steady stream of frames does not allocate
+    (and page-fault in) a new multi-megabyte array for every frame.
+
+    Frames are handed out as read-only views of a buffer. A buffer is only
+    reused once no view of it is alive anywhere, which CPython's reference
+    count tells exactly, so a consumer holding a frame (a recording queue, a
+    slow viewer) can never see it overwritten. When every buffer is busy the
+    pool grows, up to max_buffers; past that, frames get unpooled buffers.
+    """
+
+    # The pool's list and getrefcount()'s own argument
+    FREE_REFS = 2
+
+    def __init__(self, shape, dtype=np.uint8, count=POOL_BUFFERS, max_buffers=MAX_POOL_BUFFERS):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.max_buffers = max_buffers
+        self.buffers = [np.empty(self.shape, self.dtype) for _ in range(count)]
+        self.allocated = count
+        self._next = 0
+
+    def acquire(self):
+        """A buffer no frame refers to any more (or a fresh one)."""
+        for _ in range(len(self.buffers)):
+            i = self._next
+            self._next = (i + 1) % len(self.buffers)
+            if sys.getrefcount(self.buffers[i]) <= self.FREE_REFS:
+                return self.buffers[i]
+        buffer = np.empty(self.shape, self.dtype)
+        self.allocated += 1
+        if len(self.buffers) < self.max_buffers:
+            self.buffers.append(buffer)
+        return buffer
+
+    def fits(self, image):
+        return image.shape == self.shape and image.dtype == self.dtype
+
+    @staticmethod
+    def view(buffer):
+        view = buffer.view()
+        view.flags.writeable = False
+        return view
+
+
+# --------------------------------
+# Sources
+# --------------------------------
+class FrameSource:
+    """
+    Base class for camera backends read through OpenCV. Subclasses provide
+    _open_capture(); read() decodes straight into a pooled buffer.
+
+    open() -> bool, read() -> SourceFrame or None (no frame this time),
+    close(). One thread reads a source; a closed source can be reopened.
+    """
+
+    def __init__(self, pool_buffers=POOL_BUFFERS):
+        self.pool_buffers = pool_buffers
+        self.seq = 0
+        self._cap = None
+        self._pool = None
+
+    def _open_capture(self):
+        raise NotImplementedError
+
+    def open(self):
+        self._cap = self._open_capture()
+        self.seq = 0
+        if not self._cap.isOpened():
+            self.close()
+            return False
+        return True
+
+    @property
+    def opened(self):
+        return self._cap is not None
+
+    def read(self):
+        start = time.perf_counter()
+        image = self._read_into(self._pool.acquire() if self._pool is not None else None)
+        if image is None:
+            FRAME_READ_FAILURES.inc()
+            return None
+        CAPTURE_SECONDS.observe_since(start)
+        FRAMES_CAPTURED.inc()
+        self.seq += 1
+        return SourceFrame(self.seq, time.time(), FramePool.view(image))
+
+    def _read_into(self, buffer):
+        """Read the next frame into `buffer` (None before the pool exists); the filled array or None."""
+        ok, image = self._cap.read(buffer) if buffer is not None else self._cap.read()
+        if not ok or image is None:
+            return None
+        return self._pooled(image)
+
+    def _pooled(self, image):
+        """Make `image` part of the pool, starting a new pool on the first frame or a size change."""
+        if self._pool is None or not self._pool.fits(image):
+            self._pool = FramePool(image.shape, image.dtype, self.pool_buffers)
+            self._pool.buffers[0] = image
+        return image
+
+    def close(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+
+class V4L2Source(FrameSource):
+    """A V4L2 device (an index or /dev/videoN), optionally asking for a size, rate and pixel format."""
+
+    def __init__(self, device=0, width=None, height=None, fps=None, fourcc=None, **kwargs):
+        super().__init__(**kwargs)
+        self.device = int(device) if str(device).isdigit() else device
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.fourcc = fourcc
+
+    def _open_capture(self):
+        cap = cv2.VideoCapture(self.device, cv2.CAP_V4L2)
+        if self.fourcc:
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc))
+        if self.width:
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        if self.height:
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        if self.fps:
+            cap.set(cv2.CAP_PROP_FPS, self.fps)
+        # Only the newest frame is wanted; a deep driver queue just adds latency
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+
+
+class GStreamerSource(FrameSource):
+    """A GStreamer pipeline producing BGR frames; an appsink is added unless it has one."""
+
+    def __init__(self, pipeline, **kwargs):
+        super().__init__(**kwargs)
+        self.pipeline = pipeline if "appsink" in pipeline else gst_appsink_pipeline(pipeline)
+
+    def _open_capture(self):
+        return cv2.VideoCapture(self.pipeline, cv2.CAP_GSTREAMER)
+
+
+class FileSource(FrameSource):
+    """
+    Replays video files as if they were a camera: one file, or every video
+    in a folder (recursively, in name order). Frames are delivered at the
+    file's own frame rate, or `fps` if given (0 = as fast as they decode),
+    and the files start over when `loop` is set. width/height scale every
+    frame to one size, for folders with mixed resolutions.
+    """
+
+    def __init__(self, path, loop=True, fps=None, width=None, height=None, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.loop = loop
+        self.fps = fps
+        self.size = (int(width), int(height)) if width and height else None
+        self.files = []
+        self._index = 0
+        self._interval = 0.0
+        self._due = 0.0
+        self._decoded = None
+
+    def _list_files(self):
+        if not os.path.isdir(self.path):
+            return [self.path]
+        files = []
+        for root, dirs, names in os.walk(self.path):
+            files.extend(os.path.join(root, name) for name in names if name.lower().endswith(VIDEO_EXTENSIONS))
+        return sorted(files)
+
+    def _open_capture(self):
+        self.files = self._list_files()
+        self._index = 0
+        self._due = time.monotonic()
+        return self._open_file()
+
+    def _open_file(self):
+        cap = cv2.VideoCapture(self.files[self._index]) if self.files else cv2.VideoCapture()
+        fps = self.fps if self.fps is not None else cap.get(cv2.CAP_PROP_FPS) or 30
+        self._interval = 1.0 / fps if fps else 0.0
+        return cap
+
+    def _next_file(self):
+        """Move on to the next file (wrapping around when looping); False at the end."""
+        self._cap.release()
+        self._index += 1
+        if self._index >= len(self.files):
+            if not self.loop:
+                self._cap = cv2.VideoCapture()
+                return False
+            self._index = 0
+        self._cap = self._open_file()
+        return True
+
+    def _read_into(self, buffer):
+        for _ in range(len(self.files) + 1):
+            if self.size is None:
+                image = super()._read_into(buffer)
+            else:
+                # Decode into a scratch frame, then scale straight into the pooled buffer
+                ok, self._decoded = self._cap.read(self._decoded)
+                image = self._pooled(cv2.resize(self._decoded, self.size, dst=buffer)) if ok else None
+            if image is not None:
+                break
+            if not self._next_file():
+                return None
+        else:
+            return None
+        # Hold each frame back until it is due, like a live camera would
+        self._due = max(self._due + self._interval, time.monotonic() - self._interval)
+        delay = self._due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return image
+
+
+# --------------------------------
+# Source Specs
+# --------------------------------
+BACKENDS = {"v4l2": V4L2Source, "gst": GStreamerSource, "file": FileSource}
+
+
+def _option(value):
+    if value.isdigit():
+        return int(value)
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def make_source(spec):
+    """Build (but do not open) the source a spec string names; see the top of this module."""
+    backend, _, target = spec.partition(":")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown camera source {spec!r}: expected one of {', '.join(BACKENDS)}")
+    if backend == "gst":
+        # Pipelines are taken verbatim; they have no options
+        return GStreamerSource(target)
+    target, _, query = target.partition("?")
+    options = {key: _option(value) for key, value in parse_qsl(query)}
+    if "loop" in options:
+        options["loop"] = bool(options["loop"])
+    return BACKENDS[backend](target, **options)
+
+
+def camera_source(default_spec):
+    """
+    The open_source callable for a CameraBroadcaster or LiveCamera: a new
+    source for `default_spec`, or for $CAMERA_SOURCE when that is set.
+    """
+    spec = os.environ.get(SOURCE_ENV) or default_spec
+    make_source(spec)  # Fail at startup on a bad spec, not on the first viewer
+    print(f"Camera source: {spec}")
+    return lambda: make_source(spec)
@@ -0,0 +1,213 @@
+import collections
+import threading
+import time
+import cv2
+from metrics import STAGE_SECONDS, STREAM_CLIENTS
+
+# Per-client MJPEG adaptation. Each client starts on the best quality tier
+# and moves down a tier when it cannot drain frames as fast as the camera
+# produces them, or back up once it has had headroom for a while. A client's
+# caps limit every tier separately (size, quality, frame rate) rather than
+# picking one, so ?width=320 still gets full quality at the camera's rate.
+
+# scale: downscale factor, quality: JPEG quality (None = the camera's own
+# encoding), fps: frame rate limit (None = camera rate)
+Tier = collections.namedtuple("Tier", ["scale", "quality", "fps"])
+QUALITY_TIERS = [
+    Tier(1.0, None, None),
+    Tier(1.0, 70, None),
+    Tier(0.75, 60, None),
+    Tier(0.5, 50, None),
+    Tier(0.5, 40, 10),
+    Tier(0.25, 40, 5),
+]
+# OpenCV's quality when none is given, used to apply a quality cap to a tier
+DEFAULT_QUALITY = 95
+
+# Sending a frame taking more than this share of the frame interval means the client is falling behind
+SLOW_LOAD = 0.8
+# ... and less than this share means it has room for a better tier
+FAST_LOAD = 0.3
+# Frames to wait after a tier change before stepping down / up again
+STEP_DOWN_AFTER = 5
+STEP_UP_AFTER = 90
+# Weight of the newest sample in the moving averages
+SMOOTHING = 0.2
+
+# Explicit client limits from the query string (?width=640&fps=10&quality=50); None = no limit
+StreamCaps = collections.namedtuple("StreamCaps", ["width", "fps", "quality"], defaults=[None, None, None])
+
+JPEG_SECONDS = STAGE_SECONDS.labels("jpeg_encode")
+MJPEG_CLIENTS = STREAM_CLIENTS.labels("mjpeg")
+
+
+def mjpeg_part(jpeg):
+    """Wrap JPEG bytes as one part of a multipart/x-mixed-replace stream."""
+    return b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n'
+
+
+def stream_caps(args):
+    """StreamCaps from request arguments; missing, malformed or non-positive values mean no limit."""
+    def positive_int(key):
+        try:
+            value = int(args.get(key))
+        except (TypeError, ValueError):
+            return None
+        return value if value > 0 else None
+    return StreamCaps(positive_int("width"), positive_int("fps"), positive_int("quality"))
+
+
+# --------------------------------
+# Shared Encodings
+# --------------------------------
+class VariantCache:
+    """
+    Encoded variants of the newest frames, one per quality tier, shared by
+    every client of a source: each tier of each frame is encoded at most
+    once however many clients are on it.
+    """
+
+    def __init__(self):
+        self.encoded = 0
+        self._variants = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def cached(self, frame, tier):
+        """The variant if it needs no encoding (already made, or the camera's own JPEG), else None."""
+        if tier.scale == 1 and tier.quality is None and frame.jpeg is not None:
+            return frame.jpeg
+        with self._lock:
+            return self._variants.get((frame.seq, tier.scale, tier.quality))
+
+    def jpeg(self, frame, tier):
+        cached = self.cached(frame, tier)
+        if cached is not None:
+            return cached
+        key = (frame.seq, tier.scale, tier.quality)
+
+        image = frame.image
+        start = time.perf_counter()
+        if tier.scale != 1:
+            image = cv2.resize(image, None, fx=tier.scale, fy=tier.scale, interpolation=cv2.INTER_AREA)
+        ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, tier.quality or DEFAULT_QUALITY])
+        JPEG_SECONDS.observe_since(start)
+        if not ok:
+            return frame.jpeg
+        jpeg = buffer.tobytes()
+        with self._lock:
+            if frame.seq < self._seq - 1:
+                # The source started counting again; none of the cached frames are current
+                self._variants = {}
+                self._seq = frame.seq
+            elif frame.seq > self._seq:
+                # Slow clients may still ask for the previous frame; anything older is dropped
+                self._seq = frame.seq
+                self._variants = {k: v for k, v in self._variants.items() if k[0] >= frame.seq - 1}
+            self._variants[key] = jpeg
+            self.encoded += 1
+        return jpeg
+
+
+# --------------------------------
+# Per-Client Pacing
+# --------------------------------
+class ClientPacer:
+    """
+    Picks the tier and frame rate for one client.
+
+    The time a yielded part takes to come back is how long the server took
+    to write it to the client's socket, so it measures how fast the client
+    drains frames. That send time, as a share of the camera's frame
+    interval, decides when to step down or back up a tier. Caps are
+    applied to each tier once the frame width is known, and tiers that
+    come out the same are merged so every step changes what is sent.
+    """
+
+    def __init__(self, caps=None, tiers=QUALITY_TIERS):
+        self.caps = caps or StreamCaps()
+        self.tiers = tiers
+        self.tier = None
+        self._send = 0.0
+        self._interval = None
+        self._last = None
+        self._last_sent = None
+        self._since_change = 0
+        self._dropped = 0
+
+    def _capped(self, tier, width):
+        """`tier` with the client's size, quality and frame rate caps applied."""
+        scale, quality, fps = tier
+        if self.caps.width and width * scale > self.caps.width:
+            scale = self.caps.width / width
+        if self.caps.quality and (quality or DEFAULT_QUALITY) > self.caps.quality:
+            quality = self.caps.quality
+        if self.caps.fps:
+            fps = min(fps or self.caps.fps, self.caps.fps)
+        return Tier(scale, quality, fps)
+
+    def _fps(self):
+        return self.tiers[self.tier].fps
+
+    @property
+    def current(self):
+        return self.tiers[self.tier]
+
+    def want(self, frame):
+        """Whether this frame should be sent, given the client's frame rate limit."""
+        if self.tier is None:
+            width = frame.image.shape[1]
+            self.tiers = list(dict.fromkeys(self._capped(tier, width) for tier in self.tiers))
+            self.tier = 0
+        if self._last is not None and frame.seq > self._last.seq:
+            interval = (frame.timestamp - self._last.timestamp) / (frame.seq - self._last.seq)
+            self._interval = interval if self._interval is None else \
+                self._interval + SMOOTHING * (interval - self._interval)
+        self._last = frame
+
+        fps = self._fps()
+        if fps and self._last_sent is not None:
+            # Half a camera interval of slack so a 10 fps limit does not become 7.5 fps at 30 fps
+            slack = (self._interval or 0) / 2
+            if frame.timestamp - self._last_sent < 1 / fps - slack:
+                return False
+        self._last_sent = frame.timestamp
+        return True
+
+    def sent(self, seconds, dropped=0):
+        """Record how long the last frame took to send and adjust the tier."""
+        self._send += SMOOTHING * (seconds - self._send)
+        self._since_change += 1
+        fell_behind = dropped > self._dropped
+        self._dropped = dropped
+        if not self._interval:
+            return
+        fps = self._fps()
+        load = self._send / (max(self._interval, 1 / fps) if fps else self._interval)
+        if (load > SLOW_LOAD or fell_behind) and self._since_change >= STEP_DOWN_AFTER \
+                and self.tier < len(self.tiers) - 1:
+            self.tier += 1
+            self._since_change = 0
+        elif load < FAST_LOAD and self._since_change >= STEP_UP_AFTER and self.tier > 0:
+            self.tier -= 1
+            self._since_change = 0
+
+
+def adaptive_mjpeg(frames, variants, caps=None, dropped=None):
+    """
+    Multipart MJPEG parts for one client from an iterable of frames, at the
+    tier and frame rate its ClientPacer settles on. `dropped`, if given,
+    returns how many frames the client's queue has dropped so far.
+    """
+    pacer = ClientPacer(caps)
+    MJPEG_CLIENTS.inc()
+    try:
+        for frame in frames:
+            if not pacer.want(frame):
+                continue
+            part = mjpeg_part(variants.jpeg(frame, pacer.current))
+            start = time.perf_counter()
+            yield part
+            pacer.sent(time.perf_counter() - start, dropped() if dropped else 0)
+    finally:
+        MJPEG_CLIENTS.dec()
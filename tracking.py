@@ -0,0 +1,142 @@
+import itertools
+import time
+from detection import DetectionPipeline
+from gallery import TOLERANCE
+from recognition import MATCH_SECONDS, MATCH_TOP_K, face_result
+
+# A detection continues a track when their boxes overlap at least this much
+TRACK_IOU = 0.3
+# Frames a track may go undetected before it (and its cached identity) is dropped
+MAX_MISSED = 5
+# Re-encode a track once its box overlaps the box it was last encoded at by less than this
+DRIFT_IOU = 0.5
+# Seconds before a track's identity is verified again even if it has not moved
+REVERIFY_SECONDS = 3.0
+
+
+def iou(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes."""
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    inter = max(0, right - left) * max(0, bottom - top)
+    if not inter:
+        return 0.0
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    return inter / float(area_a + area_b - inter)
+
+
+class Track:
+    """One face followed across frames, with the identity it was last recognized as."""
+
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box
+        self.missed = 0
+        # Set each time the face is encoded and matched
+        self.face = None
+        self.verified_box = None
+        self.verified_at = 0.0
+
+
+# --------------------------------
+# Face Tracker
+# --------------------------------
+class FaceTracker:
+    """
+    Live recognition that only encodes faces when it has to.
+
+    Every frame is still run through detection, and each detected box is
+    associated with an existing track by greedy IoU. The 128-d encoding and
+    gallery match only run for tracks that are new, have drifted away from
+    where they were last encoded, are due for periodic re-verification, or
+    were recognized against an older gallery. All other faces reuse the
+    identity cached on their track, which is forgotten once the track dies.
+
+    Not thread-safe: use one tracker per video stream, from one thread.
+    """
+
+    def __init__(self, pipeline=None, track_iou=TRACK_IOU, max_missed=MAX_MISSED,
+                 drift_iou=DRIFT_IOU, reverify_seconds=REVERIFY_SECONDS):
+        self.pipeline = pipeline or DetectionPipeline()
+        self.track_iou = track_iou
+        self.max_missed = max_missed
+        self.drift_iou = drift_iou
+        self.reverify_seconds = reverify_seconds
+        self.tracks = []
+        self.encoded = 0
+        self.reused = 0
+        self._ids = itertools.count(1)
+        self._gallery = None
+
+    def _associate(self, boxes):
+        """Pair detections with tracks, best overlap first. Returns {box index: track}."""
+        pairs = sorted(((iou(track.box, box), t, b) for t, track in enumerate(self.tracks)
+                        for b, box in enumerate(boxes)), reverse=True)
+        assigned = {}
+        used = set()
+        for overlap, t, b in pairs:
+            if overlap < self.track_iou:
+                break
+            if t in used or b in assigned:
+                continue
+            assigned[b] = self.tracks[t]
+            used.add(t)
+        return assigned
+
+    def _stale(self, track, now, gallery_changed):
+        return (track.face is None or gallery_changed
+                or iou(track.box, track.verified_box) < self.drift_iou
+                or now - track.verified_at >= self.reverify_seconds)
+
+    def update(self, image, gallery, tolerance=TOLERANCE, timings=None, now=None):
+        """
+        Track and recognize the faces in the next RGB frame of the stream.
+        Returns the same per-face dicts as recognize_images, plus track_id.
+        """
+        timings = timings if timings is not None else {}
+        now = time.monotonic() if now is None else now
+        boxes = self.pipeline.detect([image], timings)[0]
+
+        assigned = self._associate(boxes)
+        for track in self.tracks:
+            if track not in assigned.values():
+                track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+
+        visible = []
+        for b, box in enumerate(boxes):
+            track = assigned.get(b)
+            if track is None:
+                track = Track(next(self._ids), box)
+                self.tracks.append(track)
+            track.box = box
+            track.missed = 0
+            visible.append(track)
+
+        gallery_changed = gallery is not self._gallery
+        self._gallery = gallery
+        stale = [track for track in visible if self._stale(track, now, gallery_changed)]
+        if stale:
+            encodings = self.pipeline.encode([image], [[track.box for track in stale]], timings)[0]
+            start = time.perf_counter()
+            matches = gallery.match(encodings, tolerance, top_k=MATCH_TOP_K)
+            timings["match"] = timings.get("match", 0.0) + (time.perf_counter() - start) * 1000
+            MATCH_SECONDS.observe_since(start)
+            for track, match in zip(stale, matches):
+                track.face = face_result(track.box, match)
+                track.verified_box = track.box
+                track.verified_at = now
+        self.encoded += len(stale)
+        self.reused += len(visible) - len(stale)
+
+        # Cached identities are reported at the box the face is at now
+        return [dict(track.face, box=_box_dict(track.box), track_id=track.id) for track in visible]
+
+    def stats(self):
+        return {"tracks": len(self.tracks), "encoded": self.encoded, "reused": self.reused}
+
+
+def _box_dict(box):
+    top, right, bottom, left = box
+    return {"top": top, "right": right, "bottom": bottom, "left": left}
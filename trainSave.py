@@ -1,27 +1,22 @@
-import face_recognition
 import cv2
 import os
-import pickle
+import sys
+from training import train_incremental
 print(cv2.__version__)
 
-Encodings = []
-Names = [] 
 image_dir = r'/home/checkout/Documents/hgn/HGNspring2024/demoImages-master/known'
 
 
-for root, dirs, files in os.walk(image_dir):
-    print(files)
-    for file in files:
-        path = os.path.join(root, file)
-        print(path)
-        name = os.path.splitext(file)[0]
-        print(name)
-        person = face_recognition.load_image_file(path)
-        encoding = face_recognition.face_encodings(person)[0]
-        Encodings.append(encoding)
-        Names.append(name)
-print(Names)
+# Photos here are named after the person (trump.jpg -> trump)
+def name_from_file(file):
+    return os.path.splitext(file)[0]
 
-with open('train.pkl', 'wb') as f:
-    pickle.dump(Names, f)
-    pickle.dump(Encodings, f)
+
+# Encoding fans out to worker processes, which import this module again
+if __name__ == '__main__':
+    # Only new or changed photos are encoded; pass --full to re-encode everything.
+    # Photos without a face end up in the report instead of stopping the run.
+    gallery, report = train_incremental(image_dir, 'train.gal', name_fn=name_from_file, full='--full' in sys.argv[1:])
+    print(gallery.names)
+    for failure in report['failures']:
+        print(f"Skipped {failure['path']}: {failure['reason']}")
@@ -0,0 +1,425 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+import numpy as np
+import face_recognition
+from ann_index import build_index, index_path
+from gallery import Gallery, load_gallery, open_gallery, save_gallery
+
+IMAGE_EXTENSIONS = (".jpg", ".png")
+
+
+def name_from_file(file):
+    """Photos are saved as <name>_<n>.jpg by the capture apps (william_1 -> william)."""
+    return file.split("_")[0]
+
+
+def name_error(name):
+    """Why `name` cannot be enrolled, or None. name_from_file() has to read it back from <name>_<n>.jpg."""
+    if not name:
+        return "Name is required!"
+    if "_" in name:
+        return "Name cannot contain '_'."
+    if "/" in name or "\\" in name or name.startswith("."):
+        return "Name cannot contain '/', '\\' or start with '.'."
+    return None
+
+
+def enrolled_photos(image_dir, name):
+    """The photos an enrollment of `name` saved: exactly <name>_<n>.jpg at the top of image_dir."""
+    pattern = re.compile(re.escape(name) + r"_\d+\.jpg")
+    return [rel_path for rel_path in scan_images(image_dir) if pattern.fullmatch(rel_path)]
+
+
+def manifest_path(gallery_file):
+    """The manifest lives next to the gallery: train.gal -> train.manifest.json."""
+    return os.path.splitext(gallery_file)[0] + ".manifest.json"
+
+
+def file_hash(path):
+    """SHA-1 of the file contents, read in chunks."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def encode_image(path):
+    """Return the encoding of the first face in the image, or None if there is none."""
+    image = face_recognition.load_image_file(path)
+    encodings = face_recognition.face_encodings(image)
+    if not encodings:
+        return None
+    return encodings[0]
+
+
+def _encode_chunk(paths):
+    """
+    Worker: encode a chunk of photos. Returns (path, encoding, error) tuples;
+    a photo that fails carries None and the reason instead of raising.
+    """
+    results = []
+    for path in paths:
+        try:
+            encoding = encode_image(path)
+        except Exception as e:
+            results.append((path, None, f"unreadable: {e}"))
+            continue
+        if encoding is None:
+            results.append((path, None, "no face found"))
+        else:
+            results.append((path, np.asarray(encoding, dtype=np.float32), None))
+    return results
+
+
+def print_progress(done, total, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0.0
+    print(f"Encoded {done}/{total} photos ({rate:.1f} photos/s)")
+
+
+# --------------------------------
+# Parallel Encoding
+# --------------------------------
+def encode_images(paths, workers=None, chunk_size=8, progress=print_progress):
+    """
+    Encode photos across a process pool.
+
+    Work goes out in chunks of chunk_size photos, and at most two chunks per
+    worker are in flight at once, so memory stays bounded however many photos
+    there are. Returns {path: (encoding, error)}; the result does not depend
+    on the worker count or on the order chunks finish in.
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    results = {}
+    start = time.monotonic()
+
+    def collect(chunk_results):
+        for path, encoding, error in chunk_results:
+            results[path] = (encoding, error)
+        if progress:
+            progress(len(results), len(paths), time.monotonic() - start)
+
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            collect(_encode_chunk(chunk))
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for chunk in chunks:
+            if len(pending) >= 2 * workers:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    collect(future.result())
+            pending.add(pool.submit(_encode_chunk, chunk))
+        for future in as_completed(pending):
+            collect(future.result())
+    return results
+
+
+def scan_images(image_dir):
+    """Map each image path (relative to image_dir) to its os.stat result."""
+    images = {}
+    for root, dirs, files in os.walk(image_dir):
+        for file in files:
+            if not file.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(root, file)
+            images[os.path.relpath(path, image_dir)] = os.stat(path)
+    return images
+
+
+def load_manifest(gallery_file):
+    """Return the saved manifest, or an empty one if there is no usable manifest."""
+    try:
+        with open(manifest_path(gallery_file)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}, "rows": []}
+
+
+def _legacy_manifest(gallery, manifest):
+    """
+    The manifest to use with `gallery`. A gallery with rows but no manifest
+    was converted from train.pkl (or is train.pkl itself): no photo is known
+    to stand behind its rows, which the manifest lists as None. Such legacy
+    rows are kept for every person who has no photo rows of their own.
+    """
+    if len(gallery) and not manifest["rows"]:
+        return {"files": {}, "rows": [None] * len(gallery)}
+    return manifest
+
+
+def _legacy_rows(gallery, manifest, photo_names):
+    """(name, encoding) of the legacy rows to keep next to rows for the people in photo_names."""
+    return [(gallery.name_of(row), gallery.encodings[row]) for row, rel_path in enumerate(manifest["rows"])
+            if rel_path is None and gallery.name_of(row) not in photo_names]
+
+
+def save_manifest(manifest, gallery_file):
+    _write_json(manifest, manifest_path(gallery_file))
+
+
+def report_path(gallery_file):
+    """The last run's report lives next to the gallery: train.gal -> train.report.json."""
+    return os.path.splitext(gallery_file)[0] + ".report.json"
+
+
+@contextlib.contextmanager
+def gallery_lock(gallery_file):
+    """
+    Exclusive lock for one read-modify-write of gallery_file and its
+    manifest, held across processes (face_rec.py and a running server).
+    """
+    with open(f"{gallery_file}.lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write_json(data, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+# --------------------------------
+# Incremental Training
+# --------------------------------
+def train_incremental(image_dir, gallery_file, name_fn=name_from_file, full=False,
+                      workers=None, chunk_size=8, progress=print_progress, prototypes=False,
+                      ann=False):
+    """
+    Bring gallery_file up to date with the photos in image_dir.
+
+    The manifest records size, mtime and SHA-1 for every photo seen so far.
+    Unchanged photos keep their existing gallery rows; only added or modified
+    photos are encoded, across `workers` processes, and rows of deleted photos
+    are dropped. Photos without a face or that cannot be read are remembered
+    too, so they are not retried until they change. Rows converted from
+    train.pkl stay for people without photos unless full=True, which
+    re-encodes everything from the photos alone. With prototypes=True the gallery also stores
+    per-identity prototypes for faster matching; with ann=True an IVF index
+    is built next to it. An existing index is always rebuilt so it never
+    goes stale.
+
+    Returns the new gallery and a report with counts, timing and the list of
+    failed photos; the report is also written next to the gallery.
+    """
+    with gallery_lock(gallery_file):
+        return _train_incremental(image_dir, gallery_file, name_fn, full, workers, chunk_size, progress,
+                                  prototypes, ann)
+
+
+def _train_incremental(image_dir, gallery_file, name_fn=name_from_file, full=False, workers=None,
+                       chunk_size=8, progress=print_progress, prototypes=False, ann=False):
+    started = time.monotonic()
+    manifest = load_manifest(gallery_file)
+    old_gallery = None
+    if not full and os.path.exists(gallery_file):
+        old_gallery = open_gallery(gallery_file)
+        manifest = _legacy_manifest(old_gallery, manifest)
+        if len(old_gallery) != len(manifest["rows"]):
+            print(f"Warning: {manifest_path(gallery_file)} does not match {gallery_file}. Retraining everything.")
+            old_gallery = None
+    if old_gallery is None:
+        manifest = {"files": {}, "rows": []}
+    old_rows = {path: row for row, path in enumerate(manifest["rows"])}
+
+    report = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "failed": 0, "failures": []}
+    files = {}
+    to_encode = []
+
+    # Pass 1: decide which photos need the expensive dlib work
+    images = scan_images(image_dir)
+    for rel_path in sorted(images):
+        st = images[rel_path]
+        entry = manifest["files"].get(rel_path)
+
+        if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            # A face row missing from the old gallery has to be encoded again
+            changed = entry.get("has_face", False) and rel_path not in old_rows
+        else:
+            # Size or mtime moved: only the content hash can tell if the photo really changed
+            sha1 = file_hash(os.path.join(image_dir, rel_path))
+            changed = entry is None or entry["sha1"] != sha1
+            entry = {"sha1": sha1} if changed else dict(entry)
+            entry["size"] = st.st_size
+            entry["mtime_ns"] = st.st_mtime_ns
+        entry = dict(entry, name=name_fn(os.path.basename(rel_path)))
+
+        if changed:
+            report["updated" if rel_path in manifest["files"] else "added"] += 1
+            to_encode.append(rel_path)
+        else:
+            report["unchanged"] += 1
+        files[rel_path] = entry
+
+    # Pass 2: encode in parallel, then assemble rows in sorted path order
+    encoded = encode_images([os.path.join(image_dir, p) for p in to_encode],
+                            workers=workers, chunk_size=chunk_size, progress=progress)
+    new_rows = {}
+    for rel_path in to_encode:
+        encoding, error = encoded[os.path.join(image_dir, rel_path)]
+        files[rel_path]["has_face"] = encoding is not None
+        files[rel_path]["error"] = error
+        if encoding is not None:
+            new_rows[rel_path] = encoding
+
+    names = []
+    encodings = []
+    rows = []
+    for rel_path in sorted(files):
+        entry = files[rel_path]
+        if rel_path in new_rows:
+            encodings.append(new_rows[rel_path])
+        elif entry.get("has_face"):
+            encodings.append(old_gallery.encodings[old_rows[rel_path]])
+        else:
+            report["failed"] += 1
+            report["failures"].append({"path": rel_path, "reason": entry.get("error") or "no face found"})
+            continue
+        names.append(entry["name"])
+        rows.append(rel_path)
+    if old_gallery is not None:
+        for name, encoding in _legacy_rows(old_gallery, manifest, set(names)):
+            names.append(name)
+            encodings.append(encoding)
+            rows.append(None)
+
+    report["removed"] = len(set(manifest["files"]) - set(files))
+
+    if encodings:
+        encodings = np.vstack([np.asarray(e, dtype=np.float32) for e in encodings])
+    gallery = Gallery(names, encodings)
+    if prototypes:
+        gallery.build_prototypes()
+    save_gallery(gallery, gallery_file)
+    save_manifest({"files": files, "rows": rows}, gallery_file)
+    if len(gallery) and (ann or os.path.exists(index_path(gallery_file))):
+        build_index(gallery_file, encodings=gallery.encodings)
+
+    elapsed = time.monotonic() - started
+    report["encoded"] = len(to_encode)
+    report["seconds"] = round(elapsed, 3)
+    report["photos_per_second"] = round(len(to_encode) / elapsed, 2) if elapsed > 0 else None
+    _write_json(report, report_path(gallery_file))
+    return gallery, report
+
+
+# --------------------------------
+# Enrollment Updates
+# --------------------------------
+def replace_identity(image_dir, gallery_file, name, photos, name_fn=name_from_file, replace=True, pkl_file=None):
+    """
+    Add the photos of a new enrollment of `name` without retraining anyone else.
+
+    `photos` maps paths relative to image_dir to their encoding, or to None
+    to have the photo encoded here. With `replace`, and only if every one of
+    them yields an encoding, the photos left from earlier enrollments of
+    `name` (<name>_<n>.jpg) are dropped with their rows and deleted once
+    the new gallery is saved, so a later train_incremental() agrees with the
+    result; otherwise they are kept. The gallery and manifest are rewritten
+    under gallery_lock() and each replaced atomically, so a LiveGallery
+    always loads either the old gallery or the new one. If the manifest does
+    not match the gallery, this falls back to an incremental training run.
+
+    Without gallery_file, the legacy `pkl_file` is the starting point, so
+    the first enrollment does not drop everyone enrolled before. Rows that
+    come from train.pkl are kept until `name` has photo rows of its own.
+
+    Returns the new gallery and a report like train_incremental's.
+    """
+    error = name_error(name)
+    if error:
+        raise ValueError(error)
+    for rel_path in photos:
+        if name_fn(os.path.basename(rel_path)) != name:
+            raise ValueError(f"{rel_path} is not named like a photo of {name}")
+
+    started = time.monotonic()
+    with gallery_lock(gallery_file):
+        old_gallery = load_gallery(gallery_file, pkl_file)
+        manifest = _legacy_manifest(old_gallery, load_manifest(gallery_file))
+        prototypes = old_gallery.prototypes is not None
+        if len(old_gallery) != len(manifest["rows"]):
+            print(f"Warning: {manifest_path(gallery_file)} does not match {gallery_file}. Retraining.")
+            return _train_incremental(image_dir, gallery_file, name_fn, prototypes=prototypes)
+
+        report = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "failed": 0, "failures": []}
+        new_files = {}
+        new_rows = []
+        encoded = 0
+        for rel_path in sorted(photos):
+            path = os.path.join(image_dir, rel_path)
+            encoding, error = photos[rel_path], None
+            if encoding is None:
+                [(_, encoding, error)] = _encode_chunk([path])
+                encoded += 1
+            st = os.stat(path)
+            report["updated" if rel_path in manifest["files"] else "added"] += 1
+            new_files[rel_path] = {"sha1": file_hash(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                                   "name": name, "has_face": encoding is not None, "error": error}
+            if encoding is None:
+                report["failed"] += 1
+                report["failures"].append({"path": rel_path, "reason": error or "no face found"})
+                continue
+            new_rows.append((rel_path, np.asarray(encoding, dtype=np.float32)))
+
+        # Earlier photos only go once the new set is complete; the new photos replace their own files anyway
+        stale = set()
+        if replace and not report["failed"]:
+            stale = {rel_path for rel_path in enrolled_photos(image_dir, name) if rel_path not in photos}
+        report["removed"] = len(stale)
+
+        files = {}
+        names = []
+        encodings = []
+        rows = []
+        # Every other row keeps its place, including other photos of this person
+        for row, rel_path in enumerate(manifest["rows"]):
+            if rel_path is not None and rel_path not in photos and rel_path not in stale:
+                names.append(old_gallery.name_of(row))
+                encodings.append(old_gallery.encodings[row])
+                rows.append(rel_path)
+        for rel_path, entry in manifest["files"].items():
+            if rel_path not in photos and rel_path not in stale:
+                files[rel_path] = entry
+                report["unchanged"] += 1
+        files.update(new_files)
+        for rel_path, encoding in new_rows:
+            names.append(name)
+            encodings.append(encoding)
+            rows.append(rel_path)
+        for legacy_name, encoding in _legacy_rows(old_gallery, manifest, set(names)):
+            names.append(legacy_name)
+            encodings.append(encoding)
+            rows.append(None)
+
+        if encodings:
+            encodings = np.vstack(encodings)
+        gallery = Gallery(names, encodings)
+        if prototypes:
+            gallery.build_prototypes()
+        save_gallery(gallery, gallery_file)
+        save_manifest({"files": files, "rows": rows}, gallery_file)
+        if len(gallery) and os.path.exists(index_path(gallery_file)):
+            build_index(gallery_file, encodings=gallery.encodings)
+
+        # Only now that the new gallery is published
+        for rel_path in stale:
+            os.remove(os.path.join(image_dir, rel_path))
+
+    report["encoded"] = encoded
+    report["seconds"] = round(time.monotonic() - started, 3)
+    return gallery, report
@@ -0,0 +1,264 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+from detection import DETECTION_CONFIG, DetectionPipeline
+from gallery import TOLERANCE, UNKNOWN, Gallery, load_gallery
+from recognition import recognize_images
+
+# Offline recognition over recorded videos: who appeared, when, for how long
+# and how close the match was. Each video is decoded lazily, one frame at a
+# time, and videos are spread over a process pool.
+# Usage: python video_timeline.py "ateam/videos/*.mp4" --gallery ateam/train.gal --stride 10 --out timeline.csv
+
+DEFAULT_STRIDE = 10
+# Frames handed to detection at once (the CNN detector batches same-sized frames)
+DEFAULT_BATCH = 4
+# A person missing for longer than this many seconds starts a new segment
+DEFAULT_MAX_GAP = 2.0
+CSV_FIELDS = ["video", "name", "start", "end", "duration", "sightings", "best_distance", "mean_distance"]
+
+
+# --------------------------------
+# Frame Pipeline (generators)
+# --------------------------------
+def video_frames(video_file, stride=DEFAULT_STRIDE):
+    """
+    Yield (frame index, seconds, RGB frame) for every `stride`-th frame.
+    Skipped frames are only grabbed, never decoded into an image.
+    """
+    cap = cv2.VideoCapture(video_file)
+    if not cap.isOpened():
+        raise IOError(f"Could not open {video_file}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    index = 0
+    try:
+        while cap.grab():
+            if index % stride == 0:
+                ok, frame = cap.retrieve()
+                if not ok:
+                    break
+                yield index, index / fps, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            index += 1
+    finally:
+        cap.release()
+
+
+def batched(frames, size):
+    """Group the frame stream into lists of up to `size` frames."""
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def recognized_frames(batches, gallery, pipeline, tolerance=TOLERANCE, timings=None):
+    """Yield (frame index, seconds, faces) with the recognized faces of each frame."""
+    for batch in batches:
+        faces = recognize_images([image for _, _, image in batch], gallery, tolerance, pipeline, timings)
+        for (index, seconds, _), frame_faces in zip(batch, faces):
+            yield index, seconds, frame_faces
+
+
+def build_timeline(frames, interval, max_gap=DEFAULT_MAX_GAP, include_unknown=False):
+    """
+    Merge per-frame sightings into segments, one per continuous appearance.
+
+    A segment ends once its person has not been seen for `max_gap` seconds;
+    `interval` is the time between sampled frames and counts towards the
+    last sighting, so a single sighting still lasts one interval. The
+    confidence of a segment is its best and mean face distance (lower is a
+    closer match), both None if no sighting had one (an Unknown face when
+    the gallery is empty).
+    """
+    open_segments = {}
+    segments = []
+
+    def close(name):
+        segment = open_segments.pop(name)
+        distances = segment.pop("distances")
+        segment["end"] = round(segment["end"] + interval, 3)
+        segment["duration"] = round(segment["end"] - segment["start"], 3)
+        segment["sightings"] = len(distances)
+        distances = [distance for distance in distances if distance != float("inf")]
+        segment["best_distance"] = round(min(distances), 4) if distances else None
+        segment["mean_distance"] = round(sum(distances) / len(distances), 4) if distances else None
+        segments.append(segment)
+
+    for _, seconds, faces in frames:
+        # The closest face counts if the same person is matched twice in a frame
+        seen = {}
+        for face in faces:
+            if face["name"] == UNKNOWN and not include_unknown:
+                continue
+            # No distance means there was nothing to compare against; it counts as a sighting only
+            distance = face["distance"] if face["distance"] is not None else float("inf")
+            seen[face["name"]] = min(distance, seen.get(face["name"], float("inf")))
+
+        for name in [name for name, segment in open_segments.items() if seconds - segment["end"] > max_gap]:
+            close(name)
+        for name, distance in seen.items():
+            segment = open_segments.setdefault(name, {"name": name, "start": round(seconds, 3), "distances": []})
+            segment["end"] = seconds
+            segment["distances"].append(distance)
+
+    for name in list(open_segments):
+        close(name)
+    return sorted(segments, key=lambda segment: (segment["start"], segment["name"]))
+
+
+def video_timeline(video_file, gallery, pipeline, stride=DEFAULT_STRIDE, batch_size=DEFAULT_BATCH,
+                   tolerance=TOLERANCE, max_gap=DEFAULT_MAX_GAP, include_unknown=False):
+    """Run one video through the pipeline; returns a result dict with its segments."""
+    cap = cv2.VideoCapture(video_file)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    timings = {}
+    sampled = [0]
+
+    def counted(frames):
+        for frame in frames:
+            sampled[0] += 1
+            yield frame
+
+    start = time.perf_counter()
+    frames = counted(video_frames(video_file, stride))
+    recognized = recognized_frames(batched(frames, batch_size), gallery, pipeline, tolerance, timings)
+    segments = build_timeline(recognized, stride / fps, max_gap, include_unknown)
+    elapsed = time.perf_counter() - start
+    return {
+        "video": video_file,
+        "fps": round(fps, 3),
+        "frames": frame_count,
+        "frames_processed": sampled[0],
+        "video_seconds": round(frame_count / fps, 3),
+        "seconds": round(elapsed, 3),
+        "timings_ms": {stage: round(ms, 1) for stage, ms in timings.items()},
+        "segments": segments,
+    }
+
+
+# --------------------------------
+# Parallel Jobs
+# --------------------------------
+def open_gallery_file(gallery_file):
+    """train.gal (legacy train.pkl next to it as fallback), or a .pkl given directly."""
+    if gallery_file.endswith(".pkl"):
+        return Gallery.from_pickle(gallery_file)
+    return load_gallery(gallery_file, os.path.splitext(gallery_file)[0] + ".pkl")
+
+
+_worker = {}
+
+
+def _init_worker(gallery_file, config_file):
+    # Each process loads the gallery once; train.gal is memory-mapped, so the
+    # rows are shared through the page cache rather than copied per worker
+    _worker["gallery"] = open_gallery_file(gallery_file)
+    _worker["pipeline"] = DetectionPipeline.from_config(config_file)
+
+
+def _run_video(video_file, options):
+    try:
+        return video_timeline(video_file, _worker["gallery"], _worker["pipeline"], **options)
+    except Exception as e:
+        return {"video": video_file, "error": str(e), "segments": []}
+
+
+def process_videos(video_files, gallery_file, config_file=DETECTION_CONFIG, workers=None, **options):
+    """
+    Build the timeline of every video, one video per worker process at a
+    time. Results come back in the order the videos were given.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(video_files)) or 1
+    results = {}
+    if workers == 1:
+        _init_worker(gallery_file, config_file)
+        for video_file in video_files:
+            results[video_file] = _run_video(video_file, options)
+            print_finished(results[video_file], len(results), len(video_files))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(gallery_file, config_file)) as pool:
+            futures = [pool.submit(_run_video, video_file, options) for video_file in video_files]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result["video"]] = result
+                print_finished(result, len(results), len(video_files))
+    return [results[video_file] for video_file in video_files]
+
+
+def print_finished(result, done, total):
+    if "error" in result:
+        status = f"failed: {result['error']}"
+    else:
+        status = f"{len(result['segments'])} segments, {result['video_seconds']}s of video in {result['seconds']}s"
+    print(f"[{done}/{total}] {result['video']}: {status}", file=sys.stderr)
+
+
+# --------------------------------
+# Output
+# --------------------------------
+def write_json(results, f):
+    json.dump({"timestamp": time.strftime("%Y-%m-%d %H:%M:%S"), "videos": results}, f, indent=2)
+    f.write("\n")
+
+
+def write_csv(results, f):
+    writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    for result in results:
+        for segment in result["segments"]:
+            writer.writerow({"video": result["video"], **segment})
+
+
+def positive_int(value):
+    """argparse type for counts that must be at least 1 (a stride of 0 would divide by zero)."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a timeline of recognized people from recorded videos.")
+    parser.add_argument("videos", nargs="+", help="video files or glob patterns")
+    parser.add_argument("--gallery", default="train.gal", help="train.gal (or legacy train.pkl)")
+    parser.add_argument("--config", default=DETECTION_CONFIG, help="detection settings JSON")
+    parser.add_argument("--stride", type=positive_int, default=DEFAULT_STRIDE, help="use every Nth frame")
+    parser.add_argument("--batch", type=positive_int, default=DEFAULT_BATCH, help="frames per detection call")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--max-gap", type=float, default=DEFAULT_MAX_GAP,
+                        help="seconds a person may be missing before their segment ends")
+    parser.add_argument("--unknown", action="store_true", help="include segments for unrecognized faces")
+    parser.add_argument("--workers", type=positive_int, default=None, help="parallel videos (default: all cores)")
+    parser.add_argument("--format", choices=["json", "csv"], default=None,
+                        help="output format (default: from --out extension, else json)")
+    parser.add_argument("--out", default=None, help="output file (default: stdout)")
+    args = parser.parse_args()
+
+    video_files = sorted({path for pattern in args.videos for path in glob.glob(pattern)})
+    if not video_files:
+        sys.exit("No videos found.")
+    results = process_videos(video_files, args.gallery, args.config, args.workers, stride=args.stride,
+                             batch_size=args.batch, tolerance=args.tolerance, max_gap=args.max_gap,
+                             include_unknown=args.unknown)
+
+    output_format = args.format or ("csv" if args.out and args.out.endswith(".csv") else "json")
+    write = write_csv if output_format == "csv" else write_json
+    if args.out:
+        with open(args.out, "w", newline="") as f:
+            write(results, f)
+    else:
+        write(results, sys.stdout)
@@ -1,108 +1,89 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, Response, request, jsonify
 import os
-import subprocess
-import threading
 import time
-import pickle
+import sys
+import cv2
 import face_recognition
 
+# Shared modules (gallery.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera import LiveCamera
+from recording import ContinuousRecorder
+from sources import camera_source
+from metrics import CONTENT_TYPE, render_metrics
+from detection import DetectionPipeline
+from gallery import UNKNOWN, LiveGallery
+from recognition import best_name, recognize_images
+from events import EVENTS_DB, EventStore, parse_limit, parse_time
+
 app = Flask(__name__)
 
-# Folders for saving videos and photos, and log file for recognized names
+# Folders for saving videos and photos
 VIDEO_FOLDER = "./videos"
 ACTIVE_PERSON_FOLDER = "./active_person"
-RECOGNITION_LOG = "./recognized_name.txt"  # Log for storing the recognized name
+RECORD_ON_RECOGNITION = 0  # Seconds to record when a known person is recognized (0 = off)
+RECORD_PREROLL = 0  # Seconds kept in memory and prepended to each recording (0 = off; JPEG-encodes every frame)
 os.makedirs(VIDEO_FOLDER, exist_ok=True)
 os.makedirs(ACTIVE_PERSON_FOLDER, exist_ok=True)
 
-# Variables to control recording
-recording = False
-record_process = None
-
-# Load known encodings and names from train.pkl
-Encodings = []
-Names = []
+# Load known encodings and names from train.gal (legacy train.pkl as fallback)
+# and reload them automatically whenever training rewrites the files
 PKL_FILE = 'train.pkl'
-if os.path.exists(PKL_FILE):
-    with open(PKL_FILE, 'rb') as f:
-        Names = pickle.load(f)
-        Encodings = pickle.load(f)
-else:
-    print("Warning: train.pkl not found. Facial recognition will not work.")
+GALLERY_FILE = 'train.gal'
+live_gallery = LiveGallery(GALLERY_FILE, PKL_FILE).watch()
 
+# Detection scale/model/upsample/ROI/min face size for this deployment
+DETECTION_CONFIG = 'detection.json'
+detector = DetectionPipeline.from_config(DETECTION_CONFIG)
 
-def record_video(duration):
-    """
-    Record video using GStreamer and save it to a file.
-    For a USB camera running at 30 fps, we capture duration*30 frames.
-    """
-    global record_process
-    timestamp = time.strftime("%Y%m%d-%H%M%S")
-    video_path = os.path.join(VIDEO_FOLDER, f"video_{timestamp}.mp4")
-    num_buffers = duration * 30  # assuming 30 fps
-
-    # Updated GStreamer pipeline for USB camera recording
-    gst_command = [
-        "gst-launch-1.0",
-        "v4l2src", f"device=/dev/video1", f"num-buffers={num_buffers}",
-        "!",
-        "image/jpeg,width=1280,height=720,framerate=30/1",
-        "!",
-        "jpegdec",
-        "!",
-        "videoconvert",
-        "!",
-        "x264enc", "tune=zerolatency", "bitrate=500", "speed-preset=ultrafast",
-        "!",
-        "mp4mux",
-        "!",
-        f"filesink location={video_path}"
-    ]
+# Recognition history (timestamp, camera, identity, distance, box, frame), written in the background.
+# Only the newest event frames (MAX_FRAMES in events.py) are kept in ACTIVE_PERSON_FOLDER.
+events = EventStore(EVENTS_DB, frame_dir=ACTIVE_PERSON_FOLDER).start()
 
-    try:
-        record_process = subprocess.Popen(" ".join(gst_command), shell=True)
-        record_process.wait(timeout=duration + 5)
-    except subprocess.TimeoutExpired:
-        record_process.terminate()
-    finally:
-        record_process = None
+# One long-lived GStreamer pipeline for the USB camera, owned by the server
+# (set CAMERA_SOURCE, e.g. "file:videos", to replay recordings instead)
+CAMERA_SOURCE = (
+    "gst:v4l2src device=/dev/video1 ! "
+    "image/jpeg,width=1280,height=720,framerate=30/1 ! "
+    "jpegdec ! videoconvert ! video/x-raw,format=BGR"
+)
+camera = LiveCamera(camera_source(CAMERA_SOURCE), name="zddotvid").start()
+
+# Recording branch: once triggered, writes fixed-length segments + index.m3u8,
+# starting with the last RECORD_PREROLL seconds if that is set
+recorder = ContinuousRecorder(camera, VIDEO_FOLDER, fps=30, frame_size=(1280, 720),
+                              preroll_seconds=RECORD_PREROLL).start()
 
 
-def capture_photo(photo_path):
+def capture_frame():
     """
-    Capture a single photo using GStreamer with a USB camera.
+    Take the next frame (BGR) from the live USB camera pipeline.
+    Returns None if the camera is unavailable.
     """
-    gst_command = (
-        f"gst-launch-1.0 v4l2src device=/dev/video1 num-buffers=1 ! "
-        f"image/jpeg,width=1280,height=720,framerate=30/1 ! "
-        f"jpegdec ! videoconvert ! jpegenc ! filesink location={photo_path}"
-    )
-    process = subprocess.run(gst_command, shell=True, stderr=subprocess.PIPE)
-    if process.returncode != 0:
-        print(f"Error capturing photo: {process.stderr.decode()}")
-        return False
-    return True
-
-
-def recognize_face(photo_path):
+    frame = camera.grab()
+    if frame is None:
+        print("Error capturing photo: no frame from the camera")
+        return None
+    return frame.image
+
+
+def recognize_face(image):
     """
-    Recognize the person in the given photo using face_recognition.
-    Returns the recognized name or "Unknown" if no match is found.
+    Recognize the people in the given BGR frame using face_recognition.
+    Returns the recognized name ("Unknown" if no match is found) and every face found.
     """
-    if not Encodings or not Names:
-        return "Unknown (no training data available)"
-    
-    image = face_recognition.load_image_file(photo_path)
-    face_positions = face_recognition.face_locations(image)
-    all_encodings = face_recognition.face_encodings(image, face_positions)
+    # One snapshot for the whole call, even if a reload swaps in a new one meanwhile
+    gallery = live_gallery.get()
+    if not len(gallery):
+        return "Unknown (no training data available)", []
     
-    for face_encoding in all_encodings:
-        matches = face_recognition.compare_faces(Encodings, face_encoding, tolerance=0.6)
-        if True in matches:
-            first_match_index = matches.index(True)
-            return Names[first_match_index]
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    timings = {}
+    faces = recognize_images([image], gallery, tolerance=0.6, pipeline=detector, timings=timings)[0]
+    print("Recognition timings (ms): " + ", ".join(f"{k}={v:.1f}" for k, v in timings.items()))
     
-    return "Unknown"
+    # Every face is scored against the whole gallery at once; closest match wins
+    return best_name(faces), faces
 
 
 @app.route("/")
@@ -113,57 +94,136 @@ def index():
 
 @app.route("/start-record", methods=["POST"])
 def start_record():
-    """Start video recording."""
-    global recording
-    if recording:
+    """Start a recording session (with the last RECORD_PREROLL seconds before the request, if set)."""
+    if recorder.recording:
         return jsonify({"message": "Already recording!"})
-    recording = True
-    # Duration is provided from the form; default to 5 seconds if not provided
-    duration = int(request.form.get("duration", 5))
-    threading.Thread(target=record_video, args=(duration,)).start()
-    return jsonify({"message": f"Recording started for {duration} seconds!"})
+    duration = int(request.form.get("duration", 5))  # Default to 5 seconds
+    session = recorder.trigger("api", duration)
+    return jsonify({"message": f"Recording started for {duration} seconds!", "session": session})
 
 
 @app.route("/stop-record", methods=["POST"])
 def stop_record():
     """Stop video recording."""
-    global recording, record_process
-    if not recording:
+    if not recorder.recording:
         return jsonify({"message": "No recording in progress!"})
-    if record_process:
-        record_process.terminate()
-        record_process = None
-    recording = False
+    recorder.stop()
     return jsonify({"message": "Recording stopped!"})
 
 
+@app.route("/record-status")
+def record_status():
+    """Pre-roll buffered, current session folder and segments written so far."""
+    return jsonify(recorder.status())
+
+
 @app.route("/capture-active-person", methods=["POST"])
 def capture_active_person():
     """
-    Capture a photo, perform facial recognition on it, and log the recognized name.
-    This is only allowed when recording is not in progress.
+    Capture a photo, perform facial recognition on it, and record the result.
+    Recording runs off the same pipeline, so this also works while recording.
     """
-    global recording, record_process
-    if recording or record_process:
-        return jsonify({"message": "Cannot capture photo while recording is in progress!"}), 400
-
-    # Delay to ensure the camera resource is free (adjust as needed)
-    time.sleep(7)
-    
-    photo_path = os.path.join(ACTIVE_PERSON_FOLDER, "active.jpg")
-    if not capture_photo(photo_path):
+    # The frame comes straight from the live pipeline, no camera restart needed
+    image = capture_frame()
+    if image is None:
         return jsonify({"message": "Failed to capture active person photo!"}), 500
 
-    recognized_name = recognize_face(photo_path)
+    recognized_name, faces = recognize_face(image)
+    # Keep the frame for reference, one file per capture so every event can point at its frame;
+    # a capture without faces has no events, so nothing to keep
+    timestamp = time.time()
+    frame_path = None
+    if faces:
+        frame_path = os.path.join(ACTIVE_PERSON_FOLDER, f"active_{int(timestamp * 1000)}.jpg")
+        cv2.imwrite(frame_path, image)
+    # A known face starts (or extends) a recording, with the seconds before it
+    if RECORD_ON_RECOGNITION and not recognized_name.startswith(UNKNOWN):
+        recorder.trigger(f"recognized {recognized_name}", RECORD_ON_RECOGNITION)
     
-    # Write the recognized name and timestamp to the log file
-    with open(RECOGNITION_LOG, "w") as log_file:
-        log_file.write(f"Recognized Name: {recognized_name}\n")
-        log_file.write(f"Timestamp: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+    # One event per face found, queued for the background writer
+    events.record_faces(camera.name, faces, frame_path, timestamp)
     
     return jsonify({"message": f"Photo captured and recognized as: {recognized_name}"})
 
 
+@app.route("/recognize", methods=["POST"])
+def recognize():
+    """
+    Recognize every face in one or more uploaded images (any multipart file field).
+    Returns boxes, best identity, distance and runner-up for each face.
+    """
+    uploads = [upload for key in request.files for upload in request.files.getlist(key)]
+    if not uploads:
+        return jsonify({"message": "No images uploaded!"}), 400
+
+    gallery = live_gallery.get()
+    images = []
+    results = []
+    for upload in uploads:
+        result = {"filename": upload.filename, "faces": []}
+        try:
+            images.append((result, face_recognition.load_image_file(upload)))
+        except Exception as e:
+            result["error"] = f"Could not read image: {e}"
+        results.append(result)
+
+    # Detection and matching run over the whole request at once
+    timings = {}
+    faces = recognize_images([image for _, image in images], gallery, tolerance=0.6,
+                             pipeline=detector, timings=timings)
+    for (result, _), image_faces in zip(images, faces):
+        result["faces"] = image_faces
+
+    return jsonify({
+        "gallery_version": live_gallery.version,
+        "images": results,
+        "timings_ms": {stage: round(ms, 2) for stage, ms in timings.items()},
+    })
+
+
+@app.route("/recognitions")
+def recognitions():
+    """
+    Recognition events, newest first. Optional filters: start, end (epoch
+    seconds or ISO time), identity, camera and limit (default 1000, at most 10000).
+    """
+    try:
+        start, end = parse_time(request.args.get("start")), parse_time(request.args.get("end"))
+    except ValueError as e:
+        return jsonify({"message": f"Invalid time: {e}"}), 400
+    try:
+        limit = parse_limit(request.args.get("limit"))
+    except ValueError as e:
+        return jsonify({"message": f"Invalid limit: {e}"}), 400
+    return jsonify(events.query(start, end, request.args.get("identity"), request.args.get("camera"), limit))
+
+
+@app.route("/recognitions/seen")
+def recognitions_seen():
+    """Who was seen between start and end: sightings, first/last time and best distance per identity."""
+    try:
+        start, end = parse_time(request.args.get("start")), parse_time(request.args.get("end"))
+    except ValueError as e:
+        return jsonify({"message": f"Invalid time: {e}"}), 400
+    return jsonify(events.seen(start, end, request.args.get("camera")))
+
+
+@app.route("/admin/reload-gallery", methods=["POST"])
+def reload_gallery():
+    """Force a gallery reload and report its version and size."""
+    if not live_gallery.reload():
+        status = live_gallery.status()
+        return jsonify({"message": f"Gallery reload failed: {live_gallery.error}. "
+                                   f"Still serving version {status['version']}.", **status}), 500
+    return jsonify(live_gallery.status())
+
+
+@app.route("/metrics")
+def metrics():
+    """Runtime metrics (stage latencies, frames, clients, recognitions, gallery) for Prometheus."""
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
 
@@ -1,45 +1,30 @@
-import face_recognition
+import argparse
 import os
-import pickle
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from training import train_incremental
 
 # Directory containing images for training
 image_dir = r'/home/checkout/Documents/hgn/recon/ddotvid/photos'  # Update this to the correct directory
-output_pkl = 'train.pkl'  # Output file for encodings
-
-Encodings = []  # List to store face encodings
-Names = []  # List to store corresponding names
-
-# Iterate through all images in the directory
-for root, dirs, files in os.walk(image_dir):
-    for file in files:
-        # Skip non-image files
-        if not (file.endswith(".jpg") or file.endswith(".png")):
-            continue
-
-        # Extract the name (e.g., william_1 -> william)
-        name = file.split("_")[0]  # Extract everything before the underscore
-        path = os.path.join(root, file)
-
-        # Load the image and compute the encoding
-        print(f"Processing: {path}")
-        image = face_recognition.load_image_file(path)
-        encodings = face_recognition.face_encodings(image)
-
-        # Skip if no face is detected
-        if not encodings:
-            print(f"No face found in {path}. Skipping.")
-            continue
-
-        # Add the encoding and name
-        Encodings.append(encodings[0])
-        Names.append(name)
-
-# Save encodings and names to a pickle file
-with open(output_pkl, 'wb') as f:
-    pickle.dump(Names, f)
-    pickle.dump(Encodings, f)
-
-print("Training completed. Encodings saved to:", output_pkl)
-
-
-
+output_gal = 'train.gal'  # Output file for encodings (memory-mappable gallery)
+
+# Encoding fans out to worker processes, which import this module again
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode photos into the face gallery.")
+    parser.add_argument("--full", action="store_true", help="re-encode every photo, not just new or changed ones")
+    parser.add_argument("--workers", type=int, default=None, help="encoding processes (default: one per core)")
+    parser.add_argument("--prototypes", action="store_true", help="also store per-person prototypes for faster matching")
+    parser.add_argument("--ann", action="store_true", help="also build an approximate search index for large galleries")
+    args = parser.parse_args()
+
+    gallery, report = train_incremental(image_dir, output_gal, full=args.full, workers=args.workers,
+                                        prototypes=args.prototypes, ann=args.ann)
+    print(f"Added {report['added']}, updated {report['updated']}, removed {report['removed']}, "
+          f"unchanged {report['unchanged']} photos in {report['seconds']}s.")
+    for failure in report["failures"]:
+        print(f"Skipped {failure['path']}: {failure['reason']}")
+
+    if gallery.prototypes is not None:
+        print(f"{len(gallery)} photos collapsed into {len(gallery.prototypes)} prototypes.")
+    print("Training completed. Encodings saved to:", output_gal)
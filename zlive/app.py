@@ -1,26 +1,32 @@
-import cv2
-from flask import Flask, render_template, Response
+import os
+import sys
+from flask import Flask, render_template, Response, request
+
+# Shared modules (camera.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera import CameraBroadcaster
+from detection import DetectionPipeline
+from gallery import LiveGallery
+from overlay import RecognitionOverlay
+from sources import camera_source
+from metrics import CONTENT_TYPE, render_metrics
+from streaming import stream_caps
 
 app = Flask(__name__)
 
-def gen_frames():
-    # Open the camera device; adjust the index if necessary (0 for /dev/video0, 1 for /dev/video1)
-    cap = cv2.VideoCapture(1)
-    if not cap.isOpened():
-        print("Error: Could not open video device.")
-        return
-
-    while True:
-        success, frame = cap.read()
-        if not success:
-            break
-        else:
-            # Optionally, you can resize or process the frame here
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame_bytes = buffer.tobytes()
-            # Yield a frame in byte format as a multipart response
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+# One capture thread shared by every viewer; adjust the index if necessary
+# (v4l2:0 for /dev/video0, v4l2:1 for /dev/video1, or set CAMERA_SOURCE).
+# The device is released when the last viewer leaves.
+camera = CameraBroadcaster(camera_source("v4l2:1"), name="zlive")
+
+# Known faces for /recognized_feed (train.gal in this folder, reloaded after retraining)
+live_gallery = LiveGallery("train.gal", "train.pkl").watch()
+recognized = RecognitionOverlay(camera, live_gallery, DetectionPipeline.from_config("detection.json"))
+
+def gen_frames(caps=None):
+    # Each viewer gets frames captured and JPEG-encoded once for everybody,
+    # scaled down or re-encoded per quality tier when its link cannot keep up
+    return camera.mjpeg_stream(caps=caps)
 
 @app.route('/')
 def index():
@@ -29,8 +35,18 @@ def index():
 
 @app.route('/video_feed')
 def video_feed():
-    # Return the streaming response
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    # Return the streaming response; ?width=&fps=&quality= cap what this client gets
+    return Response(gen_frames(stream_caps(request.args)), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/recognized_feed')
+def recognized_feed():
+    # Same stream with boxes and names drawn on it; recognition runs in the background
+    return Response(recognized.mjpeg_stream(stream_caps(request.args)), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/metrics')
+def metrics():
+    # Stage latencies, frame and client counts, recognitions and gallery size for Prometheus
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
 
 if __name__ == '__main__':
     # Run the app on all network interfaces for local testing
@@ -1,7 +1,14 @@
-import cv2
 from flask import Flask, render_template, Response, request, jsonify, send_from_directory
 import time
 import os
+import sys
+
+# Shared modules (camera.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera import CameraBroadcaster
+from enrollment import GalleryPublisher, enroll, name_error
+from sources import camera_source
+from metrics import CONTENT_TYPE, render_metrics
 
 app = Flask(__name__)
 
@@ -9,6 +16,11 @@ app = Flask(__name__)
 PHOTO_FOLDER = './photos'
 os.makedirs(PHOTO_FOLDER, exist_ok=True)
 
+# Finished enrollments are added to train.gal in the background; servers
+# that watch it (LiveGallery) pick each one up on their next poll
+GALLERY_FILE = 'train.gal'
+publisher = GalleryPublisher(PHOTO_FOLDER, GALLERY_FILE)
+
 # Directions for the user to face
 DIRECTIONS = [
     "Center",
@@ -18,12 +30,19 @@ DIRECTIONS = [
     "Slightly Down"
 ]
 
-def capture_photo(cap):
-    """Capture a single frame from the given VideoCapture instance."""
-    ret, frame = cap.read()
-    if not ret:
+# One capture shared by every enrollment in progress: opened for the first one
+# and released after the last. Use "v4l2:2" (for /dev/video2) if that works better.
+camera = CameraBroadcaster(camera_source("v4l2:1"), name="zphotocap")
+
+# Seconds to wait for a frame before giving up on a photo
+CAPTURE_TIMEOUT = 2.0
+
+def capture_photo(subscription):
+    """Take the next frame from the given camera subscription."""
+    frame = subscription.get(timeout=CAPTURE_TIMEOUT)
+    if frame is None:
         return None
-    return frame
+    return frame.image
 
 @app.route('/')
 def index():
@@ -33,42 +52,31 @@ def index():
 @app.route('/take-photos-stream', methods=['GET'])
 def take_photos_stream():
     """
-    SSE endpoint that instructs the user to face various directions,
-    waits a few seconds for each, then captures a photo from the camera.
-    Photos are saved as <name>_1.jpg, <name>_2.jpg, etc.
+    SSE endpoint that instructs the user to face various directions and
+    captures each photo as soon as a live frame passes the quality and pose
+    checks for it. Photos are saved as <name>_1.jpg, <name>_2.jpg, etc.
     """
     name = request.args.get('name', 'photo').strip()
-    if not name:
-        return Response("data: Error: Name is required!\n\n", mimetype="text/event-stream")
+    error = name_error(name)
+    if error:
+        return Response(f"data: Error: {error}\n\n", mimetype="text/event-stream")
     
-    # Open the camera device. Use index 2 (for /dev/video2) if that works better.
-    cap = cv2.VideoCapture(1)
-    if not cap.isOpened():
-        return Response("data: Error: Could not open video device.\n\n", mimetype="text/event-stream")
-    
-    # Optional: allow the camera a moment to warm up
+    # Join the shared capture, allowing the camera a moment to warm up if this opened it.
+    # A queue of one: the checks always look at the newest frame.
+    subscription = camera.subscribe(max_queue=1)
     time.sleep(1)
+    if subscription.closed:
+        camera.unsubscribe(subscription)
+        return Response("data: Error: Could not open video device.\n\n", mimetype="text/event-stream")
     
     def generate():
-        for i, direction in enumerate(DIRECTIONS):
-            yield f"data: Please face {direction}\n\n"
-            # Wait a few seconds for the user to adjust
-            time.sleep(2)
-            
-            # Capture a photo
-            frame = capture_photo(cap)
-            if frame is None:
-                yield f"data: Failed to capture photo {i+1} for {direction}\n\n"
-                continue
-            
-            photo_filename = f"{name}_{i+1}.jpg"
-            filepath = os.path.join(PHOTO_FOLDER, photo_filename)
-            cv2.imwrite(filepath, frame)
-            yield f"data: Captured photo {i+1} ({direction}) as {photo_filename}\n\n"
-            time.sleep(1)
-            
-        yield "data: Photo capture complete!\n\n"
-        cap.release()
+        try:
+            for message in enroll(lambda: capture_photo(subscription), PHOTO_FOLDER, name, DIRECTIONS,
+                                  publisher=publisher):
+                yield f"data: {message}\n\n"
+        finally:
+            # Also runs if the client disconnects early
+            camera.unsubscribe(subscription)
     
     return Response(generate(), mimetype="text/event-stream")
 
@@ -77,6 +85,11 @@ def serve_photo(filename):
     """Serve a photo from the photos folder."""
     return send_from_directory(PHOTO_FOLDER, filename)
 
+@app.route('/metrics')
+def metrics():
+    """Runtime metrics (stage latencies, frames, clients, recognitions, gallery) for Prometheus."""
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
 
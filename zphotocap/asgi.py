@@ -0,0 +1,40 @@
+import asyncio
+import os
+import sys
+
+# Shared modules (async_serving.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as server
+from async_serving import AsyncApp, event_stream, single_event, sse
+from enrollment import enroll_async, name_error
+
+# ASGI serving mode: uvicorn asgi:app --host 0.0.0.0 --port 5000
+# Enrollment runs as a coroutine; other routes are served by the Flask app.
+app = AsyncApp(fallback=server.app)
+
+
+@app.route("/take-photos-stream")
+async def take_photos_stream(request):
+    """
+    SSE endpoint that instructs the user to face various directions and
+    captures each photo from the shared camera once a frame passes the checks.
+    """
+    name = request.args.get('name', 'photo').strip()
+    error = name_error(name)
+    if error:
+        return event_stream(single_event(f"Error: {error}"))
+
+    async def generate():
+        subscription = server.camera.subscribe(max_queue=1)
+        try:
+            await asyncio.sleep(1)  # Camera warm-up if this enrollment opened it
+            if subscription.closed:
+                yield sse("Error: Could not open video device.")
+                return
+            async for message in enroll_async(lambda: server.capture_photo(subscription), server.PHOTO_FOLDER,
+                                              name, server.DIRECTIONS, publisher=server.publisher):
+                yield sse(message)
+        finally:
+            server.camera.unsubscribe(subscription)
+
+    return event_stream(generate())
@@ -1,26 +1,34 @@
-import cv2
-from flask import Flask, render_template, Response
+import os
+import sys
+from flask import Flask, render_template, Response, request
+
+# Shared modules (camera.py, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera import CameraBroadcaster
+from detection import DetectionPipeline
+from gallery import LiveGallery
+from overlay import RecognitionOverlay
+from sources import camera_source
+from metrics import CONTENT_TYPE, render_metrics
+from streaming import stream_caps
 
 
 app = Flask(__name__)
 
 
-def gen_frames():
-    # Open the camera device (adjust index if needed)
-    cap = cv2.VideoCapture(1)
-    if not cap.isOpened():
-        print("Error: Could not open video device.")
-        return
-    while True:
-        success, frame = cap.read()
-        if not success:
-            break
-        else:
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame_bytes = buffer.tobytes()
-            # Yield frame in multipart MIME format
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+# One capture thread shared by every viewer (adjust index if needed);
+# the device is released when the last viewer leaves
+camera = CameraBroadcaster(camera_source("v4l2:1"), name="zpos")
+
+# Server-side recognition overlay, so clients do not need face-api.js models
+live_gallery = LiveGallery("train.gal", "train.pkl").watch()
+recognized = RecognitionOverlay(camera, live_gallery, DetectionPipeline.from_config("detection.json"))
+
+
+def gen_frames(caps=None):
+    # Frames are captured and JPEG-encoded once, whatever the number of viewers;
+    # slow clients get smaller/lower-quality variants shared per quality tier
+    return camera.mjpeg_stream(caps=caps)
 
 
 @app.route('/')
@@ -30,10 +38,24 @@ def index():
 
 @app.route('/video_feed')
 def video_feed():
-    return Response(gen_frames(),
+    # Optional ?width=&fps=&quality= caps for this client
+    return Response(gen_frames(stream_caps(request.args)),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
+@app.route('/recognized_feed')
+def recognized_feed():
+    # Boxes and names drawn on the server at camera frame rate
+    return Response(recognized.mjpeg_stream(stream_caps(request.args)),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/metrics')
+def metrics():
+    # Stage latencies, frame and client counts, recognitions and gallery size for Prometheus
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
 